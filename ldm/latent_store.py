@@ -0,0 +1,143 @@
+"""chunked on-disk store of sampled latents
+
+txt2img --latents_only appends the final latents of the sampler here instead of decoding them, and
+scripts/decode_latents.py decodes them later, in batches and at any resolution. A 4x64x64 latent takes 32 KiB in
+float16, about a tenth of the png of the 512x512 image it decodes to.
+"""
+
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+
+class LatentStore(object):
+    """
+    Append-only store of latents under root. Latents are buffered per shape and written in chunks of up to
+    chunk_size latents as chunk-<n>.npy files. Once a chunk is on disk, one json line per latent with its id, chunk,
+    offset and metadata is appended to index.jsonl, so the index never refers to missing data. Chunks are read
+    memory mapped.
+
+    :param root: directory of the store, created if it does not exist. an existing store is appended to.
+    :param chunk_size: maximum number of latents per chunk file.
+    :param dtype: dtype the latents are stored in.
+    """
+    def __init__(self, root, chunk_size=256, dtype="float16"):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+        self.entries = list()
+        index_path = os.path.join(root, "index.jsonl")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        # the last line of a run that was killed while writing it
+                        pass
+        chunks = glob.glob(os.path.join(root, "chunk-*.npy"))
+        self.next_chunk = 1 + max([int(os.path.basename(c)[len("chunk-"):-len(".npy")]) for c in chunks], default=-1)
+        self.next_id = 1 + max([e["id"] for e in self.entries], default=-1)
+        self.index_file = open(index_path, "a")
+        # shape -> list of (id, latent, metadata, pending append) not written yet
+        self.buffers = dict()
+        self.mmaps = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, latents, metadata=None, on_flush=None):
+        """
+        :param latents: (b, c, h, w) tensor or numpy array.
+        :param metadata: b json serializable dicts stored in the index, e.g. prompt and seed.
+        :param on_flush: called without arguments once all b latents are on disk and in the index.
+        :return: the ids of the latents.
+        """
+        if torch.is_tensor(latents):
+            latents = latents.detach().float().cpu().numpy()
+        latents = np.asarray(latents).astype(self.dtype)
+        metadata = metadata if metadata is not None else [dict() for _ in range(len(latents))]
+        assert len(metadata) == len(latents), "need one metadata dict per latent"
+        pending = {"remaining": len(latents), "on_flush": on_flush}
+        with self.lock:
+            ids = list(range(self.next_id, self.next_id + len(latents)))
+            self.next_id += len(latents)
+            for i, latent, meta in zip(ids, latents, metadata):
+                buffer = self.buffers.setdefault(latent.shape, list())
+                buffer.append((i, latent, meta, pending))
+                if len(buffer) >= self.chunk_size:
+                    self.write_chunk(latent.shape)
+        return ids
+
+    def write_chunk(self, shape):
+        buffer = self.buffers.pop(shape, list())
+        if len(buffer) == 0:
+            return
+        name = f"chunk-{self.next_chunk:06}.npy"
+        self.next_chunk += 1
+        path = os.path.join(self.root, name)
+        # write and rename, so that a chunk is either complete or missing
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.stack([latent for _, latent, _, _ in buffer]))
+        os.replace(path + ".tmp", path)
+
+        for offset, (i, latent, meta, _) in enumerate(buffer):
+            entry = dict(meta, id=i, chunk=name, offset=offset, shape=list(latent.shape))
+            self.index_file.write(json.dumps(entry) + "\n")
+            self.entries.append(entry)
+        self.index_file.flush()
+
+        for _, _, _, pending in buffer:
+            pending["remaining"] -= 1
+            if pending["remaining"] == 0 and pending["on_flush"] is not None:
+                pending["on_flush"]()
+
+    def flush(self):
+        """write all buffered latents, in chunks smaller than chunk_size if need be"""
+        with self.lock:
+            for shape in list(self.buffers.keys()):
+                self.write_chunk(shape)
+
+    def close(self):
+        self.flush()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def chunk(self, name):
+        if name not in self.mmaps:
+            self.mmaps[name] = np.load(os.path.join(self.root, name), mmap_mode="r")
+        return self.mmaps[name]
+
+    def get(self, entries):
+        """the latents of index entries of the same shape, as one (b, c, h, w) numpy array"""
+        return np.stack([self.chunk(e["chunk"])[e["offset"]] for e in entries])
+
+    def batches(self, batch_size, entries=None):
+        """
+        Iterate over (entries, latents) batches of up to batch_size latents of the same shape, in the order of the
+        index.
+        :param entries: the index entries to read, all if None.
+        """
+        entries = self.entries if entries is None else entries
+        by_shape = dict()
+        for e in entries:
+            batch = by_shape.setdefault(tuple(e["shape"]), list())
+            batch.append(e)
+            if len(batch) == batch_size:
+                yield batch, self.get(batch)
+                by_shape[tuple(e["shape"])] = list()
+        for batch in by_shape.values():
+            if len(batch) > 0:
+                yield batch, self.get(batch)
@@ -4,9 +4,43 @@ import torch
 import numpy as np
 from tqdm import tqdm
 from functools import partial
+from contextlib import contextmanager, nullcontext
 
+from ldm.modules.attention import cross_attention_kv_cache
+from ldm.modules.diffusionmodules.openaimodel import UNetModel, timestep_schedule
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+    extract_into_tensor, make_generators, randn
+from ldm.models.diffusion.sampling_util import ClassifierFreeGuidance, ConvergenceMonitor, \
+    PartialClassifierFreeGuidance, cat_conditioning, select_conditioning, select_generator
+
+
+class DDIMSampleState(object):
+    """
+    Progress of a single sample through its own DDIM schedule. Created by DDIMSampler.init_state and advanced by
+    DDIMSampler.step, which runs samples at different steps of different schedules in one forward pass.
+    """
+    def __init__(self, x, cond, unconditional_conditioning, scale, timesteps, coefs, tag=None, generator=None,
+                 eta=0.):
+        self.x = x
+        self.cond = cond
+        self.unconditional_conditioning = unconditional_conditioning
+        self.scale = scale
+        # timesteps and coefficient rows in sampling order
+        self.timesteps = timesteps
+        self.coefs = coefs
+        self.i = 0
+        self.pred_x0 = None
+        self.tag = tag
+        self.generator = generator
+        self.eta = eta
+
+    @property
+    def done(self):
+        return self.i >= len(self.timesteps)
+
+    @property
+    def guided(self):
+        return self.unconditional_conditioning is not None and self.scale != 1.
 
 
 class DDIMSampler(object):
@@ -15,11 +49,19 @@ class DDIMSampler(object):
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # eta of make_schedule, None before it is called
+        self.ddim_eta = None
+        self.state_schedules = dict()
+        # the integer timesteps of all state schedules, registered with the unets while stepping() is active
+        self.state_timesteps = set()
+        self.stepping_unets = None
+        # (states, guidance, generators) of the last step(), reused for as long as the same states are stepped
+        self.step_inputs = None
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
@@ -53,6 +95,30 @@ class DDIMSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        self.ddim_eta = ddim_eta
+        # per-step coefficients of the update in p_sample_ddim, indexed by the step index
+        self.register_buffer('ddim_coefs', self.make_coef_table(ddim_alphas, ddim_alphas_prev, ddim_sigmas))
+        self.register_buffer('ddpm_coefs', self.make_coef_table(alphas_cumprod, self.model.alphas_cumprod_prev,
+                                                                sigmas_for_original_sampling_steps))
+
+    @staticmethod
+    def make_coef_table(alphas, alphas_prev, sigmas):
+        """
+        Precompute the coefficients of the DDIM update for every step, such that
+            pred_x0 = recip_sqrt_a_t * x - sqrt_recipm1_a_t * e_t
+            x_prev = sqrt_a_prev * pred_x0 + dir_coef * e_t + sigma_t * noise
+        :return: a [num_steps x 5] float32 tensor with columns
+                 (recip_sqrt_a_t, sqrt_recipm1_a_t, sqrt_a_prev, dir_coef, sigma_t).
+        """
+        to_float64 = lambda x: torch.as_tensor(np.asarray(x.cpu() if torch.is_tensor(x) else x), dtype=torch.float64)
+        alphas, alphas_prev, sigmas = map(to_float64, (alphas, alphas_prev, sigmas))
+        table = torch.stack([1. / alphas.sqrt(),
+                             (1. / alphas - 1.).sqrt(),
+                             alphas_prev.sqrt(),
+                             (1. - alphas_prev - sigmas ** 2).clamp(min=0.).sqrt(),
+                             sigmas], dim=1)
+        return table.to(torch.float32)
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -76,8 +142,17 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               guidance_policy="batched",
+               early_exit_threshold=None,
+               early_exit_patience=2,
+               generator=None,
                **kwargs
                ):
+        """
+        :param generator: None, a torch.Generator, or one torch.Generator or seed per sample, for x_T (if not given)
+                          and the noise of every step. with one per sample, a sample only depends on its own
+                          conditioning and seed, not on the size or the other samples of the batch.
+        """
         if conditioning is not None:
             if isinstance(conditioning, dict):
                 cbs = conditioning[list(conditioning.keys())[0]].shape[0]
@@ -93,21 +168,27 @@ class DDIMSampler(object):
         size = (batch_size, C, H, W)
         print(f'Data shape for DDIM sampling is {size}, eta {eta}')
 
-        samples, intermediates = self.ddim_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    )
+        with cross_attention_kv_cache(self.model), timestep_schedule(self.model, self.ddim_timesteps):
+            samples, intermediates = self.ddim_sampling(conditioning, size,
+                                                        callback=callback,
+                                                        img_callback=img_callback,
+                                                        quantize_denoised=quantize_x0,
+                                                        mask=mask, x0=x0,
+                                                        ddim_use_original_steps=False,
+                                                        noise_dropout=noise_dropout,
+                                                        temperature=temperature,
+                                                        score_corrector=score_corrector,
+                                                        corrector_kwargs=corrector_kwargs,
+                                                        x_T=x_T,
+                                                        log_every_t=log_every_t,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        unconditional_conditioning=unconditional_conditioning,
+                                                        guidance_policy=guidance_policy,
+                                                        early_exit_threshold=early_exit_threshold,
+                                                        early_exit_patience=early_exit_patience,
+                                                        generator=make_generators(generator, batch_size,
+                                                                                  self.model.betas.device),
+                                                        )
         return samples, intermediates
 
     @torch.no_grad()
@@ -116,11 +197,18 @@ class DDIMSampler(object):
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_policy="batched",
+                      early_exit_threshold=None, early_exit_patience=2, generator=None):
+        """
+        :param early_exit_threshold: if given, a sample stops as soon as the relative change of its pred_x0 stayed
+                                     below this threshold for early_exit_patience steps, and its pred_x0 is
+                                     returned. the remaining samples continue with a smaller batch; the steps after
+                                     which the samples stopped are returned as intermediates['stop_steps'].
+        """
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = randn(shape, device, generator)
         else:
             img = x_T
 
@@ -131,15 +219,21 @@ class DDIMSampler(object):
             timesteps = self.ddim_timesteps[:subset_end]
 
         intermediates = {'x_inter': [img], 'pred_x0': [img]}
-        time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
+        time_range = list(reversed(range(0,timesteps))) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        time_table = torch.tensor(np.ascontiguousarray(time_range), device=device, dtype=torch.long)
+        guidance = ClassifierFreeGuidance(self.model.apply_model, cond, unconditional_conditioning,
+                                          unconditional_guidance_scale, policy=guidance_policy)
+        monitor = None
+        if early_exit_threshold is not None:
+            monitor = ConvergenceMonitor(b, early_exit_threshold, early_exit_patience, on_drop=guidance.select)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            ts = time_table[i].expand(b)
 
             if mask is not None:
                 assert x0 is not None
@@ -151,60 +245,206 @@ class DDIMSampler(object):
                                       noise_dropout=noise_dropout, score_corrector=score_corrector,
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning)
+                                      unconditional_conditioning=unconditional_conditioning,
+                                      guidance=guidance, generator=generator)
             img, pred_x0 = outs
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
 
+            if monitor is not None:
+                keep = monitor.update(pred_x0, i + 1)
+                if keep is not None:
+                    # drop the finished samples from the batch
+                    img, pred_x0 = img[keep], pred_x0[keep]
+                    cond = select_conditioning(cond, keep)
+                    generator = select_generator(generator, keep)
+                    if mask is not None and mask.shape[0] == keep.shape[0]:
+                        mask = mask[keep]
+                    if x0 is not None and x0.shape[0] == keep.shape[0]:
+                        x0 = x0[keep]
+                    b = img.shape[0]
+
             if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['x_inter'].append(img)
-                intermediates['pred_x0'].append(pred_x0)
+                intermediates['x_inter'].append(img if monitor is None else monitor.merge(img))
+                intermediates['pred_x0'].append(pred_x0 if monitor is None else monitor.merge(pred_x0))
+
+            if monitor is not None and monitor.finished:
+                break
 
+        if monitor is not None:
+            img = monitor.merge(img)
+            intermediates['stop_steps'] = monitor.stop_steps
         return img, intermediates
 
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
-        b, *_, device = *x.shape, x.device
-
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            e_t = self.model.apply_model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance=None,
+                      generator=None):
+        if guidance is None:
+            guidance = ClassifierFreeGuidance(self.model.apply_model, c, unconditional_conditioning,
+                                              unconditional_guidance_scale)
+        e_t = guidance(x, t)
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
+        coefs = self.ddpm_coefs if use_original_steps else self.ddim_coefs
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        return self.ddim_step(x, e_t, coefs[index], repeat_noise=repeat_noise, quantize_denoised=quantize_denoised,
+                              temperature=temperature, noise_dropout=noise_dropout, generator=generator,
+                              stochastic=self.ddim_eta != 0)
+
+    def ddim_step(self, x, e_t, coefs, repeat_noise=False, quantize_denoised=False, temperature=1.,
+                  noise_dropout=0., generator=None, stochastic=True):
+        """
+        The DDIM update given the model output.
+        :param coefs: one row of the coefficient table shared by the batch, or a [b x 5] tensor with one row per
+                      sample.
+        :param generator: for the noise, see make_generators.
+        :param stochastic: False if sigma_t is known to be 0 (eta 0), to skip drawing the noise.
+        """
+        # views into the table, kept at x.dim() dims (rather than 0-dim) so that a half precision e_t is still
+        # promoted to float32
+        recip_sqrt_at, sqrt_recipm1_at, sqrt_a_prev, dir_coef, sigma_t = \
+            coefs.reshape(-1, 5).t().reshape(5, -1, *((1,) * (x.dim() - 1)))
 
         # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        pred_x0 = recip_sqrt_at * x - sqrt_recipm1_at * e_t
         if quantize_denoised:
             pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
         # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        dir_xt = dir_coef * e_t
+        x_prev = sqrt_a_prev * pred_x0 + dir_xt
+        if stochastic:
+            noise = sigma_t * noise_like(x.shape, x.device, repeat_noise, generator=generator) * temperature
+            if noise_dropout > 0.:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+            x_prev = x_prev + noise
         return x_prev, pred_x0
 
+    def state_schedule(self, S, eta=0., ddim_discretize="uniform"):
+        """timesteps and coefficient table of an S step schedule, in sampling order"""
+        key = (S, eta, ddim_discretize)
+        if key not in self.state_schedules:
+            ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=S,
+                                                 num_ddpm_timesteps=self.ddpm_num_timesteps, verbose=False)
+            ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(
+                alphacums=self.model.alphas_cumprod.cpu(), ddim_timesteps=ddim_timesteps, eta=eta, verbose=False)
+            coefs = self.make_coef_table(ddim_alphas, ddim_alphas_prev, ddim_sigmas)
+            timesteps = torch.tensor(np.flip(ddim_timesteps).copy(), dtype=torch.long)
+            self.state_schedules[key] = (timesteps.to(self.model.device), coefs.flip(0).to(self.model.device))
+            if not self.state_timesteps.issuperset(ddim_timesteps.tolist()):
+                self.state_timesteps.update(ddim_timesteps.tolist())
+                self.register_state_timesteps()
+        return self.state_schedules[key]
+
+    def register_state_timesteps(self):
+        if self.stepping_unets is None or len(self.state_timesteps) == 0:
+            return
+        timesteps = sorted(self.state_timesteps)
+        for m in self.stepping_unets:
+            m.set_timestep_schedule(timesteps)
+
+    @contextmanager
+    def stepping(self):
+        """
+        Keep the cross-attention key / value cache and the ResBlock timestep tables of the timesteps of every state
+        schedule active across calls to step(), e.g. around the loop of a server that keeps stepping states.
+        """
+        self.stepping_unets = [m for m in self.model.modules() if isinstance(m, UNetModel)]
+        try:
+            with cross_attention_kv_cache(self.model):
+                self.register_state_timesteps()
+                yield
+        finally:
+            for m in self.stepping_unets:
+                m.clear_timestep_schedule()
+            self.stepping_unets = None
+            self.step_inputs = None
+
+    def init_state(self, S, conditioning, shape=None, x_T=None, eta=0., unconditional_guidance_scale=1.,
+                   unconditional_conditioning=None, tag=None, generator=None):
+        """
+        Start sampling a single sample with its own step count, eta and guidance scale. Advance it with step().
+        :param conditioning: conditioning of the sample, with a batch dimension of 1.
+        :param shape: (C, H, W) of the latent, only used when x_T is not given.
+        :param x_T: start code with a batch dimension of 1.
+        :param tag: anything, to identify the state.
+        :param generator: a torch.Generator or seed of the sample, for x_T (if not given) and the noise of every
+                          step, such that the sample does not depend on the states it is stepped with.
+        """
+        timesteps, coefs = self.state_schedule(S, eta)
+        if generator is not None:
+            generator = make_generators([generator], 1, self.model.device)[0]
+        if x_T is None:
+            x_T = randn((1, *shape), self.model.device, generator)
+        return DDIMSampleState(x_T, conditioning, unconditional_conditioning, unconditional_guidance_scale,
+                               timesteps, coefs, tag=tag, generator=generator, eta=eta)
+
+    @torch.no_grad()
+    def step(self, states, temperature=1., noise_dropout=0., guidance_policy="batched"):
+        """
+        Advance every unfinished state by one DDIM step, using a single model call for all of them. The states may
+        be at different steps of different schedules but need to share the latent shape.
+        :return: the states that finished with this step.
+        """
+        states = [s for s in states if not s.done]
+        if len(states) == 0:
+            return []
+        assert all(s.x.shape == states[0].x.shape for s in states), "states have to share the latent shape"
+
+        x = torch.cat([s.x for s in states])
+        ts = torch.stack([s.timesteps[s.i] for s in states])
+        coefs = torch.stack([s.coefs[s.i] for s in states])
+        guidance, generator = self.step_guidance(states, x, guidance_policy)
+        e_t = guidance(x, ts)
+        x_prev, pred_x0 = self.ddim_step(x, e_t, coefs, temperature=temperature, noise_dropout=noise_dropout,
+                                         generator=generator, stochastic=any(s.eta != 0 for s in states))
+
+        finished = list()
+        for j, s in enumerate(states):
+            s.x = x_prev[j:j + 1]
+            s.pred_x0 = pred_x0[j:j + 1]
+            s.i += 1
+            if s.done:
+                finished.append(s)
+        return finished
+
+    def step_guidance(self, states, x, guidance_policy="batched"):
+        """
+        The guidance and the generators of a step over states. They are built when the set of states changes and
+        reused otherwise, so that the concatenated conditioning (and with it the cross-attention key / value cache
+        entry) and the doubled inputs of the guidance carry over from step to step. Only the guided states are
+        evaluated unconditionally.
+        """
+        cached = self.step_inputs
+        if cached is not None and len(cached[0]) == len(states) and cached[1].policy == guidance_policy and \
+                all(a is b for a, b in zip(cached[0], states)):
+            return cached[1], cached[2]
+
+        guided = [j for j, s in enumerate(states) if s.guided]
+        cond = cat_conditioning(*[s.cond for s in states])
+        uc, scale = None, 1.
+        if len(guided) > 0:
+            uc = cat_conditioning(*[states[j].unconditional_conditioning for j in guided])
+            scale = torch.tensor([states[j].scale for j in guided], device=x.device)
+            scale = scale.view(-1, *((1,) * (x.dim() - 1)))
+        if len(guided) == len(states):
+            guidance = ClassifierFreeGuidance(self.model.apply_model, cond, uc, scale, policy=guidance_policy)
+        else:
+            guided = torch.tensor(guided, dtype=torch.long, device=x.device)
+            guidance = PartialClassifierFreeGuidance(self.model.apply_model, cond, uc, scale, guided,
+                                                     policy=guidance_policy)
+        generator = None
+        if all(s.generator is not None for s in states):
+            generator = [s.generator for s in states]
+        self.step_inputs = (list(states), guidance, generator)
+        return guidance, generator
+
     @torch.no_grad()
-    def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
+    def stochastic_encode(self, x0, t, use_original_steps=False, noise=None, generator=None):
         # fast, but does not allow for exact reconstruction
         # t serves as an index to gather the correct alphas
         if use_original_steps:
@@ -215,13 +455,13 @@ class DDIMSampler(object):
             sqrt_one_minus_alphas_cumprod = self.ddim_sqrt_one_minus_alphas
 
         if noise is None:
-            noise = torch.randn_like(x0)
+            noise = randn(x0.shape, x0.device, make_generators(generator, x0.shape[0], x0.device)).to(x0.dtype)
         return (extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0 +
                 extract_into_tensor(sqrt_one_minus_alphas_cumprod, t, x0.shape) * noise)
 
     @torch.no_grad()
     def decode(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               use_original_steps=False):
+               use_original_steps=False, guidance_policy="batched", generator=None):
 
         timesteps = np.arange(self.ddpm_num_timesteps) if use_original_steps else self.ddim_timesteps
         timesteps = timesteps[:t_start]
@@ -232,10 +472,18 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
-            x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+        generator = make_generators(generator, x_latent.shape[0], x_latent.device)
+        time_table = torch.tensor(np.ascontiguousarray(time_range), device=x_latent.device, dtype=torch.long)
+        guidance = ClassifierFreeGuidance(self.model.apply_model, cond, unconditional_conditioning,
+                                          unconditional_guidance_scale, policy=guidance_policy)
+        # the original steps are not a schedule the ResBlock projections are precomputed for
+        schedule = nullcontext() if use_original_steps else timestep_schedule(self.model, self.ddim_timesteps)
+        with cross_attention_kv_cache(self.model), schedule:
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = time_table[i].expand(x_latent.shape[0])
+                x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=unconditional_conditioning,
+                                              guidance=guidance, generator=generator)
         return x_dec
\ No newline at end of file
@@ -6,6 +6,8 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 
+import os
+import hashlib
 import torch
 import torch.nn as nn
 import numpy as np
@@ -14,6 +16,7 @@ from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange, repeat
 from contextlib import contextmanager
 from functools import partial
+from collections import OrderedDict, namedtuple
 from tqdm import tqdm
 from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
@@ -24,6 +27,8 @@ from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianD
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.sampling_util import cat_conditioning, select_conditioning
+from ldm.modules.attention import CrossAttention
 
 
 __conditioning_keys__ = {'concat': 'c_concat',
@@ -41,6 +46,139 @@ def uniform_on_device(r1, r2, shape, device):
     return (r1 - r2) * torch.rand(*shape, device=device) + r2
 
 
+def tile_starts(size, tile_size, overlap):
+    """start offsets of tiles of tile_size covering size, neighbouring tiles overlap by at least overlap"""
+    if size <= tile_size:
+        return [0]
+    return list(range(0, size - tile_size, tile_size - overlap)) + [size - tile_size]
+
+
+def blend_ramp(n, ramp_start, ramp_end, device):
+    """weights of a tile of length n that ramp up linearly over its first ramp_start and down over its last
+    ramp_end entries, which blends the seams between overlapping tiles"""
+    w = torch.ones(n, device=device)
+    if ramp_start > 0:
+        w[:ramp_start] *= torch.linspace(0., 1., ramp_start + 2, device=device)[1:-1]
+    if ramp_end > 0:
+        w[n - ramp_end:] *= torch.linspace(1., 0., ramp_end + 2, device=device)[1:-1]
+    return w
+
+
+def tiled_apply(fn, x, tile_size, overlap, sequential=False):
+    """
+    Apply fn to overlapping tiles of x and blend the results. fn maps a (b, c, h, w) tensor to a (b, c', h * s, w * s)
+    tensor for some scale s, e.g. s = 8 for decoding and s = 1/8 for encoding, or to a DiagonalGaussianDistribution
+    whose parameters have that shape. Overlapping outputs are blended with linear ramps.
+
+    Since normalization and attention layers only see one tile, the result differs slightly from fn(x).
+
+    :param tile_size: tile size in units of x.
+    :param overlap: minimum overlap of neighbouring tiles in units of x.
+    :param sequential: run fn on one tile at a time, which bounds peak memory by the tile size. otherwise all tiles
+                       are run as one batch.
+    """
+    h, w = x.shape[-2:]
+    th, tw = min(tile_size, h), min(tile_size, w)
+    ys, xs = tile_starts(h, th, overlap), tile_starts(w, tw, overlap)
+    if len(ys) == 1 and len(xs) == 1:
+        return fn(x)
+    tiles = [(y, x_) for y in ys for x_ in xs]
+
+    is_posterior = False
+    def run(inputs):
+        nonlocal is_posterior
+        out = fn(inputs)
+        if isinstance(out, DiagonalGaussianDistribution):
+            is_posterior = True
+            return out.parameters
+        return out
+
+    if sequential:
+        outputs = (run(x[..., y:y + th, x_:x_ + tw]) for y, x_ in tiles)
+    else:
+        outputs = run(torch.cat([x[..., y:y + th, x_:x_ + tw] for y, x_ in tiles])).chunk(len(tiles))
+
+    out, weights = None, None
+    for (y, x_), tile in zip(tiles, outputs):
+        if out is None:
+            sy, sx = tile.shape[-2] / th, tile.shape[-1] / tw
+            out = tile.new_zeros((*tile.shape[:-2], round(h * sy), round(w * sx)))
+            weights = tile.new_zeros((round(h * sy), round(w * sx)))
+            # blending weights along each axis, by tile start
+            ramps_y = {y0: blend_ramp(tile.shape[-2],
+                                      round((ys[i - 1] + th - y0) * sy) if i > 0 else 0,
+                                      round((y0 + th - ys[i + 1]) * sy) if i < len(ys) - 1 else 0, x.device)
+                       for i, y0 in enumerate(ys)}
+            ramps_x = {x0: blend_ramp(tile.shape[-1],
+                                      round((xs[i - 1] + tw - x0) * sx) if i > 0 else 0,
+                                      round((x0 + tw - xs[i + 1]) * sx) if i < len(xs) - 1 else 0, x.device)
+                       for i, x0 in enumerate(xs)}
+        oy, ox = round(y * sy), round(x_ * sx)
+        weight = (ramps_y[y][:, None] * ramps_x[x_][None, :]).to(tile.dtype)
+        out[..., oy:oy + tile.shape[-2], ox:ox + tile.shape[-1]] += tile * weight
+        weights[oy:oy + tile.shape[-2], ox:ox + tile.shape[-1]] += weight
+    out = out / weights
+    return DiagonalGaussianDistribution(out) if is_posterior else out
+
+
+ConditioningCacheInfo = namedtuple("ConditioningCacheInfo", ["hits", "misses", "entries", "nbytes"])
+
+
+class ConditioningCache(object):
+    """
+    LRU cache of per-prompt conditioning rows, bounded by the number of entries and by their total size in bytes.
+    Entries are tagged with a version of the encoder weights and dropped as soon as the weights change.
+    """
+    def __init__(self, max_entries=256, max_bytes=128 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.rows = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def check_version(self, version):
+        if version != self.version:
+            self.rows.clear()
+            self.nbytes = 0
+            self.version = version
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            self.misses += 1
+            return None
+        self.rows.move_to_end(key)
+        self.hits += 1
+        return row
+
+    def put(self, key, row):
+        size = row.numel() * row.element_size()
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        if key in self.rows:
+            self.nbytes -= self.rows[key].numel() * self.rows[key].element_size()
+        self.rows[key] = row
+        self.rows.move_to_end(key)
+        self.nbytes += size
+        while len(self.rows) > self.max_entries or self.nbytes > self.max_bytes:
+            _, old = self.rows.popitem(last=False)
+            self.nbytes -= old.numel() * old.element_size()
+
+    def clear(self):
+        self.rows.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return ConditioningCacheInfo(self.hits, self.misses, len(self.rows), self.nbytes)
+
+
 class DDPM(pl.LightningModule):
     # classic DDPM with Gaussian diffusion, in image space
     def __init__(self,
@@ -84,6 +222,8 @@ class DDPM(pl.LightningModule):
         self.channels = channels
         self.use_positional_encodings = use_positional_encodings
         self.model = DiffusionWrapper(unet_config, conditioning_key)
+        # bumped whenever the weights change, see invalidate_weight_caches
+        self.weights_version = 0
         count_params(self.model, verbose=True)
         self.use_ema = use_ema
         if self.use_ema:
@@ -105,6 +245,8 @@ class DDPM(pl.LightningModule):
 
         self.register_schedule(given_betas=given_betas, beta_schedule=beta_schedule, timesteps=timesteps,
                                linear_start=linear_start, linear_end=linear_end, cosine_s=cosine_s)
+        if hasattr(self.model.diffusion_model, "timestep_table_size"):
+            self.model.diffusion_model.timestep_table_size = self.num_timesteps
 
         self.loss_type = loss_type
 
@@ -173,6 +315,7 @@ class DDPM(pl.LightningModule):
         if self.use_ema:
             self.model_ema.store(self.model.parameters())
             self.model_ema.copy_to(self.model)
+            self.invalidate_weight_caches()
             if context is not None:
                 print(f"{context}: Switched to EMA weights")
         try:
@@ -180,9 +323,25 @@ class DDPM(pl.LightningModule):
         finally:
             if self.use_ema:
                 self.model_ema.restore(self.model.parameters())
+                self.invalidate_weight_caches()
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
+    def invalidate_weight_caches(self):
+        """
+        drop everything precomputed from the weights of the model, after they were changed through .data or in
+        place outside of load_state_dict and ema_scope
+        """
+        self.weights_version += 1
+        for m in self.model.modules():
+            if hasattr(m, "invalidate_timestep_table"):
+                m.invalidate_timestep_table()
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        result = super().load_state_dict(state_dict, *args, **kwargs)
+        self.invalidate_weight_caches()
+        return result
+
     def init_from_ckpt(self, path, ignore_keys=list(), only_model=False):
         sd = torch.load(path, map_location="cpu")
         if "state_dict" in list(sd.keys()):
@@ -434,6 +593,9 @@ class LatentDiffusion(DDPM):
                  conditioning_key=None,
                  scale_factor=1.0,
                  scale_by_std=False,
+                 cond_cache_max_entries=256,
+                 cond_cache_max_bytes=128 * 2**20,
+                 first_stage_tiling=None,
                  *args, **kwargs):
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
@@ -460,6 +622,18 @@ class LatentDiffusion(DDPM):
         self.instantiate_first_stage(first_stage_config)
         self.instantiate_cond_stage(cond_stage_config)
         self.cond_stage_forward = cond_stage_forward
+        # fold, unfold, normalization and weighting of the split_input_params patching, least recently used last,
+        # see get_fold_unfold
+        self.fold_unfold_cache = OrderedDict()
+        self.fold_unfold_cache_size = 8
+        # only frozen conditioning encoders are cached, see get_learned_conditioning
+        self.cond_cache = ConditioningCache(cond_cache_max_entries, cond_cache_max_bytes)
+        # whether the cond stage model encodes every prompt into its own row, found out on the first cached call
+        self.cond_per_prompt = None
+        # dict(tile_size=..., overlap=..., sequential=...) to tile encode_first_stage and decode_first_stage
+        self.first_stage_tiling = None
+        if first_stage_tiling is not None:
+            self.enable_first_stage_tiling(**first_stage_tiling)
         self.clip_denoised = False
         self.bbox_tokenizer = None  
 
@@ -549,6 +723,61 @@ class LatentDiffusion(DDPM):
         return self.scale_factor * z
 
     def get_learned_conditioning(self, c):
+        if self.use_cond_cache(c):
+            return self.get_cached_conditioning(c)
+        return self.encode_conditioning(c)
+
+    def use_cond_cache(self, c):
+        return not self.cond_stage_trainable and self.cond_stage_model is not None and \
+               self.cond_per_prompt is not False and \
+               isinstance(c, (list, tuple)) and len(c) > 0 and all(isinstance(p, str) for p in c)
+
+    def cond_stage_version(self):
+        # weight changes bump weights_version (see invalidate_weight_caches), moving the model swaps the storage
+        param = next(self.cond_stage_model.parameters(), None)
+        if param is None:
+            return self.weights_version
+        return self.weights_version, param.data_ptr(), param.dtype
+
+    def get_cached_conditioning(self, prompts):
+        """
+        Encodes a batch of prompts through the conditioning cache. Only prompts not seen before are run through the
+        cond stage model, in a single batch. Rows are cached per autocast state, so that the dtype of the result
+        does not depend on the state the prompt was first encoded in. The result never aliases the cache. If the
+        whole batch is one prompt (e.g. the empty prompt of the unconditional conditioning), a copy of its row is
+        broadcast to the batch size with expand. In place ops on that view fail, and its consumers (cat_conditioning
+        and the key / value projections of the cross-attention) do not need it contiguous.
+        """
+        cache = self.cond_cache
+        cache.check_version(self.cond_stage_version())
+        autocast = torch.is_autocast_enabled()
+        unique = list(dict.fromkeys(prompts))
+        if self.cond_per_prompt is None:
+            # the first call encodes the whole batch once and finds out whether the result can be cached by prompt
+            c = self.encode_conditioning(list(prompts))
+            self.cond_per_prompt = isinstance(c, torch.Tensor) and c.shape[0] == len(prompts)
+            if self.cond_per_prompt:
+                cache.misses += len(unique)
+                for p, row in zip(prompts, c.detach()):
+                    if cache.rows.get((p, autocast)) is None:
+                        # clone so that a cached row does not keep the whole batch alive
+                        cache.put((p, autocast), row.clone())
+            return c
+        # look up every prompt once, repeated prompts count as one hit or miss
+        rows = {p: cache.get((p, autocast)) for p in unique}
+        missing = [p for p, row in rows.items() if row is None]
+        if len(missing) > 0:
+            c = self.encode_conditioning(missing)
+            for p, row in zip(missing, c.detach()):
+                row = row.clone()
+                cache.put((p, autocast), row)
+                rows[p] = row
+        if len(rows) == 1:
+            row = rows[prompts[0]].clone()
+            return row.unsqueeze(0).expand(len(prompts), *row.shape)
+        return torch.stack([rows[p] for p in prompts])
+
+    def encode_conditioning(self, c):
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
                 c = self.cond_stage_model.encode(c)
@@ -598,11 +827,25 @@ class LatentDiffusion(DDPM):
             weighting = weighting * L_weighting
         return weighting
 
-    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):  # todo load once not every time, shorten code
+    def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         """
         :param x: img of size (bs, c, h, w)
         :return: n img crops of size (n, bs, c, kernel_size[0], kernel_size[1])
         """
+        weighting_params = tuple(self.split_input_params.get(k) for k in
+                                 ["clip_min_weight", "clip_max_weight", "tie_braker", "clip_min_tie_weight",
+                                  "clip_max_tie_weight"])
+        # the normalization and weighting broadcast over batch and channels, only the spatial size matters
+        key = (tuple(x.shape[2:]), tuple(kernel_size), tuple(stride), uf, df, x.device, x.dtype, weighting_params)
+        if key in self.fold_unfold_cache:
+            self.fold_unfold_cache.move_to_end(key)
+        else:
+            self.fold_unfold_cache[key] = self.make_fold_unfold(x, kernel_size, stride, uf=uf, df=df)
+            while len(self.fold_unfold_cache) > self.fold_unfold_cache_size:
+                self.fold_unfold_cache.popitem(last=False)
+        return self.fold_unfold_cache[key]
+
+    def make_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):
         bs, nc, h, w = x.shape
 
         # number of crops in image
@@ -702,6 +945,40 @@ class LatentDiffusion(DDPM):
             out.append(xc)
         return out
 
+    def enable_first_stage_tiling(self, tile_size=64, overlap=16, sequential=False):
+        """
+        Encode and decode with the first stage model in overlapping tiles, see tiled_apply. This bounds the memory of
+        the autoencoder at high resolutions, in particular of the attention over all pixels in its middle block.
+        :param tile_size: tile size in latent pixels (times the downsampling factor for encoding).
+        :param overlap: minimum overlap of neighbouring tiles in latent pixels.
+        :param sequential: decode one tile at a time instead of all tiles in one batch.
+        """
+        assert 0 <= overlap < tile_size, "the overlap has to be smaller than the tile size"
+        self.first_stage_tiling = dict(tile_size=tile_size, overlap=overlap, sequential=sequential)
+
+    def disable_first_stage_tiling(self):
+        self.first_stage_tiling = None
+
+    def compile_denoiser(self, buckets, cache_dir=None, backend="trace"):
+        """
+        Run the UNet compiled for the given input shapes, see CompiledDenoiser. Every sampler goes through
+        apply_model and picks up the compiled model, calls with other shapes or with gradients run the eager model.
+        The compiled graphs see the weights of the model, but not changes of its structure or attention backends
+        after this call.
+        :param buckets: (batch, H, W, context length) shapes, batch including the doubling of classifier-free
+                        guidance, H and W in latent pixels. e.g. [(2, 64, 64, 77)] for one guided 512 px sample.
+        :param cache_dir: directory to keep the compiled artifacts in across runs.
+        :param backend: "trace" or "compile".
+        """
+        if self.model.conditioning_key != 'crossattn':
+            raise NotImplementedError(f"compile_denoiser supports cross-attention conditioning only, "
+                                      f"not {self.model.conditioning_key}")
+        self.model.compiled = CompiledDenoiser(self.model.diffusion_model, buckets, cache_dir=cache_dir,
+                                               backend=backend)
+
+    def disable_compiled_denoiser(self):
+        self.model.compiled = None
+
     @torch.no_grad()
     def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
         if predict_cids:
@@ -712,6 +989,13 @@ class LatentDiffusion(DDPM):
 
         z = 1. / self.scale_factor * z
 
+        if self.first_stage_tiling is not None:
+            if isinstance(self.first_stage_model, VQModelInterface):
+                decode = partial(self.first_stage_model.decode, force_not_quantize=predict_cids or force_not_quantize)
+            else:
+                decode = self.first_stage_model.decode
+            return tiled_apply(decode, z, **self.first_stage_tiling)
+
         if hasattr(self, "split_input_params"):
             if self.split_input_params["patch_distributed_vq"]:
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
@@ -824,6 +1108,11 @@ class LatentDiffusion(DDPM):
 
     @torch.no_grad()
     def encode_first_stage(self, x):
+        if self.first_stage_tiling is not None:
+            f = 2 ** self.num_downs
+            return tiled_apply(self.first_stage_model.encode, x, self.first_stage_tiling["tile_size"] * f,
+                               self.first_stage_tiling["overlap"] * f, self.first_stage_tiling["sequential"])
+
         if hasattr(self, "split_input_params"):
             if self.split_input_params["patch_distributed_vq"]:
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
@@ -912,7 +1201,9 @@ class LatentDiffusion(DDPM):
             z = unfold(x_noisy)  # (bn, nc * prod(**ks), L)
             # Reshape to img shape
             z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-            z_list = [z[:, :, :, :, i] for i in range(z.shape[-1])]
+            # fold the crops into the batch dimension, crop-major
+            bn, L = z.shape[0], z.shape[-1]
+            z = rearrange(z, 'b c h w l -> (l b) c h w')
 
             if self.cond_stage_key in ["image", "LR_image", "segmentation",
                                        'bbox_img'] and self.model.conditioning_key:  # todo check for completeness
@@ -924,7 +1215,7 @@ class LatentDiffusion(DDPM):
                 c = unfold(c)
                 c = c.view((c.shape[0], -1, ks[0], ks[1], c.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
 
-                cond_list = [{c_key: [c[:, :, :, :, i]]} for i in range(c.shape[-1])]
+                cond = {c_key: [rearrange(c, 'b c h w l -> (l b) c h w')]}
 
             elif self.cond_stage_key == 'coordinates_bbox':
                 assert 'original_image_size' in self.split_input_params, 'BoudingBoxRescaling is missing original_image_size'
@@ -941,7 +1232,7 @@ class LatentDiffusion(DDPM):
                 # need to rescale the tl patch coordinates to be in between (0,1)
                 tl_patch_coordinates = [(rescale_latent * stride[0] * (patch_nr % n_patches_per_row) / full_img_w,
                                          rescale_latent * stride[1] * (patch_nr // n_patches_per_row) / full_img_h)
-                                        for patch_nr in range(z.shape[-1])]
+                                        for patch_nr in range(L)]
 
                 # patch_limits are tl_coord, width and height coordinates as (x_tl, y_tl, h, w)
                 patch_limits = [(x_tl, y_tl,
@@ -963,23 +1254,27 @@ class LatentDiffusion(DDPM):
                 print(adapted_cond.shape)
                 adapted_cond = self.get_learned_conditioning(adapted_cond)
                 print(adapted_cond.shape)
-                adapted_cond = rearrange(adapted_cond, '(l b) n d -> l b n d', l=z.shape[-1])
-                print(adapted_cond.shape)
 
-                cond_list = [{'c_crossattn': [e]} for e in adapted_cond]
+                # already crop-major, (l b) n d
+                cond = {'c_crossattn': [adapted_cond]}
 
             else:
-                cond_list = [cond for i in range(z.shape[-1])]  # Todo make this more efficient
-
-            # apply model by loop over crops
-            output_list = [self.model(z_list[i], t, **cond_list[i]) for i in range(z.shape[-1])]
+                cond = cat_conditioning(*[cond] * L)
+
+            # apply model to micro batches of crops, all crops in one batch by default
+            micro_batch = self.split_input_params.get("micro_batch") or L
+            t = t.repeat(L)
+            output_list = []
+            for i in range(0, L, micro_batch):
+                crops = slice(i * bn, min(i + micro_batch, L) * bn)
+                output_list.append(self.model(z[crops], t[crops], **select_conditioning(cond, crops)))
             assert not isinstance(output_list[0],
                                   tuple)  # todo cant deal with multiple model outputs check this never happens
 
-            o = torch.stack(output_list, axis=-1)
+            o = rearrange(torch.cat(output_list), '(l b) c h w -> b c h w l', l=L)
             o = o * weighting
             # Reverse reshape to img shape
-            o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
+            o = o.reshape((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
             # stitch crops together
             x_recon = fold(o) / normalization
 
@@ -1392,25 +1687,148 @@ class LatentDiffusion(DDPM):
         return x
 
 
+class CompiledDenoiser(object):
+    """
+    Compiled versions of a cross-attention UNetModel for fixed (batch, H, W, context length) buckets, which skip the
+    per call python overhead of the module tree. Inputs of any other shape return None, and the caller falls back to
+    the eager model.
+
+    :param unet: the UNetModel.
+    :param buckets: (batch, H, W, context length) shapes to compile, H and W in latent pixels.
+    :param cache_dir: directory for compiled artifacts that are reused across runs, None to keep them in memory only.
+    :param backend: "trace" traces every bucket with torch.jit.trace on its first call. the traces are saved without
+                    weights and bound to the parameters of unet when loaded, so they follow in place weight updates
+                    such as ema_scope. "compile" uses torch.compile with a static graph per bucket, with the inductor
+                    cache in cache_dir.
+    """
+    def __init__(self, unet, buckets, cache_dir=None, backend="trace"):
+        assert backend in ["trace", "compile"], f"unknown backend {backend}"
+        if backend == "compile" and not hasattr(torch, "compile"):
+            raise RuntimeError(f"torch.compile is not available in torch {torch.__version__}")
+        self.unet = unet
+        self.buckets = set(tuple(b) for b in buckets)
+        self.cache_dir = cache_dir
+        self.backend = backend
+        self.compiled = dict()
+        self.failed = set()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        if backend == "compile":
+            if cache_dir is not None:
+                os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+            import torch._dynamo
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(self.buckets))
+            self.compiled_unet = torch.compile(unet, dynamic=False)
+
+    def architecture_key(self):
+        """everything the traced graph depends on, except for the values of the weights"""
+        h = hashlib.sha256()
+        h.update(f"{torch.__version__}:{self.unet.memory_format}:".encode("utf-8"))
+        h.update(str(self.unet).encode("utf-8"))
+        for name, tensor in list(self.unet.named_parameters()) + list(self.unet.named_buffers()):
+            h.update(f"{name}:{tuple(tensor.shape)}:{tensor.stride()}:{tensor.dtype}:{tensor.device};".encode("utf-8"))
+        for m in self.unet.modules():
+            if hasattr(m, "attention_backend"):
+                h.update(f"{m.attention_backend};".encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def __call__(self, x, t, context):
+        if torch.is_grad_enabled() or context is None:
+            return None
+        bucket = (x.shape[0], x.shape[2], x.shape[3], context.shape[1])
+        if bucket not in self.buckets or t.shape != (x.shape[0],) or context.shape[0] != x.shape[0]:
+            return None
+        if self.backend == "compile":
+            return self.compiled_unet(x, t, context=context)
+        key = (bucket, x.dtype, context.dtype, torch.is_autocast_enabled())
+        if key in self.failed:
+            return None
+        if key not in self.compiled:
+            try:
+                self.compiled[key] = self.load_or_trace(key, x, t, context)
+            except Exception as e:
+                print(f"Tracing the denoiser for {key} failed, falling back to eager: {e}")
+                self.failed.add(key)
+                return None
+        return self.compiled[key](x, t, context)
+
+    def trace_path(self, key):
+        (b, h, w, n), dtype, context_dtype, autocast = key
+        name = f"unet-{self.architecture_key()}-{b}x{h}x{w}x{n}-{str(dtype)[6:]}-{str(context_dtype)[6:]}"
+        return os.path.join(self.cache_dir, f"{name}{'-autocast' if autocast else ''}.pt")
+
+    def load_or_trace(self, key, x, t, context):
+        path = self.trace_path(key) if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            print(f"Loading traced denoiser from {path}")
+            traced = torch.jit.load(path, map_location=x.device)
+            self.bind_weights(traced, dict(self.unet.named_parameters()), dict(self.unet.named_buffers()))
+            return traced
+
+        print(f"Tracing the denoiser for batch {key[0][0]}, {key[0][1]}x{key[0][2]}, context length {key[0][3]}")
+        layers = [m for m in self.unet.modules() if isinstance(m, CrossAttention)]
+        kv_caches = [m.kv_cache for m in layers]
+        try:
+            # keys and values cached across calls would end up in the trace as constants
+            for m in layers:
+                m.kv_cache = None
+            traced = torch.jit.trace(self.unet, (x, t, context), check_trace=False)
+        finally:
+            for m, kv_cache in zip(layers, kv_caches):
+                m.kv_cache = kv_cache
+        if path is not None:
+            # the weights are in the checkpoint already, the saved trace only holds the graph
+            params, buffers = dict(traced.named_parameters()), dict(traced.named_buffers())
+            empty = {name: torch.empty(0, dtype=v.dtype, device=v.device) for name, v in
+                     list(params.items()) + list(buffers.items())}
+            self.bind_weights(traced, {k: nn.Parameter(v, requires_grad=False) for k, v in empty.items()
+                                       if k in params}, {k: v for k, v in empty.items() if k in buffers})
+            try:
+                torch.jit.save(traced, path + ".tmp")
+                os.replace(path + ".tmp", path)
+            finally:
+                self.bind_weights(traced, params, buffers)
+        return traced
+
+    @staticmethod
+    def bind_weights(traced, params, buffers):
+        """point the parameters and buffers of a traced module to the given tensors, by name"""
+        for name, value in list(params.items()) + list(buffers.items()):
+            *path, leaf = name.split(".")
+            module = traced
+            for p in path:
+                module = getattr(module, p)
+            setattr(module, leaf, value)
+
+
 class DiffusionWrapper(pl.LightningModule):
     def __init__(self, diff_model_config, conditioning_key):
         super().__init__()
         self.diffusion_model = instantiate_from_config(diff_model_config)
         self.conditioning_key = conditioning_key
         assert self.conditioning_key in [None, 'concat', 'crossattn', 'hybrid', 'adm']
+        # see LatentDiffusion.compile_denoiser
+        self.compiled = None
 
     def forward(self, x, t, c_concat: list = None, c_crossattn: list = None):
+        if self.conditioning_key == 'crossattn' and self.compiled is not None:
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
+            out = self.compiled(x, t, cc)
+            if out is not None:
+                return out
+
         if self.conditioning_key is None:
             out = self.diffusion_model(x, t)
         elif self.conditioning_key == 'concat':
             xc = torch.cat([x] + c_concat, dim=1)
             out = self.diffusion_model(xc, t)
         elif self.conditioning_key == 'crossattn':
-            cc = torch.cat(c_crossattn, 1)
+            # a single context is passed as is, which keeps its identity for the cross-attention kv cache
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(x, t, context=cc)
         elif self.conditioning_key == 'hybrid':
             xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
+            cc = c_crossattn[0] if len(c_crossattn) == 1 else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(xc, t, context=cc)
         elif self.conditioning_key == 'adm':
             cc = c_crossattn[0]
@@ -925,6 +925,9 @@ class DPM_Solver:
                 The type slightly impacts the performance. We recommend to use 'dpm_solver' type.
         Returns:
             x_0: A pytorch tensor. The approximated solution at time `t_0`.
+            The step size is controlled per sample: a step is accepted or rejected for every sample on its own, and
+            samples that reached `t_0` keep their value while the others continue. The number of function
+            evaluations spent on every sample is stored in `self.nfe`, a `long` tensor of shape (batch,).
 
         [1] A. Jolicoeur-Martineau, K. Li, R. Piché-Taillefer, T. Kachman, and I. Mitliagkas, "Gotta go fast when generating data with score-based models," arXiv preprint arXiv:2105.14080, 2021.
         """
@@ -934,7 +937,7 @@ class DPM_Solver:
         lambda_0 = ns.marginal_lambda(t_0 * torch.ones_like(s).to(x))
         h = h_init * torch.ones_like(s).to(x)
         x_prev = x
-        nfe = 0
+        nfe = torch.zeros((x.shape[0],), dtype=torch.long, device=x.device)
         if order == 2:
             r1 = 0.5
             lower_update = lambda x, s, t: self.dpm_solver_first_update(x, s, t, return_intermediate=True)
@@ -945,26 +948,41 @@ class DPM_Solver:
             higher_update = lambda x, s, t, **kwargs: self.singlestep_dpm_solver_third_update(x, s, t, r1=r1, r2=r2, solver_type=solver_type, **kwargs)
         else:
             raise ValueError("For adaptive step size solver, order must be 2 or 3, got {}".format(order))
-        while torch.abs((s - t_0)).mean() > t_err:
+        active = torch.abs(s - t_0) > t_err
+        while active.any():
             t = ns.inverse_lambda(lambda_s + h)
             x_lower, lower_noise_kwargs = lower_update(x, s, t)
             x_higher = higher_update(x, s, t, **lower_noise_kwargs)
             delta = torch.max(torch.ones_like(x).to(x) * atol, rtol * torch.max(torch.abs(x_lower), torch.abs(x_prev)))
-            norm_fn = lambda v: torch.sqrt(torch.square(v.reshape((v.shape[0], -1))).mean(dim=-1, keepdim=True))
-            E = norm_fn((x_higher - x_lower) / delta).max()
-            if torch.all(E <= 1.):
-                x = x_higher
-                s = t
-                x_prev = x_lower
-                lambda_s = ns.marginal_lambda(s)
-            h = torch.min(theta * h * torch.float_power(E, -1. / order).float(), lambda_0 - lambda_s)
-            nfe += order
-        print('adaptive solver nfe', nfe)
+            norm_fn = lambda v: torch.sqrt(torch.square(v.reshape((v.shape[0], -1))).mean(dim=-1))
+            E = norm_fn((x_higher - x_lower) / delta)
+            accept = active & (E <= 1.)
+            accept_x = expand_dims(accept, x.dim())
+            x = torch.where(accept_x, x_higher, x)
+            x_prev = torch.where(accept_x, x_lower, x_prev)
+            s = torch.where(accept, t, s)
+            lambda_s = ns.marginal_lambda(s)
+            nfe += order * active
+            active = torch.abs(s - t_0) > t_err
+            # finished samples take zero steps, the clamp avoids 0 * inf for them
+            h = torch.min(theta * h * torch.float_power(E.clamp(min=1e-8), -1. / order).float(), lambda_0 - lambda_s)
+            h = torch.where(active, h, torch.zeros_like(h))
+        self.nfe = nfe
         return x
 
+    def model_to_data_prediction(self, x, t, model_out):
+        """
+        Return the data prediction (x_0 estimate) for an output of `self.model_fn`.
+        """
+        if self.predict_x0:
+            return model_out
+        ns = self.noise_schedule
+        alpha_t, sigma_t = ns.marginal_alpha(t), ns.marginal_std(t)
+        return (x - expand_dims(sigma_t, x.dim()) * model_out) / expand_dims(alpha_t, x.dim())
+
     def sample(self, x, steps=20, t_start=None, t_end=None, order=3, skip_type='time_uniform',
         method='singlestep', lower_order_final=True, denoise_to_zero=False, solver_type='dpm_solver',
-        atol=0.0078, rtol=0.05,
+        atol=0.0078, rtol=0.05, convergence_monitor=None,
     ):
         """
         Compute the sample at time `t_end` by DPM-Solver, given the initial `x` at time `t_start`.
@@ -1064,6 +1082,10 @@ class DPM_Solver:
             solver_type: A `str`. The taylor expansion type for the solver. `dpm_solver` or `taylor`. We recommend `dpm_solver`.
             atol: A `float`. The absolute tolerance of the adaptive step size solver. Valid when `method` == 'adaptive'.
             rtol: A `float`. The relative tolerance of the adaptive step size solver. Valid when `method` == 'adaptive'.
+            convergence_monitor: A `ConvergenceMonitor` (ldm.models.diffusion.sampling_util) or None. Valid when `method` == 'multistep'.
+                After every model evaluation, samples whose data prediction stopped changing are finished with that
+                prediction and dropped from the batch; the remaining samples continue with a smaller batch. The monitor
+                records the number of steps after which every sample stopped.
         Returns:
             x_end: A pytorch tensor. The approximated solution at time `t_end`.
 
@@ -1071,6 +1093,8 @@ class DPM_Solver:
         t_0 = 1. / self.noise_schedule.total_N if t_end is None else t_end
         t_T = self.noise_schedule.T if t_start is None else t_start
         device = x.device
+        if convergence_monitor is not None and method != 'multistep':
+            raise ValueError("early exit (convergence_monitor) is only supported by the 'multistep' method, got {}".format(method))
         if method == 'adaptive':
             with torch.no_grad():
                 x = self.dpm_solver_adaptive(x, order=order, t_T=t_T, t_0=t_0, atol=atol, rtol=rtol, solver_type=solver_type)
@@ -1103,6 +1127,14 @@ class DPM_Solver:
                     # We do not need to evaluate the final model value.
                     if step < steps:
                         model_prev_list[-1] = self.model_fn(x, vec_t)
+                        if convergence_monitor is not None:
+                            keep = convergence_monitor.update(self.model_to_data_prediction(x, vec_t, model_prev_list[-1]), step)
+                            if keep is not None:
+                                x = x[keep]
+                                model_prev_list = [model_prev[keep] for model_prev in model_prev_list]
+                                t_prev_list = [t_prev[keep] for t_prev in t_prev_list]
+                                if x.shape[0] == 0:
+                                    break
         elif method in ['singlestep', 'singlestep_fixed']:
             if method == 'singlestep':
                 timesteps_outer, orders = self.get_orders_and_timesteps_for_singlestep_solver(steps=steps, order=order, skip_type=skip_type, t_T=t_T, t_0=t_0, device=device)
@@ -1119,8 +1151,10 @@ class DPM_Solver:
                 r1 = None if order <= 1 else (lambda_inner[1] - lambda_inner[0]) / h
                 r2 = None if order <= 2 else (lambda_inner[2] - lambda_inner[0]) / h
                 x = self.singlestep_dpm_solver_update(x, vec_s, vec_t, order, solver_type=solver_type, r1=r1, r2=r2)
-        if denoise_to_zero:
+        if denoise_to_zero and x.shape[0] > 0:
             x = self.denoise_to_zero_fn(x, torch.ones((x.shape[0],)).to(device) * t_0)
+        if convergence_monitor is not None:
+            x = convergence_monitor.merge(x)
         return x
 
 
@@ -3,6 +3,9 @@
 import torch
 
 from .dpm_solver import NoiseScheduleVP, model_wrapper, DPM_Solver
+from ldm.modules.attention import cross_attention_kv_cache
+from ldm.modules.diffusionmodules.util import make_generators, randn
+from ldm.models.diffusion.sampling_util import ClassifierFreeGuidance, ConvergenceMonitor
 
 
 class DPMSolverSampler(object):
@@ -14,8 +17,8 @@ class DPMSolverSampler(object):
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     @torch.no_grad()
@@ -41,8 +44,32 @@ class DPMSolverSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               guidance_policy="batched",
+               method="multistep",
+               order=2,
+               atol=0.0078,
+               rtol=0.05,
+               early_exit_threshold=None,
+               early_exit_patience=2,
+               generator=None,
                **kwargs
                ):
+        """
+        :param method: "multistep" takes S steps. "adaptive" ignores S and chooses the step size per sample, such
+                       that the local error estimate stays within atol/rtol. "singlestep" and "singlestep_fixed" are
+                       also passed through to DPM_Solver.sample.
+        :param order: order of the solver, 2 or 3 for "adaptive".
+        :param atol: absolute tolerance of the adaptive solver.
+        :param rtol: relative tolerance of the adaptive solver.
+        :param early_exit_threshold: "multistep" only. if given, a sample stops as soon as the relative change of its
+                                     x0 prediction stayed below this threshold for early_exit_patience evaluations.
+        :param generator: None, a torch.Generator, or one torch.Generator or seed per sample, for x_T if it is not
+                          given. the solver itself is deterministic.
+        :return: the samples and a dict with the number of function evaluations per sample under 'nfe'. every NFE
+                 is one model call on the whole batch (two with the "sequential" guidance policy), the
+                 adaptive solver keeps evaluating finished samples until the whole batch is done. with early exit,
+                 the steps after which the samples stopped are returned under 'stop_steps'.
+        """
         if conditioning is not None:
             if isinstance(conditioning, dict):
                 cbs = conditioning[list(conditioning.keys())[0]].shape[0]
@@ -60,23 +87,43 @@ class DPMSolverSampler(object):
 
         device = self.model.betas.device
         if x_T is None:
-            img = torch.randn(size, device=device)
+            img = randn(size, device, make_generators(generator, batch_size, device))
         else:
             img = x_T
 
         ns = NoiseScheduleVP('discrete', alphas_cumprod=self.alphas_cumprod)
 
+        # classifier-free guidance is applied by the shared guidance engine, so the wrapper sees an unguided model
+        guidance = ClassifierFreeGuidance(self.model.apply_model, conditioning, unconditional_conditioning,
+                                          unconditional_guidance_scale, policy=guidance_policy)
         model_fn = model_wrapper(
-            lambda x, t, c: self.model.apply_model(x, t, c),
+            lambda x, t: guidance(x, t),
             ns,
             model_type="noise",
-            guidance_type="classifier-free",
-            condition=conditioning,
-            unconditional_condition=unconditional_conditioning,
-            guidance_scale=unconditional_guidance_scale,
+            guidance_type="uncond",
         )
 
+        monitor = None
+        if early_exit_threshold is not None:
+            monitor = ConvergenceMonitor(size[0], early_exit_threshold, early_exit_patience, on_drop=guidance.select)
+
         dpm_solver = DPM_Solver(model_fn, ns, predict_x0=True, thresholding=False)
-        x = dpm_solver.sample(img, steps=S, skip_type="time_uniform", method="multistep", order=2, lower_order_final=True)
+        with cross_attention_kv_cache(self.model):
+            x = dpm_solver.sample(img, steps=S, skip_type="time_uniform", method=method, order=order,
+                                  lower_order_final=True, atol=atol, rtol=rtol, convergence_monitor=monitor)
+        info = dict()
+        if monitor is not None:
+            info['stop_steps'] = monitor.stop_steps
+            # the model is evaluated once more than the number of steps taken before a sample stops
+            nfe = [S if stop is None else stop + 1 for stop in monitor.stop_steps]
+        elif method == "adaptive":
+            nfe = dpm_solver.nfe.tolist()
+        elif method == "singlestep_fixed":
+            nfe = [S // order * order] * batch_size
+        else:
+            nfe = [S] * batch_size
+        if verbose:
+            print(f"DPM-Solver ({method}, order {order}) used {max(nfe)} function evaluations")
 
-        return x.to(device), None
+        info['nfe'] = nfe
+        return x.to(device), info
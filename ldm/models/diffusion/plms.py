@@ -5,7 +5,12 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from ldm.modules.attention import cross_attention_kv_cache
+from ldm.modules.diffusionmodules.openaimodel import timestep_schedule
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, make_generators, \
+    randn
+from ldm.models.diffusion.sampling_util import ClassifierFreeGuidance, ConvergenceMonitor, select_conditioning, \
+    select_generator
 
 
 class PLMSSampler(object):
@@ -17,8 +22,8 @@ class PLMSSampler(object):
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
@@ -77,8 +82,16 @@ class PLMSSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               guidance_policy="batched",
+               early_exit_threshold=None,
+               early_exit_patience=2,
+               generator=None,
                **kwargs
                ):
+        """
+        :param generator: None, a torch.Generator, or one torch.Generator or seed per sample, for x_T (if not given),
+                          see DDIMSampler.sample. PLMS draws no noise in its steps, eta is always 0.
+        """
         if conditioning is not None:
             if isinstance(conditioning, dict):
                 cbs = conditioning[list(conditioning.keys())[0]].shape[0]
@@ -94,21 +107,27 @@ class PLMSSampler(object):
         size = (batch_size, C, H, W)
         print(f'Data shape for PLMS sampling is {size}')
 
-        samples, intermediates = self.plms_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    )
+        with cross_attention_kv_cache(self.model), timestep_schedule(self.model, self.ddim_timesteps):
+            samples, intermediates = self.plms_sampling(conditioning, size,
+                                                        callback=callback,
+                                                        img_callback=img_callback,
+                                                        quantize_denoised=quantize_x0,
+                                                        mask=mask, x0=x0,
+                                                        ddim_use_original_steps=False,
+                                                        noise_dropout=noise_dropout,
+                                                        temperature=temperature,
+                                                        score_corrector=score_corrector,
+                                                        corrector_kwargs=corrector_kwargs,
+                                                        x_T=x_T,
+                                                        log_every_t=log_every_t,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        unconditional_conditioning=unconditional_conditioning,
+                                                        guidance_policy=guidance_policy,
+                                                        early_exit_threshold=early_exit_threshold,
+                                                        early_exit_patience=early_exit_patience,
+                                                        generator=make_generators(generator, batch_size,
+                                                                                  self.model.betas.device),
+                                                        )
         return samples, intermediates
 
     @torch.no_grad()
@@ -117,11 +136,18 @@ class PLMSSampler(object):
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_policy="batched",
+                      early_exit_threshold=None, early_exit_patience=2, generator=None):
+        """
+        :param early_exit_threshold: if given, a sample stops as soon as the relative change of its pred_x0 stayed
+                                     below this threshold for early_exit_patience steps, and its pred_x0 is
+                                     returned. the remaining samples continue with a smaller batch; the steps after
+                                     which the samples stopped are returned as intermediates['stop_steps'].
+        """
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = randn(shape, device, generator)
         else:
             img = x_T
 
@@ -138,6 +164,11 @@ class PLMSSampler(object):
 
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
+        guidance = ClassifierFreeGuidance(self.model.apply_model, cond, unconditional_conditioning,
+                                          unconditional_guidance_scale, policy=guidance_policy)
+        monitor = None
+        if early_exit_threshold is not None:
+            monitor = ConvergenceMonitor(b, early_exit_threshold, early_exit_patience, on_drop=guidance.select)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
@@ -155,7 +186,7 @@ class PLMSSampler(object):
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
                                       unconditional_conditioning=unconditional_conditioning,
-                                      old_eps=old_eps, t_next=ts_next)
+                                      old_eps=old_eps, t_next=ts_next, guidance=guidance, generator=generator)
             img, pred_x0, e_t = outs
             old_eps.append(e_t)
             if len(old_eps) >= 4:
@@ -163,27 +194,44 @@ class PLMSSampler(object):
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
 
+            if monitor is not None:
+                keep = monitor.update(pred_x0, i + 1)
+                if keep is not None:
+                    # drop the finished samples from the batch
+                    img, pred_x0 = img[keep], pred_x0[keep]
+                    old_eps = [e[keep] for e in old_eps]
+                    cond = select_conditioning(cond, keep)
+                    generator = select_generator(generator, keep)
+                    if mask is not None and mask.shape[0] == keep.shape[0]:
+                        mask = mask[keep]
+                    if x0 is not None and x0.shape[0] == keep.shape[0]:
+                        x0 = x0[keep]
+                    b = img.shape[0]
+
             if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['x_inter'].append(img)
-                intermediates['pred_x0'].append(pred_x0)
+                intermediates['x_inter'].append(img if monitor is None else monitor.merge(img))
+                intermediates['pred_x0'].append(pred_x0 if monitor is None else monitor.merge(pred_x0))
+
+            if monitor is not None and monitor.finished:
+                break
 
+        if monitor is not None:
+            img = monitor.merge(img)
+            intermediates['stop_steps'] = monitor.stop_steps
         return img, intermediates
 
     @torch.no_grad()
     def p_sample_plms(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None,
+                      guidance=None, generator=None):
         b, *_, device = *x.shape, x.device
+        if guidance is None:
+            guidance = ClassifierFreeGuidance(self.model.apply_model, c, unconditional_conditioning,
+                                              unconditional_guidance_scale)
 
         def get_model_output(x, t):
-            if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-                e_t = self.model.apply_model(x, t, c)
-            else:
-                x_in = torch.cat([x] * 2)
-                t_in = torch.cat([t] * 2)
-                c_in = torch.cat([unconditional_conditioning, c])
-                e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-                e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+            e_t = guidance(x, t)
 
             if score_corrector is not None:
                 assert self.model.parameterization == "eps"
@@ -209,10 +257,8 @@ class PLMSSampler(object):
                 pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
             # direction pointing to x_t
             dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-            if noise_dropout > 0.:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+            # eta is 0 for PLMS, so sigma_t is 0 and no noise is drawn
+            x_prev = a_prev.sqrt() * pred_x0 + dir_xt
             return x_prev, pred_x0
 
         e_t = get_model_output(x, t)
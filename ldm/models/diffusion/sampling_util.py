@@ -0,0 +1,236 @@
+"""SAMPLING ONLY."""
+
+import torch
+
+
+def cat_conditioning(*conds):
+    """
+    Concatenate conditionings along the batch dimension. Supports tensors as well as the list and dict (hybrid)
+    formats accepted by LatentDiffusion.apply_model.
+    """
+    c = conds[0]
+    if isinstance(c, dict):
+        return {k: cat_conditioning(*[c_[k] for c_ in conds]) for k in c}
+    if isinstance(c, (list, tuple)):
+        return [cat_conditioning(*cs) for cs in zip(*conds)]
+    return torch.cat(conds)
+
+
+def select_conditioning(c, keep):
+    """Select the samples `keep` (a boolean mask or an index tensor) of a conditioning in any of the above formats."""
+    if c is None:
+        return None
+    if isinstance(c, dict):
+        return {k: select_conditioning(v, keep) for k, v in c.items()}
+    if isinstance(c, (list, tuple)):
+        return [select_conditioning(c_, keep) for c_ in c]
+    return c[keep]
+
+
+def select_generator(generator, keep):
+    """Select the samples `keep` of a list of per-sample generators, a shared generator or None is left as is."""
+    if not isinstance(generator, (list, tuple)):
+        return generator
+    keep = torch.arange(len(generator))[keep.cpu()].tolist()
+    return [generator[i] for i in keep]
+
+
+class ClassifierFreeGuidance(object):
+    """
+    Computes the guided prediction eps(x, uc) + scale * (eps(x, c) - eps(x, uc)) for one sampling run.
+
+    Supported policies:
+        "batched": evaluate the unconditional and the conditional prediction in one forward pass over the doubled
+                   batch. The doubled inputs are allocated once per run and x, t are written into them in place on
+                   every step; the doubled conditioning is built only once.
+        "sequential": evaluate the unconditional and the conditional prediction in two forward passes of the
+                      original batch size, which lowers peak memory at the cost of throughput.
+
+    :param model_fn: callable (x, t, c) -> eps, e.g. LatentDiffusion.apply_model.
+    :param scale: a float, or a tensor broadcastable to eps for a per-sample guidance scale.
+    """
+    policies = ("batched", "sequential")
+
+    def __init__(self, model_fn, conditioning, unconditional_conditioning=None, scale=1., policy="batched"):
+        assert policy in self.policies, f"unknown guidance policy '{policy}', choose from {self.policies}"
+        self.model_fn = model_fn
+        self.c = conditioning
+        self.uc = unconditional_conditioning
+        self.scale = scale
+        self.policy = policy
+        self.x_in = None
+        self.t_in = None
+        self.c_in = None
+
+    @property
+    def guided(self):
+        return self.uc is not None and (torch.is_tensor(self.scale) or self.scale != 1.)
+
+    def __call__(self, x, t):
+        if not self.guided:
+            return self.model_fn(x, t, self.c)
+
+        if self.policy == "sequential":
+            e_t_uncond = self.model_fn(x, t, self.uc)
+            e_t = self.model_fn(x, t, self.c)
+        else:
+            x_in, t_in, c_in = self.doubled_inputs(x, t)
+            e_t_uncond, e_t = self.model_fn(x_in, t_in, c_in).chunk(2)
+        return e_t_uncond + self.scale * (e_t - e_t_uncond)
+
+    def select(self, keep):
+        """continue with the samples `keep` only"""
+        self.c = select_conditioning(self.c, keep)
+        self.uc = select_conditioning(self.uc, keep)
+        if torch.is_tensor(self.scale) and self.scale.dim() > 0 and self.scale.shape[0] > 1:
+            self.scale = self.scale[keep]
+        self.c_in = None
+
+    def doubled_inputs(self, x, t):
+        b = x.shape[0]
+        if self.x_in is None or self.x_in.shape[1:] != x.shape[1:] or self.x_in.shape[0] != 2 * b or \
+                self.x_in.dtype != x.dtype or self.x_in.device != x.device:
+            self.x_in = x.new_empty((2 * b, *x.shape[1:]))
+        if self.t_in is None or self.t_in.shape[0] != 2 * b or self.t_in.dtype != t.dtype or \
+                self.t_in.device != t.device:
+            self.t_in = t.new_empty((2 * b, *t.shape[1:]))
+        if self.c_in is None:
+            self.c_in = cat_conditioning(self.uc, self.c)
+
+        self.x_in[:b].copy_(x)
+        self.x_in[b:].copy_(x)
+        self.t_in[:b].copy_(t)
+        self.t_in[b:].copy_(t)
+        return self.x_in, self.t_in, self.c_in
+
+
+class PartialClassifierFreeGuidance(ClassifierFreeGuidance):
+    """
+    Classifier-free guidance for a batch in which only some samples are guided. The unconditional prediction is only
+    evaluated for the guided samples, the other samples get their conditional prediction. With the "batched" policy,
+    the unconditional inputs of the guided samples are prepended to the full batch, so that the whole batch still
+    takes a single forward pass.
+
+    :param unconditional_conditioning: conditioning of the guided samples only.
+    :param scale: guidance scale of the guided samples, a float or a tensor broadcastable to their eps.
+    :param guided_index: index tensor of the guided samples in the batch.
+    """
+    def __init__(self, model_fn, conditioning, unconditional_conditioning, scale, guided_index, policy="batched"):
+        super().__init__(model_fn, conditioning, unconditional_conditioning, scale, policy=policy)
+        self.guided_index = guided_index
+
+    @property
+    def guided(self):
+        return self.uc is not None and len(self.guided_index) > 0
+
+    def __call__(self, x, t):
+        if not self.guided:
+            return self.model_fn(x, t, self.c)
+
+        g = self.guided_index
+        if self.policy == "sequential":
+            e_t_uncond = self.model_fn(x[g], t[g], self.uc)
+            e_t = self.model_fn(x, t, self.c)
+        else:
+            x_in, t_in, c_in = self.doubled_inputs(x, t)
+            e_t_uncond, e_t = self.model_fn(x_in, t_in, c_in).split([len(g), x.shape[0]])
+        e_t[g] = e_t_uncond + self.scale * (e_t[g] - e_t_uncond)
+        return e_t
+
+    def select(self, keep):
+        raise NotImplementedError("dropping samples is not supported with partial guidance")
+
+    def doubled_inputs(self, x, t):
+        """x and t of the guided samples followed by those of the whole batch"""
+        g = self.guided_index
+        n = len(g) + x.shape[0]
+        if self.x_in is None or self.x_in.shape[1:] != x.shape[1:] or self.x_in.shape[0] != n or \
+                self.x_in.dtype != x.dtype or self.x_in.device != x.device:
+            self.x_in = x.new_empty((n, *x.shape[1:]))
+        if self.t_in is None or self.t_in.shape[0] != n or self.t_in.dtype != t.dtype or \
+                self.t_in.device != t.device:
+            self.t_in = t.new_empty((n, *t.shape[1:]))
+        if self.c_in is None:
+            self.c_in = cat_conditioning(self.uc, self.c)
+
+        torch.index_select(x, 0, g, out=self.x_in[:len(g)])
+        self.x_in[len(g):].copy_(x)
+        torch.index_select(t, 0, g, out=self.t_in[:len(g)])
+        self.t_in[len(g):].copy_(t)
+        return self.x_in, self.t_in, self.c_in
+
+
+class ConvergenceMonitor(object):
+    """
+    Early exit for sampling loops. Tracks the relative change ||pred_x0 - prev_pred_x0|| / ||prev_pred_x0|| of every
+    sample between steps; a sample whose change stays below `threshold` for `patience` consecutive steps is done, and
+    its current pred_x0 is taken as the final sample. The sampling loop drops finished samples from its batch and
+    calls merge() at the end to get the full batch back.
+
+    Checking for finished samples synchronizes with the device once per step.
+
+    :param batch_size: batch size at the start of sampling.
+    :param threshold: relative change of pred_x0 below which a sample counts as converged.
+    :param patience: number of consecutive steps below the threshold before a sample stops.
+    :param on_drop: called with the boolean mask of the samples that keep running whenever samples are dropped,
+                    e.g. ClassifierFreeGuidance.select.
+    """
+    def __init__(self, batch_size, threshold=1e-3, patience=2, on_drop=None):
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.patience = patience
+        self.on_drop = on_drop
+        self.active = None
+        self.prev = None
+        self.count = None
+        self.out = None
+        # number of steps after which every sample stopped, None for samples that ran the full schedule
+        self.stop_steps = [None] * batch_size
+
+    def update(self, pred_x0, step):
+        """
+        :param pred_x0: current prediction of x_0 for the samples that are still running.
+        :param step: the step count to report for samples that stop now.
+        :return: None if no sample stopped, else the boolean mask of the running samples that keep running.
+        """
+        if self.active is None:
+            self.active = torch.arange(self.batch_size, device=pred_x0.device)
+            self.count = torch.zeros(self.batch_size, dtype=torch.long, device=pred_x0.device)
+        if self.prev is None:
+            self.prev = pred_x0
+            return None
+
+        prev = self.prev.flatten(1).float()
+        change = (pred_x0.flatten(1).float() - prev).norm(dim=1) / prev.norm(dim=1).clamp(min=1e-8)
+        self.count = torch.where(change < self.threshold, self.count + 1, torch.zeros_like(self.count))
+        self.prev = pred_x0
+        done = self.count >= self.patience
+        if not done.any():
+            return None
+
+        if self.out is None:
+            self.out = pred_x0.new_empty((self.batch_size, *pred_x0.shape[1:]))
+        idx = self.active[done]
+        self.out[idx] = pred_x0[done]
+        for j in idx.tolist():
+            self.stop_steps[j] = step
+
+        keep = ~done
+        self.active = self.active[keep]
+        self.prev = self.prev[keep]
+        self.count = self.count[keep]
+        if self.on_drop is not None:
+            self.on_drop(keep)
+        return keep
+
+    @property
+    def finished(self):
+        return self.active is not None and self.active.shape[0] == 0
+
+    def merge(self, x):
+        """the full batch, with the final pred_x0 of finished samples and x for the running ones"""
+        if self.out is None:
+            return x
+        out = self.out.clone()
+        out[self.active] = x.to(out.dtype)
+        return out
@@ -1,5 +1,7 @@
 from inspect import isfunction
+from contextlib import contextmanager
 import math
+import os
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
@@ -149,14 +151,139 @@ class SpatialSelfAttention(nn.Module):
         return x+h_
 
 
+# queries per chunk of the chunked attention, and the number of queries from which on "auto" uses it
+ATTENTION_CHUNK_SIZE = 1024
+ATTENTION_CHUNK_THRESHOLD = 4096
+
+# attention kernels by name, see register_attention_backend
+ATTENTION_BACKENDS = dict()
+
+
+def register_attention_backend(name):
+    """
+    Register an attention kernel fn(q, k, v, scale, mask=None, upcast=False, **kwargs) -> out for q of shape
+    (b, n, d) and k, v of shape (b, m, d), returning (b, n, d). mask is None or a bool tensor broadcastable to
+    (b, 1, m), False for keys to ignore. With upcast, the softmax is computed in float32 and the scale is applied to
+    q and k separately, which is more stable in float16. Backends ignore kwargs they do not know.
+    """
+    def register(fn):
+        ATTENTION_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+def default_attention_backend(fallback="auto"):
+    """
+    the LDM_ATTENTION_BACKEND environment variable, or fallback. AttnBlock and QKVAttention fall back to "naive",
+    the "auto" threshold is tuned for the cross-attention of the unet and would chunk e.g. the 4096 tokens of the
+    mid-block attention of the autoencoder.
+    """
+    return os.environ.get("LDM_ATTENTION_BACKEND", fallback)
+
+
+def attention(q, k, v, scale, mask=None, backend=None, upcast=False, **kwargs):
+    """
+    Dispatch to an attention kernel. backend defaults to the LDM_ATTENTION_BACKEND environment variable, or "auto".
+    """
+    backend = default(backend, default_attention_backend())
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"unknown attention backend '{backend}', choose from {list(ATTENTION_BACKENDS.keys())}")
+    return ATTENTION_BACKENDS[backend](q, k, v, scale, mask=mask, upcast=upcast, **kwargs)
+
+
+def set_attention_backend(model, backend):
+    """use backend (None for the default) in all attention modules of model"""
+    for module in model.modules():
+        if hasattr(module, "attention_backend"):
+            module.attention_backend = backend
+
+
+@register_attention_backend("naive")
+def naive_attention(q, k, v, scale, mask=None, upcast=False, **kwargs):
+    """softmax(q k^T * scale) v, materializing the full (b, n, m) similarity matrix"""
+    if upcast:
+        sqrt_scale = math.sqrt(scale)
+        sim = einsum('b i d, b j d -> b i j', q * sqrt_scale, k * sqrt_scale)
+    else:
+        sim = einsum('b i d, b j d -> b i j', q, k) * scale
+
+    if exists(mask):
+        max_neg_value = -torch.finfo(sim.dtype).max
+        sim.masked_fill_(~mask, max_neg_value)
+
+    # attention, what we cannot get enough of
+    if upcast:
+        attn = sim.float().softmax(dim=-1).type(sim.dtype)
+    else:
+        attn = sim.softmax(dim=-1)
+
+    return einsum('b i j, b j d -> b i d', attn, v)
+
+
+@register_attention_backend("chunked")
+def chunked_attention(q, k, v, scale, mask=None, upcast=False, chunk_size=ATTENTION_CHUNK_SIZE, **kwargs):
+    """
+    Same as naive_attention, but for chunk_size queries at a time, so that only a (b, chunk_size, m) slice of the
+    similarity matrix exists at any time instead of the full (b, n, m) one. Peak memory grows linearly with n.
+    """
+    out = None
+    for i in range(0, q.shape[1], chunk_size):
+        out_chunk = naive_attention(q[:, i:i + chunk_size], k, v, scale, mask=mask, upcast=upcast)
+        if out is None:
+            out = out_chunk.new_empty((q.shape[0], q.shape[1], out_chunk.shape[2]))
+        out[:, i:i + chunk_size] = out_chunk
+    return out
+
+
+@register_attention_backend("auto")
+def auto_attention(q, k, v, scale, mask=None, upcast=False, chunk_size=ATTENTION_CHUNK_SIZE,
+                   chunk_threshold=ATTENTION_CHUNK_THRESHOLD, **kwargs):
+    """naive attention for short sequences, chunked attention from chunk_threshold queries on"""
+    if q.shape[1] >= chunk_threshold:
+        return chunked_attention(q, k, v, scale, mask=mask, upcast=upcast, chunk_size=chunk_size)
+    return naive_attention(q, k, v, scale, mask=mask, upcast=upcast)
+
+
+if hasattr(F, "scaled_dot_product_attention"):
+    @register_attention_backend("sdpa")
+    def sdpa_attention(q, k, v, scale, mask=None, upcast=False, **kwargs):
+        """
+        torch.nn.functional.scaled_dot_product_attention (torch >= 2.0), which picks a fused kernel if possible. With
+        upcast, the attention runs in float32 and the result is cast back, as sdpa has no float32 softmax option.
+        """
+        dtype = q.dtype
+        if upcast:
+            q, k, v = q.float(), k.float(), v.float()
+        # sdpa scales by 1 / sqrt(d), the scale argument only exists from torch 2.1 on
+        q = q * (scale * math.sqrt(q.shape[-1]))
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask).type(dtype)
+
+
+# contexts per layer the cross-attention key/value cache holds, e.g. the conditional and unconditional one of the
+# sequential guidance policy
+KV_CACHE_MAX_ENTRIES = 4
+
+
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
+    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.,
+                 chunk_size=None, chunk_threshold=None, attention_backend=None):
+        """
+        :param chunk_size: queries per chunk of the chunked attention (default ATTENTION_CHUNK_SIZE).
+        :param chunk_threshold: number of queries from which on the "auto" backend uses the chunked attention
+                                (default ATTENTION_CHUNK_THRESHOLD).
+        :param attention_backend: name of the attention kernel, see ATTENTION_BACKENDS. None for the default.
+        """
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
 
         self.scale = dim_head ** -0.5
         self.heads = heads
+        self.chunk_size = default(chunk_size, ATTENTION_CHUNK_SIZE)
+        self.chunk_threshold = default(chunk_threshold, ATTENTION_CHUNK_THRESHOLD)
+        self.attention_backend = attention_backend
+        # keys and values per context tensor, only while inside cross_attention_kv_cache
+        self.kv_cache = None
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
@@ -167,39 +294,74 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
 
-    def forward(self, x, context=None, mask=None):
-        h = self.heads
-
-        q = self.to_q(x)
-        context = default(context, x)
+    def context_kv(self, context):
+        """keys and values of context in (b h) n d layout"""
         k = self.to_k(context)
         v = self.to_v(context)
+        return tuple(rearrange(t, 'b n (h d) -> (b h) n d', h=self.heads) for t in (k, v))
+
+    def cached_context_kv(self, context):
+        # the entry keeps the context alive, so its id cannot be reused while it is cached. in-place modifications
+        # bump the version counter and invalidate the entry
+        entry = self.kv_cache.get(id(context))
+        if entry is not None and entry[0] is context and entry[1] == context._version:
+            return entry[2], entry[3]
+        k, v = self.context_kv(context)
+        self.kv_cache[id(context)] = (context, context._version, k, v)
+        while len(self.kv_cache) > KV_CACHE_MAX_ENTRIES:
+            self.kv_cache.pop(next(iter(self.kv_cache)))
+        return k, v
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+    def forward(self, x, context=None, mask=None):
+        h = self.heads
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+        q = self.to_q(x)
+        q = rearrange(q, 'b n (h d) -> (b h) n d', h=h)
+        if context is not None and self.kv_cache is not None and not torch.is_grad_enabled():
+            k, v = self.cached_context_kv(context)
+        else:
+            k, v = self.context_kv(default(context, x))
 
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
-
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        out = attention(q, k, v, self.scale, mask=mask, backend=self.attention_backend,
+                        chunk_size=self.chunk_size, chunk_threshold=self.chunk_threshold)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
 
+@contextmanager
+def cross_attention_kv_cache(model):
+    """
+    Cache the keys and values that the cross-attention layers of model compute from their context, for as long as the
+    context manager is active. Meant for sampling loops, where the same conditioning tensor is passed on every step:
+    the projections to_k(context) and to_v(context) are computed on the first step only. Entries are keyed by the
+    identity of the context tensor, the cache is bypassed when gradients are enabled and released on exit.
+    """
+    layers = [m for m in model.modules() if isinstance(m, CrossAttention)]
+    previous = [m.kv_cache for m in layers]
+    for m in layers:
+        if m.kv_cache is None:
+            m.kv_cache = dict()
+    try:
+        yield
+    finally:
+        for m, kv_cache in zip(layers, previous):
+            m.kv_cache = kv_cache
+
+
 class BasicTransformerBlock(nn.Module):
-    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True):
+    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
+                 attention_backend=None):
         super().__init__()
-        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
+        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    attention_backend=attention_backend)  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         self.attn2 = CrossAttention(query_dim=dim, context_dim=context_dim,
-                                    heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
+                                    heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    attention_backend=attention_backend)  # is self-attn if context is none
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
@@ -224,7 +386,7 @@ class SpatialTransformer(nn.Module):
     Finally, reshape to image
     """
     def __init__(self, in_channels, n_heads, d_head,
-                 depth=1, dropout=0., context_dim=None):
+                 depth=1, dropout=0., context_dim=None, attention_backend=None):
         super().__init__()
         self.in_channels = in_channels
         inner_dim = n_heads * d_head
@@ -237,7 +399,8 @@ class SpatialTransformer(nn.Module):
                                  padding=0)
 
         self.transformer_blocks = nn.ModuleList(
-            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim)
+            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim,
+                                   attention_backend=attention_backend)
                 for d in range(depth)]
         )
 
@@ -247,8 +410,9 @@ class SpatialTransformer(nn.Module):
                                               stride=1,
                                               padding=0))
 
-    def forward(self, x, context=None):
+    def forward(self, x, context=None, out=None):
         # note: if no context is given, cross-attention defaults to self-attention
+        # out: see TimestepEmbedSequential.forward of the unet
         b, c, h, w = x.shape
         x_in = x
         x = self.norm(x)
@@ -258,4 +422,6 @@ class SpatialTransformer(nn.Module):
             x = block(x, context=context)
         x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
         x = self.proj_out(x)
-        return x + x_in
\ No newline at end of file
+        if out is None:
+            return x + x_in
+        return torch.add(x, x_in, out=out(x.shape, torch.result_type(x, x_in), x.device))
\ No newline at end of file
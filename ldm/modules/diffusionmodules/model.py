@@ -5,8 +5,9 @@ import torch.nn as nn
 import numpy as np
 from einops import rearrange
 
-from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.util import instantiate_from_config, default
+from ldm.modules.diffusionmodules.util import GroupNormSiLU, optimize_for_inference
+from ldm.modules.attention import LinearAttention, attention, default_attention_backend
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -117,18 +118,29 @@ class ResnetBlock(nn.Module):
                                                     kernel_size=1,
                                                     stride=1,
                                                     padding=0)
+        # norm1 and norm2 apply the nonlinearity themselves, see fuse_norm_act
+        self.fused_norm_act = False
+
+    def fuse_norm_act(self):
+        """fuse the group norms with the following nonlinearities, see GroupNormSiLU"""
+        if not self.fused_norm_act:
+            self.norm1 = GroupNormSiLU(self.norm1)
+            self.norm2 = GroupNormSiLU(self.norm2)
+            self.fused_norm_act = True
 
     def forward(self, x, temb):
         h = x
         h = self.norm1(h)
-        h = nonlinearity(h)
+        if not self.fused_norm_act:
+            h = nonlinearity(h)
         h = self.conv1(h)
 
         if temb is not None:
             h = h + self.temb_proj(nonlinearity(temb))[:,:,None,None]
 
         h = self.norm2(h)
-        h = nonlinearity(h)
+        if not self.fused_norm_act:
+            h = nonlinearity(h)
         h = self.dropout(h)
         h = self.conv2(h)
 
@@ -148,9 +160,10 @@ class LinAttnBlock(LinearAttention):
 
 
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, attention_backend=None):
         super().__init__()
         self.in_channels = in_channels
+        self.attention_backend = attention_backend
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -184,29 +197,23 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b,c,h*w)
-        w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b,c,h,w)
+        q = q.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        k = k.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        v = v.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        backend = default(self.attention_backend, default_attention_backend("naive"))
+        h_ = attention(q, k, v, int(c)**(-0.5), backend=backend)   # b,hw,c
+        h_ = h_.permute(0,2,1).reshape(b,c,h,w)
 
         h_ = self.proj_out(h_)
 
         return x+h_
 
 
-def make_attn(in_channels, attn_type="vanilla"):
+def make_attn(in_channels, attn_type="vanilla", attention_backend=None):
     assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
-        return AttnBlock(in_channels)
+        return AttnBlock(in_channels, attention_backend=attention_backend)
     elif attn_type == "none":
         return nn.Identity(in_channels)
     else:
@@ -216,7 +223,8 @@ def make_attn(in_channels, attn_type="vanilla"):
 class Model(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla"):
+                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla",
+                 attention_backend=None):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -259,7 +267,7 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -274,7 +282,7 @@ class Model(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -296,7 +304,7 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -369,7 +377,7 @@ class Encoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, double_z=True, use_linear_attn=False, attn_type="vanilla",
-                 **ignore_kwargs):
+                 attention_backend=None, **ignore_kwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -402,7 +410,7 @@ class Encoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -417,7 +425,7 @@ class Encoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -463,7 +471,7 @@ class Decoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, give_pre_end=False, tanh_out=False, use_linear_attn=False,
-                 attn_type="vanilla", **ignorekwargs):
+                 attn_type="vanilla", attention_backend=None, **ignorekwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -496,7 +504,7 @@ class Decoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -515,7 +523,7 @@ class Decoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -531,6 +539,21 @@ class Decoder(nn.Module):
                                         kernel_size=3,
                                         stride=1,
                                         padding=1)
+        # memory format of the activations and whether norm_out applies the nonlinearity, see
+        # optimize_for_inference
+        self.memory_format = torch.contiguous_format
+        self.fused_norm_act = False
+
+    def fuse_norm_act(self):
+        if not self.fused_norm_act:
+            self.norm_out = GroupNormSiLU(self.norm_out)
+            self.fused_norm_act = True
+
+    def optimize_for_inference(self, channels_last=True, fuse_norm_act=True):
+        """
+        Switch to the inference execution mode: channels_last weights and activations and fused GroupNorm + SiLU.
+        """
+        return optimize_for_inference(self, channels_last=channels_last, fuse_norm_act=fuse_norm_act)
 
     def forward(self, z):
         #assert z.shape[1:] == self.z_shape[1:]
@@ -540,7 +563,7 @@ class Decoder(nn.Module):
         temb = None
 
         # z to block_in
-        h = self.conv_in(z)
+        h = self.conv_in(z.contiguous(memory_format=self.memory_format))
 
         # middle
         h = self.mid.block_1(h, temb)
@@ -561,7 +584,8 @@ class Decoder(nn.Module):
             return h
 
         h = self.norm_out(h)
-        h = nonlinearity(h)
+        if not self.fused_norm_act:
+            h = nonlinearity(h)
         h = self.conv_out(h)
         if self.tanh_out:
             h = torch.tanh(h)
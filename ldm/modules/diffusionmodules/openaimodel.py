@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from contextlib import contextmanager
 from functools import partial
 import math
 from typing import Iterable
@@ -16,8 +17,11 @@ from ldm.modules.diffusionmodules.util import (
     zero_module,
     normalization,
     timestep_embedding,
+    fuse_norm_silu,
+    optimize_for_inference,
 )
-from ldm.modules.attention import SpatialTransformer
+from ldm.modules.attention import SpatialTransformer, attention, default_attention_backend, set_attention_backend
+from ldm.util import default
 
 
 # dummy replace
@@ -59,6 +63,16 @@ class AttentionPool2d(nn.Module):
         return x[:, :, 0]
 
 
+class ScheduledEmbedding(object):
+    """
+    Stands in for the timestep embeddings while UNetModel samples along a registered timestep schedule: the rows of
+    the timesteps in the schedule, which index the per-block tables of the ResBlocks, see
+    UNetModel.set_timestep_schedule.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+
 class TimestepBlock(nn.Module):
     """
     Any module where forward() takes timestep embeddings as a second argument.
@@ -77,14 +91,22 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
     support it as an extra input.
     """
 
-    def forward(self, x, emb, context=None):
-        for layer in self:
+    def forward(self, x, emb, context=None, out=None):
+        """
+        :param out: if given, the last layer writes its output into the tensor out(shape, dtype, device) returns,
+                    see SkipBuffers.
+        """
+        for i, layer in enumerate(self):
+            layer_out = out if i == len(self) - 1 else None
             if isinstance(layer, TimestepBlock):
-                x = layer(x, emb)
+                x = layer(x, emb, out=layer_out)
             elif isinstance(layer, SpatialTransformer):
-                x = layer(x, context)
+                x = layer(x, context, out=layer_out)
             else:
                 x = layer(x)
+                if layer_out is not None:
+                    # layers without an out argument, i.e. convolutions and up and downsampling
+                    x = layer_out(x.shape, x.dtype, x.device).copy_(x)
         return x
 
 
@@ -240,19 +262,26 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = conv_nd(dims, channels, self.out_channels, 1)
 
-    def forward(self, x, emb):
+        # emb_layers(emb) of the timesteps of a schedule, looked up by ScheduledEmbedding rows
+        self.emb_table = None
+
+    def forward(self, x, emb, out=None):
         """
         Apply the block to a Tensor, conditioned on a timestep embedding.
         :param x: an [N x C x ...] Tensor of features.
         :param emb: an [N x emb_channels] Tensor of timestep embeddings.
+        :param out: see TimestepEmbedSequential.forward.
         :return: an [N x C x ...] Tensor of outputs.
         """
+        if out is not None:
+            # only the inference forward of UNetModel with skip buffers passes out
+            return self._forward(x, emb, out)
         return checkpoint(
             self._forward, (x, emb), self.parameters(), self.use_checkpoint
         )
 
 
-    def _forward(self, x, emb):
+    def _forward(self, x, emb, out=None):
         if self.updown:
             in_rest, in_conv = self.in_layers[:-1], self.in_layers[-1]
             h = in_rest(x)
@@ -261,7 +290,10 @@ class ResBlock(TimestepBlock):
             h = in_conv(h)
         else:
             h = self.in_layers(x)
-        emb_out = self.emb_layers(emb).type(h.dtype)
+        if isinstance(emb, ScheduledEmbedding):
+            emb_out = self.emb_table[emb.rows].type(h.dtype)
+        else:
+            emb_out = self.emb_layers(emb).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
         if self.use_scale_shift_norm:
@@ -272,7 +304,17 @@ class ResBlock(TimestepBlock):
         else:
             h = h + emb_out
             h = self.out_layers(h)
-        return self.skip_connection(x) + h
+        skip = self.skip_connection(x)
+        if out is None:
+            return skip + h
+        return th.add(skip, h, out=out(h.shape, th.result_type(skip, h), h.device))
+
+    def fuse_norm_act(self):
+        """fuse the group norms with the following SiLUs, see GroupNormSiLU"""
+        fuse_norm_silu(self.in_layers)
+        if not self.use_scale_shift_norm:
+            # with scale shift norm, the SiLU comes after the modulation of the normalized features
+            fuse_norm_silu(self.out_layers)
 
 
 class AttentionBlock(nn.Module):
@@ -289,6 +331,7 @@ class AttentionBlock(nn.Module):
         num_head_channels=-1,
         use_checkpoint=False,
         use_new_attention_order=False,
+        attention_backend=None,
     ):
         super().__init__()
         self.channels = channels
@@ -304,10 +347,10 @@ class AttentionBlock(nn.Module):
         self.qkv = conv_nd(1, channels, channels * 3, 1)
         if use_new_attention_order:
             # split qkv before split heads
-            self.attention = QKVAttention(self.num_heads)
+            self.attention = QKVAttention(self.num_heads, attention_backend=attention_backend)
         else:
             # split heads before split qkv
-            self.attention = QKVAttentionLegacy(self.num_heads)
+            self.attention = QKVAttentionLegacy(self.num_heads, attention_backend=attention_backend)
 
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
@@ -349,9 +392,10 @@ class QKVAttentionLegacy(nn.Module):
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, attention_backend=None):
         super().__init__()
         self.n_heads = n_heads
+        self.attention_backend = attention_backend
 
     def forward(self, qkv):
         """
@@ -363,13 +407,11 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        # upcast scales q and k separately, more stable with f16 than dividing afterwards
+        backend = default(self.attention_backend, default_attention_backend("naive"))
+        a = attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), 1 / math.sqrt(ch),
+                      backend=backend, upcast=True)
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -381,9 +423,10 @@ class QKVAttention(nn.Module):
     A module which performs QKV attention and splits in a different order.
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, attention_backend=None):
         super().__init__()
         self.n_heads = n_heads
+        self.attention_backend = attention_backend
 
     def forward(self, qkv):
         """
@@ -394,22 +437,48 @@ class QKVAttention(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        q, k, v = [x.reshape(bs * self.n_heads, ch, length).transpose(1, 2) for x in qkv.chunk(3, dim=1)]
+        # upcast scales q and k separately, more stable with f16 than dividing afterwards
+        backend = default(self.attention_backend, default_attention_backend("naive"))
+        a = attention(q, k, v, 1 / math.sqrt(ch), backend=backend, upcast=True)
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
         return count_flops_attn(model, _x, y)
 
 
+class SkipBuffers(object):
+    """
+    The concatenated inputs th.cat([h, skip], dim=1) of the output blocks of a UNetModel, for one forward pass. The
+    input block that computes the skip of an output block allocates its buffer and writes the skip into the last
+    channels, the block before the output block writes h into the first channels, and the output block reads the
+    buffer as it is. pop releases a buffer once its output block runs.
+    :param channels: (h channels, skip channels) of every output block.
+    :param memory_format: memory format of the buffers.
+    """
+
+    def __init__(self, channels, memory_format=th.contiguous_format):
+        self.channels = channels
+        self.memory_format = memory_format
+        self.buffers = [None] * len(channels)
+
+    def writer(self, j, skip):
+        """the out argument (see TimestepEmbedSequential.forward) of the block that writes a half of buffer j"""
+        def out(shape, dtype, device):
+            c_h, c_skip = self.channels[j]
+            if self.buffers[j] is None:
+                self.buffers[j] = th.empty((shape[0], c_h + c_skip, *shape[2:]), dtype=dtype, device=device,
+                                           memory_format=self.memory_format)
+            buffer = self.buffers[j]
+            return buffer[:, c_h:] if skip else buffer[:, :c_h]
+        return out
+
+    def pop(self, j):
+        buffer, self.buffers[j] = self.buffers[j], None
+        return buffer
+
+
 class UNetModel(nn.Module):
     """
     The full UNet model with attention and timestep embedding.
@@ -438,6 +507,8 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_backend: name of the attention kernel of all attention layers,
+                              see ldm.modules.attention.ATTENTION_BACKENDS. None for the default.
     """
 
     def __init__(
@@ -466,6 +537,7 @@ class UNetModel(nn.Module):
         context_dim=None,                 # custom transformer support
         n_embed=None,                     # custom support for prediction of discrete ids into codebook of first stage vq model
         legacy=True,
+        attention_backend=None,
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -624,9 +696,12 @@ class UNetModel(nn.Module):
         self._feature_size += ch
 
         self.output_blocks = nn.ModuleList([])
+        # (h channels, skip channels) of the concatenated input of every output block
+        self.concat_channels = list()
         for level, mult in list(enumerate(channel_mult))[::-1]:
             for i in range(num_res_blocks + 1):
                 ich = input_block_chans.pop()
+                self.concat_channels.append((ch, ich))
                 layers = [
                     ResBlock(
                         ch + ich,
@@ -690,6 +765,17 @@ class UNetModel(nn.Module):
             conv_nd(dims, model_channels, n_embed, 1),
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
+        if attention_backend is not None:
+            set_attention_backend(self, attention_backend)
+        # memory format of the activations, see optimize_for_inference
+        self.memory_format = th.contiguous_format
+        # time_embed(timestep_embedding(t)) of the integer timesteps [0, timestep_table_size), see time_embedding
+        self.timestep_table_size = 1000
+        self.timestep_table = None
+        # (timesteps, table row of every timestep, schedule_key) of the schedule the ResBlock tables are built for
+        self.timestep_schedule = None
+        # preallocate the concatenated inputs of the output blocks at inference, see enable_skip_buffers
+        self.skip_buffers = False
 
     def convert_to_fp16(self):
         """
@@ -707,6 +793,124 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
+    def fuse_norm_act(self):
+        fuse_norm_silu(self.out)
+
+    def timestep_table_key(self, device):
+        # in place updates of the weights (optimizer steps, load_state_dict) bump their version, the .data copies of
+        # ema_scope do not and call invalidate_timestep_table instead
+        params = tuple((p.data_ptr(), p._version) for p in self.time_embed.parameters())
+        return device, th.is_autocast_enabled(), params
+
+    def invalidate_timestep_table(self):
+        self.timestep_table = None
+        if self.timestep_schedule is not None:
+            # rebuilt with the new weights on the next call
+            self.timestep_schedule = (self.timestep_schedule[0], self.timestep_schedule[1], None)
+
+    def time_embedding(self, timesteps):
+        """
+        time_embed(timestep_embedding(timesteps)). At inference, integer timesteps are looked up in a table of all
+        timestep_table_size timesteps, which is built on the first call and rebuilt when the weights, the device or
+        the autocast state change.
+        :param timesteps: a 1-D batch of timesteps.
+        :return: an [N x time_embed_dim] Tensor of embeddings.
+        """
+        if self.training or th.is_grad_enabled() or th.is_floating_point(timesteps) or th.jit.is_tracing():
+            return self.time_embed(timestep_embedding(timesteps, self.model_channels, repeat_only=False))
+        key = self.timestep_table_key(timesteps.device)
+        if self.timestep_table is None or self.timestep_table[0] != key:
+            t = th.arange(self.timestep_table_size, device=timesteps.device)
+            table = self.time_embed(timestep_embedding(t, self.model_channels, repeat_only=False))
+            self.timestep_table = (key, table)
+        return self.timestep_table[1][timesteps]
+
+    def schedule_key(self, device):
+        # weight changes are not looked for here, which would mean a pass over the parameters of every ResBlock per
+        # call, they go through invalidate_timestep_table (see DDPM.invalidate_weight_caches). conversions
+        # (convert_to_fp16, .half()) change the dtype of the projections.
+        dtype = self.resblocks[0].emb_layers[-1].weight.dtype if len(self.resblocks) > 0 else None
+        return device, th.is_autocast_enabled(), dtype
+
+    @th.no_grad()
+    def set_timestep_schedule(self, timesteps):
+        """
+        Precompute emb_layers(time_embedding(t)) of every ResBlock for the timesteps of a sampling schedule, into one
+        [len(timesteps) x emb channels] table per block. Until clear_timestep_schedule, calls at inference look the
+        projections up instead of computing them. A timestep that is not part of the schedule gets the projections of
+        the nearest one that is, so calls with other timesteps belong outside of the schedule.
+        Class conditional models add the label embedding to the timestep embedding and always compute it.
+        :param timesteps: the integer timesteps of the schedule, in [0, timestep_table_size).
+        """
+        if self.num_classes is not None:
+            return
+        if th.is_tensor(timesteps):
+            timesteps = timesteps.cpu()
+        timesteps = th.as_tensor(np.asarray(timesteps).copy(), dtype=th.long).reshape(-1)
+        if len(timesteps) == 0 or timesteps.min() < 0 or timesteps.max() >= self.timestep_table_size:
+            raise ValueError(f"the timesteps of a schedule have to be in [0, {self.timestep_table_size})")
+        timesteps = timesteps.unique()
+        # row of the nearest timestep of the schedule, for every timestep
+        t = th.arange(self.timestep_table_size)
+        right = th.searchsorted(timesteps, t).clamp(max=len(timesteps) - 1)
+        left = (right - 1).clamp(min=0)
+        rows = th.where(t - timesteps[left] <= (timesteps[right] - t).abs(), left, right)
+
+        device = self.time_embed[0].weight.device
+        self.resblocks = [m for m in self.modules() if isinstance(m, ResBlock)]
+        emb = self.time_embedding(timesteps.to(device))
+        for m in self.resblocks:
+            m.emb_table = m.emb_layers(emb)
+        self.timestep_schedule = (timesteps, rows.to(device), self.schedule_key(device))
+
+    def clear_timestep_schedule(self):
+        if self.timestep_schedule is None:
+            return
+        self.timestep_schedule = None
+        for m in self.resblocks:
+            m.emb_table = None
+
+    def scheduled_embedding(self, timesteps):
+        """
+        ScheduledEmbedding of timesteps, or None if the ResBlock tables do not apply to this call: there is no
+        schedule, or the call is not at inference.
+        """
+        if self.timestep_schedule is None or self.training or th.is_grad_enabled() or \
+                th.is_floating_point(timesteps) or th.jit.is_tracing():
+            return None
+        if self.timestep_schedule[2] != self.schedule_key(timesteps.device):
+            self.set_timestep_schedule(self.timestep_schedule[0])
+        # clamped instead of checked, a check would wait for the device on every call
+        return ScheduledEmbedding(self.timestep_schedule[1][timesteps.clamp(0, self.timestep_table_size - 1)])
+
+    def optimize_for_inference(self, channels_last=True, fuse_norm_act=True):
+        """
+        Switch to the inference execution mode: channels_last weights and activations and fused GroupNorm + SiLU.
+        """
+        return optimize_for_inference(self, channels_last=channels_last, fuse_norm_act=fuse_norm_act)
+
+    def enable_skip_buffers(self, enabled=True):
+        """
+        Run the blocks of forward with SkipBuffers at inference, which writes the skip connections and the outputs
+        of the blocks before the output blocks into preallocated concatenation buffers instead of copying them with
+        th.cat. A buffer is held, with the channels of both halves, from the input block that writes the skip until
+        the output block that reads it, see scripts/benchmarks/unet_skip_buffers.py for the peak memory per level.
+        """
+        self.skip_buffers = enabled
+        return self
+
+    def forward_skip_buffers(self, h, emb, context=None):
+        """the input, middle and output blocks of forward, with the skip connections in SkipBuffers"""
+        buffers = SkipBuffers(self.concat_channels, self.memory_format)
+        n = len(self.output_blocks)
+        for i, module in enumerate(self.input_blocks):
+            h = module(h, emb, context, out=buffers.writer(n - 1 - i, skip=True))
+        h = self.middle_block(h, emb, context, out=buffers.writer(0, skip=False))
+        for j, module in enumerate(self.output_blocks):
+            out = buffers.writer(j + 1, skip=False) if j + 1 < n else None
+            h = module(buffers.pop(j), emb, context, out=out)
+        return h
+
     def forward(self, x, timesteps=None, context=None, y=None,**kwargs):
         """
         Apply the model to an input batch.
@@ -720,21 +924,25 @@ class UNetModel(nn.Module):
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        emb = self.scheduled_embedding(timesteps)
+        if emb is None:
+            emb = self.time_embedding(timesteps)
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
-        h = x.type(self.dtype)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
-            h = th.cat([h, hs.pop()], dim=1)
-            h = module(h, emb, context)
+        h = x.type(self.dtype).contiguous(memory_format=self.memory_format)
+        if self.skip_buffers and not (self.training or th.is_grad_enabled() or th.jit.is_tracing()):
+            h = self.forward_skip_buffers(h, emb, context)
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            for module in self.output_blocks:
+                h = th.cat([h, hs.pop()], dim=1)
+                h = module(h, emb, context)
         h = h.type(x.dtype)
         if self.predict_codebook_ids:
             return self.id_predictor(h)
@@ -769,6 +977,7 @@ class EncoderUNetModel(nn.Module):
         resblock_updown=False,
         use_new_attention_order=False,
         pool="adaptive",
+        attention_backend=None,
         *args,
         **kwargs
     ):
@@ -920,6 +1129,8 @@ class EncoderUNetModel(nn.Module):
             )
         else:
             raise NotImplementedError(f"Unexpected {pool} pooling")
+        if attention_backend is not None:
+            set_attention_backend(self, attention_backend)
 
     def convert_to_fp16(self):
         """
@@ -959,3 +1170,18 @@ class EncoderUNetModel(nn.Module):
             h = h.type(x.dtype)
             return self.out(h)
 
+
+@contextmanager
+def timestep_schedule(model, timesteps):
+    """
+    Sample with the ResBlock projections of the UNetModels in model precomputed for timesteps, for as long as the
+    context manager is active, see UNetModel.set_timestep_schedule.
+    """
+    unets = [m for m in model.modules() if isinstance(m, UNetModel)]
+    for m in unets:
+        m.set_timestep_schedule(timesteps)
+    try:
+        yield
+    finally:
+        for m in unets:
+            m.clear_timestep_schedule()
@@ -12,6 +12,7 @@ import os
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from einops import repeat
 
@@ -109,7 +110,8 @@ def checkpoint(func, inputs, params, flag):
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
+    # without gradients there is nothing to recompute, and the autograd function would keep the model from being traced
+    if flag and torch.is_grad_enabled():
         args = tuple(inputs) + tuple(params)
         return CheckpointFunction.apply(func, len(inputs), *args)
     else:
@@ -215,6 +217,64 @@ class GroupNorm32(nn.GroupNorm):
     def forward(self, x):
         return super().forward(x.float()).type(x.dtype)
 
+
+class GroupNormSiLU(nn.Module):
+    """
+    GroupNorm followed by SiLU in one module, for inference. The SiLU is applied in place on the output of the
+    normalization, and with upcast it is applied before the cast back to the input dtype, so a norm + activation
+    writes one activation sized tensor (two with upcast on half inputs) instead of up to four.
+    Shares the parameters of the norm it replaces, so the state dict keys stay the same.
+    :param norm: the nn.GroupNorm to replace.
+    :param upcast: normalize in float32, as GroupNorm32 does. defaults to whether norm is a GroupNorm32.
+    """
+    def __init__(self, norm, upcast=None):
+        super().__init__()
+        self.num_groups = norm.num_groups
+        self.num_channels = norm.num_channels
+        self.eps = norm.eps
+        self.weight = norm.weight
+        self.bias = norm.bias
+        self.upcast = isinstance(norm, GroupNorm32) if upcast is None else upcast
+
+    def forward(self, x):
+        h = F.group_norm(x.float() if self.upcast else x, self.num_groups, self.weight, self.bias, self.eps)
+        return F.silu(h, inplace=True).type(x.dtype)
+
+    def extra_repr(self):
+        return f"{self.num_groups}, {self.num_channels}, eps={self.eps}, upcast={self.upcast}"
+
+
+def fuse_norm_silu(layers):
+    """
+    In place, replace a GroupNorm directly followed by a SiLU in an nn.Sequential with a GroupNormSiLU and an
+    nn.Identity, so that indexing into the layers still works.
+    """
+    for i in range(len(layers) - 1):
+        if isinstance(layers[i], nn.GroupNorm) and isinstance(layers[i + 1], (nn.SiLU, SiLU)):
+            layers[i] = GroupNormSiLU(layers[i])
+            layers[i + 1] = nn.Identity()
+    return layers
+
+
+def optimize_for_inference(model, channels_last=True, fuse_norm_act=True):
+    """
+    Inference execution mode of 2d models: fuse GroupNorm + SiLU pairs of the modules that support it (see the
+    fuse_norm_act methods of ResBlock, UNetModel, ResnetBlock and Decoder) and switch the weights and the input of the
+    model to channels_last, which the convolutions and group norms of recent PyTorch versions run without layout
+    conversions. Parameter names are unchanged, checkpoints still load after the conversion.
+    :param model: a UNetModel, Decoder or any module containing them.
+    """
+    if fuse_norm_act:
+        for module in list(model.modules()):
+            if hasattr(module, "fuse_norm_act"):
+                module.fuse_norm_act()
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+        for module in model.modules():
+            if hasattr(module, "memory_format"):
+                module.memory_format = torch.channels_last
+    return model
+
 def conv_nd(dims, *args, **kwargs):
     """
     Create a 1D, 2D, or 3D convolution module.
@@ -261,7 +321,39 @@ class HybridConditioner(nn.Module):
         return {'c_concat': [c_concat], 'c_crossattn': [c_crossattn]}
 
 
-def noise_like(shape, device, repeat=False):
-    repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
-    noise = lambda: torch.randn(shape, device=device)
+def make_generators(generator, batch_size, device=None):
+    """
+    Normalize the generator argument of the samplers.
+    :param generator: None for the global random state, a torch.Generator shared by the batch, or a list with one
+                      torch.Generator or integer seed per sample.
+    :param device: device of the generators made for seeds, such that the noise is drawn where it is used. defaults
+                   to the cpu, where a seed gives the same sample on every device.
+    :return: None, a torch.Generator or a list of batch_size torch.Generators.
+    """
+    if generator is None or isinstance(generator, torch.Generator):
+        return generator
+    generator = list(generator)
+    assert len(generator) == batch_size, f"got {len(generator)} generators for a batch of {batch_size}"
+    return [g if isinstance(g, torch.Generator) else torch.Generator(device=device or "cpu").manual_seed(int(g))
+            for g in generator]
+
+
+def randn(shape, device, generator=None):
+    """
+    torch.randn on device, drawn from generator (see make_generators). with one generator per sample, every sample
+    draws from its own generator and does not depend on the size or the order of its batch.
+    """
+    if isinstance(generator, (list, tuple)):
+        assert len(generator) == shape[0], f"got {len(generator)} generators for a batch of {shape[0]}"
+        return torch.stack([torch.randn(shape[1:], generator=g, device=g.device) for g in generator]).to(device)
+    if generator is not None:
+        return torch.randn(shape, generator=generator, device=generator.device).to(device)
+    return torch.randn(shape, device=device)
+
+
+def noise_like(shape, device, repeat=False, generator=None):
+    if isinstance(generator, (list, tuple)) and repeat:
+        generator = generator[0]
+    repeat_noise = lambda: randn((1, *shape[1:]), device, generator).repeat(shape[0], *((1,) * (len(shape) - 1)))
+    noise = lambda: randn(shape, device, generator)
     return repeat_noise() if repeat else noise()
\ No newline at end of file
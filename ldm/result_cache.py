@@ -0,0 +1,237 @@
+"""content addressed cache of generation results
+
+A result is keyed on a hash of everything that determines it: the request parameters (prompt, seed, steps, scale,
+size, ...) and a fingerprint of the weights it was sampled with. Results are stored as uint8 images, before they are
+encoded to any file format, together with scalar info (e.g. the safety checker flags) and optionally the final
+latents. Entries live on disk, one file each, or in a single sqlite database, and the least recently used ones are
+evicted once the cache grows beyond max_bytes.
+"""
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+def state_dict_fingerprint(model, samples=1024):
+    """
+    Hash of the state dict of a model that tells checkpoints apart without hashing gigabytes of weights: the names,
+    shapes and dtypes of all entries and up to `samples` evenly spaced values of every tensor.
+    """
+    h = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode("utf-8"))
+        flat = tensor.detach().reshape(-1)
+        if flat.numel() == 0:
+            continue
+        index = torch.linspace(0, flat.numel() - 1, min(flat.numel(), samples), device=flat.device).long()
+        h.update(flat[index].float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def request_key(fingerprint, **params):
+    """hash of the weight fingerprint and the json serializable request parameters"""
+    payload = json.dumps({"fingerprint": fingerprint, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskBackend(object):
+    """
+    One file per entry under root, sharded into subdirectories by the first two characters of the key. The access
+    time of an entry is its mtime, which get() refreshes.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        # key -> (size, last used), rebuilt from the directory so that the cache survives restarts
+        self.index = dict()
+        for shard in os.scandir(root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    self.index[entry.name[:-len(".npz")]] = (stat.st_size, stat.st_mtime)
+        self.size = sum(size for size, _ in self.index.values())
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.index[key] = (self.index[key][0], time.time())
+        try:
+            with open(self.path(key), "rb") as f:
+                value = f.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            with self.lock:
+                self.forget(key)
+            return None
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write and rename, so that readers never see a partial entry
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(value)
+        os.replace(tmp, path)
+        with self.lock:
+            self.forget(key)
+            self.index[key] = (len(value), time.time())
+            self.size += len(value)
+            self.evict()
+
+    def forget(self, key):
+        if key in self.index:
+            self.size -= self.index.pop(key)[0]
+
+    def evict(self):
+        if self.size <= self.max_bytes:
+            return
+        # evict down to 90% of max_bytes, so that not every put has to sort the index
+        for key, _ in sorted(self.index.items(), key=lambda item: item[1][1]):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            self.forget(key)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def __len__(self):
+        return len(self.index)
+
+
+class SQLiteBackend(object):
+    """All entries in one sqlite database, with their size and the time they were last used."""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                        "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return bytes(row[0])
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            (key, sqlite3.Binary(value), len(value), time.time()))
+            self.evict()
+
+    def evict(self):
+        size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        # evict down to 90% of max_bytes, least recently used first
+        excess = size - 0.9 * self.max_bytes
+        evicted = list()
+        for key, entry_size in self.db.execute("SELECT key, size FROM results ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= entry_size
+        self.db.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def open_backend(path, max_bytes):
+    """a SQLiteBackend for paths ending in .sqlite or .db, else a DiskBackend rooted at path"""
+    if os.path.splitext(path)[1] in [".sqlite", ".db"]:
+        return SQLiteBackend(path, max_bytes)
+    return DiskBackend(path, max_bytes)
+
+
+class ResultCache(object):
+    """
+    Cache of generation results in front of a sampling pipeline.
+
+    :param backend: a DiskBackend or SQLiteBackend, or a path for open_backend.
+    :param fingerprint: fingerprint of the weights, see state_dict_fingerprint.
+    :param max_bytes: size limit if backend is a path.
+    :param store_latents: also store the final latents passed to put().
+    """
+    def __init__(self, backend, fingerprint, max_bytes=10 * 2**30, store_latents=False):
+        if isinstance(backend, str):
+            backend = open_backend(backend, max_bytes)
+        self.backend = backend
+        self.fingerprint = fingerprint
+        self.store_latents = store_latents
+        # get() is called from the request threads of a server
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, **params):
+        return request_key(self.fingerprint, **params)
+
+    def get(self, key):
+        """
+        :return: None, or a dict with the cached "images" ((b, h, w, c) uint8), "info" and, if they were stored,
+                 "latents".
+        """
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            return None
+        with np.load(io.BytesIO(value), allow_pickle=False) as data:
+            result = {"images": data["images"], "info": json.loads(str(data["info"]))}
+            if "latents" in data:
+                result["latents"] = data["latents"]
+        return result
+
+    def put(self, key, images, latents=None, info=None):
+        """
+        :param images: (b, h, w, c) uint8 numpy array of the final images.
+        :param latents: numpy array or tensor of the final latents, only stored with store_latents.
+        :param info: json serializable dict stored alongside.
+        """
+        arrays = {"images": np.asarray(images, dtype=np.uint8), "info": np.array(json.dumps(info or {}))}
+        if self.store_latents and latents is not None:
+            if torch.is_tensor(latents):
+                latents = latents.detach().cpu().numpy()
+            arrays["latents"] = latents
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        self.backend.put(key, buf.getvalue())
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        return {"hits": hits, "misses": misses, "entries": len(self.backend)}
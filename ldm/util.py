@@ -1,13 +1,19 @@
 import importlib
+import hashlib
+import json
+import os
 
 import torch
 import numpy as np
 from collections import abc
+from contextlib import contextmanager
+from omegaconf import OmegaConf
 from einops import rearrange
 from functools import partial
 
 import multiprocessing as mp
-from threading import Thread
+from threading import Thread, BoundedSemaphore, Lock, local
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from queue import Queue
 
 from inspect import isfunction
@@ -93,6 +99,408 @@ def get_obj_from_str(string, reload=False):
     return getattr(importlib.import_module(module, package=None), cls)
 
 
+MMAP_ALIGNMENT = 64
+MMAP_VERSION = 1
+
+_TORCH_DTYPES = {str(dt): dt for dt in [torch.float64, torch.float32, torch.float16, torch.bfloat16, torch.int64,
+                                        torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool]}
+
+
+def _aligned(n, alignment=MMAP_ALIGNMENT):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def mmap_checkpoint_path(ckpt, mmap_dir=None):
+    """
+    Next to ckpt, or in mmap_dir. Checkpoints are often all called model.ckpt, so in mmap_dir the name includes a
+    hash of the absolute checkpoint path.
+    """
+    stem = os.path.splitext(os.path.basename(ckpt))[0]
+    if mmap_dir is None:
+        return os.path.join(os.path.dirname(ckpt), stem + ".mmap")
+    digest = hashlib.sha1(os.path.abspath(ckpt).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(mmap_dir, f"{stem}-{digest}.mmap")
+
+
+def convert_checkpoint(ckpt, path=None):
+    """
+    Convert a (lightning) .ckpt into a memory-mappable file. Layout: the length of the header as 8 byte little endian
+    integer, a JSON header, and the raw data of every tensor of the state dict, each aligned to MMAP_ALIGNMENT bytes.
+    The header lists name, dtype, shape, offset and size of every tensor, the scalar entries of the checkpoint
+    (e.g. global_step) and size and mtime of the source, to detect a stale conversion.
+    """
+    path = mmap_checkpoint_path(ckpt) if path is None else path
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    sd = pl_sd["state_dict"] if "state_dict" in pl_sd else pl_sd
+
+    tensors, offset = dict(), 0
+    for name, t in sd.items():
+        if not isinstance(t, torch.Tensor):
+            continue
+        if str(t.dtype) not in _TORCH_DTYPES:
+            raise TypeError(f"unsupported dtype {t.dtype} of {name}")
+        nbytes = t.numel() * t.element_size()
+        tensors[name] = {"dtype": str(t.dtype), "shape": list(t.shape), "offset": offset, "nbytes": nbytes}
+        offset = _aligned(offset + nbytes)
+    stat = os.stat(ckpt)
+    header = {"version": MMAP_VERSION,
+              "source": {"size": stat.st_size, "mtime": stat.st_mtime},
+              "metadata": {k: v for k, v in pl_sd.items() if isinstance(v, (int, float, str, bool))},
+              "tensors": tensors}
+    header = json.dumps(header).encode("utf-8")
+    data_offset = _aligned(8 + len(header))
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        f.write(b"\0" * (data_offset - 8 - len(header)))
+        for name, info in tensors.items():
+            f.seek(data_offset + info["offset"])
+            if info["nbytes"] > 0:
+                f.write(sd[name].detach().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        f.truncate(data_offset + offset)
+    os.replace(tmp, path)
+    return path
+
+
+def read_mmap_header(path):
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    header["data_offset"] = _aligned(8 + header_len)
+    return header
+
+
+def load_mmap_checkpoint(path):
+    """
+    Map a file written by convert_checkpoint. The tensors of the returned state dict share the pages of the file
+    (copy-on-write), nothing is read before it is accessed.
+    :return: state dict and metadata of the checkpoint.
+    """
+    header = read_mmap_header(path)
+    mm = np.memmap(path, dtype=np.uint8, mode="c")
+    base = header["data_offset"]
+    sd = dict()
+    for name, info in header["tensors"].items():
+        start = base + info["offset"]
+        buf = torch.from_numpy(mm[start:start + info["nbytes"]])
+        sd[name] = buf.view(_TORCH_DTYPES[info["dtype"]]).reshape(info["shape"])
+    return sd, header["metadata"]
+
+
+def mmap_checkpoint_is_fresh(ckpt, path):
+    if not os.path.exists(path):
+        return False
+    try:
+        header = read_mmap_header(path)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(ckpt)
+    return header.get("version") == MMAP_VERSION and \
+        header["source"]["size"] == stat.st_size and header["source"]["mtime"] == stat.st_mtime
+
+
+_empty_weights = local()
+_empty_weights_lock = Lock()
+_empty_weights_installed = False
+
+
+def _empty_parameter(module, name, param):
+    if param is None or not getattr(_empty_weights, "depth", 0):
+        return None
+    return type(param)(param.to("meta"), requires_grad=param.requires_grad)
+
+
+def _install_empty_weights_hook():
+    """
+    Install the parameter registration hook of init_empty_weights once per process. It only acts in threads that
+    are inside the context, so modules constructed concurrently by other threads are not affected.
+    """
+    global _empty_weights_installed
+    with _empty_weights_lock:
+        if _empty_weights_installed:
+            return
+        if hasattr(torch.nn.modules.module, "register_module_parameter_registration_hook"):
+            torch.nn.modules.module.register_module_parameter_registration_hook(_empty_parameter)
+        else:
+            register_parameter = torch.nn.Module.register_parameter
+
+            def register_empty_parameter(module, name, param):
+                register_parameter(module, name, param)
+                empty = _empty_parameter(module, name, module._parameters.get(name))
+                if empty is not None:
+                    module._parameters[name] = empty
+
+            torch.nn.Module.register_parameter = register_empty_parameter
+        _empty_weights_installed = True
+
+
+@contextmanager
+def init_empty_weights():
+    """
+    Modules created in this context get their parameters on the meta device, so no memory is allocated for weights
+    that are overwritten by a checkpoint anyway. Buffers stay on the cpu, they are small and often computed in
+    __init__ (e.g. the diffusion schedule), which is why the torch.device("meta") context, which would also put
+    them on meta, is not used. The context is thread-local.
+    """
+    _install_empty_weights_hook()
+    _empty_weights.depth = getattr(_empty_weights, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _empty_weights.depth -= 1
+
+
+def assign_state_dict(model, sd):
+    """
+    Like load_state_dict(strict=False), but the tensors of sd become the parameters and buffers of model instead of
+    being copied into them. Tensors are only converted if their dtype differs.
+    :return: missing and unexpected keys.
+    """
+    expected = dict(model.state_dict(keep_vars=True))
+    unexpected = list()
+    for name, t in sd.items():
+        if name not in expected or expected[name].shape != t.shape:
+            unexpected.append(name)
+            continue
+        prefix, _, attr = name.rpartition(".")
+        module = model.get_submodule(prefix) if prefix else model
+        old = expected[name]
+        if t.dtype != old.dtype:
+            t = t.to(old.dtype)
+        if attr in module._parameters:
+            module._parameters[attr] = type(old)(t, requires_grad=old.requires_grad)
+        else:
+            module._buffers[attr] = t
+    missing = [k for k in expected if k not in sd]
+    return missing, unexpected
+
+
+# models loaded with keep_warm=True, see load_model_from_config
+_WARM_POOL = dict()
+
+
+def load_model_from_config(config, ckpt, verbose=False, device=None, use_mmap=False, mmap_dir=None, keep_warm=False,
+                           return_metadata=False):
+    """
+    Instantiate config.model and load the weights of ckpt.
+
+    With use_mmap, the checkpoint is converted once into a memory-mappable file (see convert_checkpoint), which takes
+    as much disk space as the checkpoint,
+    the model is built with parameters on the meta device and the mapped tensors are assigned as its weights. This
+    avoids reading the full checkpoint into memory and materializing every weight twice. If the conversion cannot be
+    written, or if the model ends up with weights that are not in the checkpoint, the regular torch.load path is
+    used.
+
+    :param device: device to move the model to, defaults to cuda if available.
+    :param use_mmap: load through the memory-mappable conversion of ckpt, off by default.
+    :param mmap_dir: directory for the conversion, defaults to the directory of ckpt. Created if missing.
+    :param keep_warm: keep the loaded model in a process wide pool and return it again for the same config,
+                      checkpoint and device, e.g. for long running services and notebooks.
+    :param return_metadata: also return the scalar entries of the checkpoint, e.g. global_step.
+    """
+    if device is None:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    key = None
+    if keep_warm:
+        key = (OmegaConf.to_yaml(config.model), os.path.abspath(ckpt), os.stat(ckpt).st_mtime, str(device))
+        if key in _WARM_POOL:
+            print(f"Using warm model for {ckpt}")
+            model, metadata = _WARM_POOL[key]
+            return (model, metadata) if return_metadata else model
+
+    print(f"Loading model from {ckpt}")
+    model = None
+    if use_mmap:
+        path = mmap_checkpoint_path(ckpt, mmap_dir)
+        try:
+            if not mmap_checkpoint_is_fresh(ckpt, path):
+                if mmap_dir is not None:
+                    os.makedirs(mmap_dir, exist_ok=True)
+                print(f"Converting {ckpt} to memory-mappable {path}")
+                convert_checkpoint(ckpt, path)
+            sd, metadata = load_mmap_checkpoint(path)
+            with init_empty_weights():
+                model = instantiate_from_config(config.model)
+            m, u = assign_state_dict(model, sd)
+            left = [n for n, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+            if len(left) > 0:
+                print(f"{len(left)} weights are not in the checkpoint, falling back to torch.load")
+                model = None
+        except Exception as e:
+            print(f"Cannot memory-map {ckpt} ({e}), falling back to torch.load")
+            model = None
+
+    if model is None:
+        pl_sd = torch.load(ckpt, map_location="cpu")
+        metadata = {k: v for k, v in pl_sd.items() if isinstance(v, (int, float, str, bool))}
+        sd = pl_sd["state_dict"]
+        model = instantiate_from_config(config.model)
+        m, u = model.load_state_dict(sd, strict=False)
+
+    if "global_step" in metadata:
+        print(f"Global Step: {metadata['global_step']}")
+    if len(m) > 0 and verbose:
+        print("missing keys:")
+        print(m)
+    if len(u) > 0 and verbose:
+        print("unexpected keys:")
+        print(u)
+
+    model.to(device)
+    model.eval()
+    if keep_warm:
+        _WARM_POOL[key] = (model, metadata)
+    return (model, metadata) if return_metadata else model
+
+
+class AsyncImageWriter(object):
+    """
+    Post-processes, encodes and writes batches of images on a pool of worker threads, so that sampling the next batch
+    overlaps with writing the previous one. Image encoding in PIL and cv2 releases the GIL.
+
+    :param num_workers: number of worker threads.
+    :param max_pending: maximum number of batches in flight, submit blocks while it is reached.
+    :param transform: called on every PIL image before it is saved.
+    :param batch_transform: called on the (b, h, w, c) uint8 stack of the images of a batch that are saved, e.g. a
+                            BatchWatermarker.
+    :param save_kwargs: passed to PIL.Image.save, the format follows from the extension of the path.
+    """
+    def __init__(self, num_workers=2, max_pending=4, transform=None, batch_transform=None, **save_kwargs):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = BoundedSemaphore(max_pending)
+        self.transform = transform
+        self.batch_transform = batch_transform
+        self.save_kwargs = save_kwargs
+        self.pending = list()
+
+    def submit(self, images, paths, postprocess=None):
+        """
+        :param images: (b, h, w, c) numpy array, uint8 or float in [0, 1].
+        :param paths: b output paths, images with path None are not written.
+        :param postprocess: called with images on the worker before writing, returns the images to write, e.g. the
+                            safety check.
+        :return: a future of the written images.
+        """
+        assert len(images) == len(paths), "need one path per image"
+        self.raise_errors()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.write, images, paths, postprocess)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.pending.append(future)
+        return future
+
+    def write(self, images, paths, postprocess=None):
+        if postprocess is not None:
+            images = postprocess(images)
+        keep = [i for i, path in enumerate(paths) if path is not None]
+        if len(keep) > 0:
+            out = np.asarray(images)[keep]
+            if out.dtype != np.uint8:
+                out = (255. * out).astype(np.uint8)
+            if self.batch_transform is not None:
+                out = self.batch_transform(out)
+            for image, i in zip(out, keep):
+                img = Image.fromarray(image)
+                if self.transform is not None:
+                    img = self.transform(img)
+                img.save(paths[i], **self.save_kwargs)
+        return images
+
+    def raise_errors(self):
+        """re-raise the first error of the batches written so far"""
+        done = [f for f in self.pending if f.done()]
+        self.pending = [f for f in self.pending if not f.done()]
+        for f in done:
+            f.result()
+
+    def flush(self):
+        """wait until all submitted batches are written"""
+        pending, self.pending = self.pending, list()
+        for f in pending:
+            f.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+
+
+# per process state of BatchWatermarker
+_WATERMARK_ENCODER = None
+_WATERMARK_BUFFERS = dict()
+
+
+def _init_watermark_worker(watermark):
+    global _WATERMARK_ENCODER
+    from imwatermark import WatermarkEncoder
+    _WATERMARK_ENCODER = WatermarkEncoder()
+    _WATERMARK_ENCODER.set_watermark('bytes', watermark.encode('utf-8'))
+
+
+def _put_watermark_batch(images):
+    # the BGR input of the encoder is written into one buffer per image shape instead of a new copy per image
+    buf = _WATERMARK_BUFFERS.get(images.shape[1:])
+    if buf is None:
+        buf = _WATERMARK_BUFFERS[images.shape[1:]] = np.empty(images.shape[1:], dtype=np.uint8)
+    for image in images:
+        np.copyto(buf, image[:, :, ::-1])
+        image[...] = _WATERMARK_ENCODER.encode(buf, 'dwtDct')[:, :, ::-1]
+    return images
+
+
+class BatchWatermarker(object):
+    """
+    Puts the invisible dwtDct watermark (see https://github.com/ShieldMnt/invisible-watermark) on stacks of uint8 RGB
+    images. The stack is split over a pool of worker processes, which keep their WatermarkEncoder and conversion
+    buffers across calls. The workers are spawned, not forked: the pool is usually created after cuda has been
+    initialized and threads (e.g. of the AsyncImageWriter) have been started, and a forked child would inherit
+    their state. The pool is started right away, so the import cost of the workers is paid up front.
+
+    :param watermark: the watermark string.
+    :param num_workers: number of worker processes, 0 to watermark in this process.
+    """
+    def __init__(self, watermark, num_workers=4):
+        self.num_workers = num_workers
+        self.pool = None
+        if num_workers > 0:
+            self.pool = ProcessPoolExecutor(num_workers, mp_context=mp.get_context("spawn"),
+                                            initializer=_init_watermark_worker, initargs=(watermark,))
+            self.pool.submit(int).result()
+        else:
+            _init_watermark_worker(watermark)
+
+    def __call__(self, images):
+        """
+        :param images: (b, h, w, 3) uint8 RGB array.
+        :return: the watermarked images.
+        """
+        images = np.ascontiguousarray(images)
+        if self.pool is None:
+            return _put_watermark_batch(images.copy())
+        chunks = np.array_split(images, min(len(images), self.num_workers))
+        return np.concatenate(list(self.pool.map(_put_watermark_batch, chunks)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
 def _do_parallel_data_prefetch(func, Q, data, idx, idx_to_fn=False):
     # create dummy dataset instance
 
@@ -0,0 +1,107 @@
+"""attention backends per module at stable diffusion shapes
+
+Runs every registered attention backend (see ldm.modules.attention.ATTENTION_BACKENDS) through the three attention
+implementations of the repo at the shapes they see in a 512 px stable diffusion run: CrossAttention self- and
+cross-attention of the UNet levels, the AttnBlock in the middle of the autoencoder and QKVAttention of the
+AttentionBlock of class conditional UNets. Reports the median time and the largest deviation from "naive".
+
+    python scripts/benchmarks/attention_backends.py --batch_size 2
+    python scripts/benchmarks/attention_backends.py --backends naive sdpa --H 768 --W 768
+"""
+
+import argparse
+import time
+
+import torch
+import numpy as np
+
+from ldm.modules.attention import ATTENTION_BACKENDS, CrossAttention, set_attention_backend
+from ldm.modules.diffusionmodules.model import AttnBlock
+from ldm.modules.diffusionmodules.openaimodel import AttentionBlock
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def measure(module, inputs, repeats):
+    device = inputs[0].device
+    timings = []
+    out = None
+    for _ in range(repeats + 1):
+        sync(device)
+        tic = time.perf_counter()
+        out = module(*inputs)
+        sync(device)
+        timings.append(time.perf_counter() - tic)
+    # the first run is warmup
+    return out, 1e3 * np.median(timings[1:])
+
+
+def cases(opt, device, dtype):
+    """(name, module, inputs) at the shapes of a H x W sample"""
+    h, w = opt.H // opt.f, opt.W // opt.f
+    b = opt.batch_size
+    randn = lambda *shape: torch.randn(*shape, device=device, dtype=dtype)
+    for level, ch in enumerate([320, 640, 1280]):
+        n = (h >> level) * (w >> level)
+        attn = CrossAttention(ch, heads=8, dim_head=ch // 8)
+        yield f"CrossAttention self {ch}ch {n}", attn, (randn(b, n, ch),)
+        attn = CrossAttention(ch, context_dim=opt.context_dim, heads=8, dim_head=ch // 8)
+        yield f"CrossAttention ctx {ch}ch {n}x77", attn, (randn(b, n, ch), randn(b, 77, opt.context_dim))
+    # the autoencoder attends over the latent resolution with 512 channels and a single head
+    yield f"AttnBlock 512ch {h * w}", AttnBlock(512), (randn(1, 512, h, w),)
+    for level, ch in enumerate([256, 512]):
+        hl, wl = (h >> (level + 1)), (w >> (level + 1))
+        for legacy in [True, False]:
+            attn = AttentionBlock(ch, num_head_channels=64, use_new_attention_order=not legacy)
+            yield f"QKVAttention{'Legacy' if legacy else ''} {ch}ch {hl * wl}", attn, (randn(b, ch, hl, wl),)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", type=str, nargs="+", default=list(ATTENTION_BACKENDS.keys()),
+                        help="backends to compare, the first one that is run is the reference")
+    parser.add_argument("--batch_size", type=int, default=2, help="2 for a single guided sample")
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor of the autoencoder")
+    parser.add_argument("--context_dim", type=int, default=768)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch cpu threads")
+    parser.add_argument("--half", action="store_true", help="run in float16")
+    parser.add_argument("--device", type=str, default="cpu")
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+    dtype = torch.float16 if opt.half else torch.float32
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+
+    backends = [name for name in opt.backends if name in ATTENTION_BACKENDS]
+    for name in set(opt.backends) - set(backends):
+        print(f"skipping backend '{name}', not available in torch {torch.__version__}")
+
+    print(f"{opt.H}x{opt.W}, batch size {opt.batch_size}, {dtype}, device {device}, "
+          f"{torch.get_num_threads()} threads")
+    print(f"{'module':<36} {'backend':<8} {'ms':>9} {'max abs diff':>13}")
+    for name, module, inputs in cases(opt, device, dtype):
+        module = module.to(device, dtype).eval()
+        ref = None
+        for backend in backends:
+            set_attention_backend(module, backend)
+            try:
+                out, ms = measure(module, inputs, opt.repeats)
+            except RuntimeError as e:
+                # out of memory, or a kernel missing for this dtype and device
+                print(f"{name:<36} {backend:<8} failed: {str(e).splitlines()[0]}")
+                continue
+            if ref is None:
+                ref = out
+            diff = (out.float() - ref.float()).abs().max().item()
+            print(f"{name:<36} {backend:<8} {ms:>9.2f} {diff:>13.2e}")
+
+
+if __name__ == "__main__":
+    main()
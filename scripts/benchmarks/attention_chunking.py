@@ -0,0 +1,83 @@
+"""naive vs. chunked self-attention of the first UNet level
+
+Runs the self-attention (attn1) of a BasicTransformerBlock of the first level of the stable diffusion UNet
+(320 channels, 8 heads) at the token counts of 256, 512 and 768 px images, with the full similarity matrix and with
+the query-chunked path, and reports time, peak memory (cuda only) and the largest deviation between both outputs.
+
+    python scripts/benchmarks/attention_chunking.py --batch_size 2 --chunk_size 1024
+"""
+
+import argparse
+import time
+
+import torch
+import numpy as np
+
+from ldm.modules.attention import CrossAttention
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def measure(attn, x, repeats):
+    device = x.device
+    timings = []
+    out = None
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    for _ in range(repeats + 1):
+        sync(device)
+        tic = time.perf_counter()
+        out = attn(x)
+        sync(device)
+        timings.append(time.perf_counter() - tic)
+    peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == "cuda" else float("nan")
+    # the first run is warmup
+    return out, 1e3 * np.median(timings[1:]), peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 768], help="image sizes in pixels")
+    parser.add_argument("--batch_size", type=int, default=2, help="2 for a single guided sample")
+    parser.add_argument("--channels", type=int, default=320)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor of the autoencoder")
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--half", action="store_true", help="run in float16")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+    dtype = torch.float16 if opt.half else torch.float32
+
+    attn = CrossAttention(opt.channels, heads=opt.heads, dim_head=opt.channels // opt.heads,
+                          chunk_size=opt.chunk_size)
+    attn = attn.to(device, dtype).eval()
+
+    print(f"batch size {opt.batch_size}, {opt.channels} channels, {opt.heads} heads, chunk size {opt.chunk_size}, "
+          f"{dtype}, device {device}")
+    print(f"{'px':>5} {'tokens':>7} {'path':<8} {'ms':>9} {'peak MiB':>9} {'max abs diff':>13}")
+    for px in opt.sizes:
+        n = (px // opt.f) ** 2
+        x = torch.randn(opt.batch_size, n, opt.channels, device=device, dtype=dtype)
+        results = dict()
+        for path, threshold in [("naive", n + 1), ("chunked", 0)]:
+            attn.chunk_threshold = threshold
+            try:
+                results[path] = measure(attn, x, opt.repeats)
+            except RuntimeError as e:
+                # out of memory
+                print(f"{px:>5} {n:>7} {path:<8} failed: {str(e).splitlines()[0]}")
+        for path, (out, ms, peak) in results.items():
+            diff = "" if len(results) < 2 else \
+                f"{(results['naive'][0].float() - results['chunked'][0].float()).abs().max().item():>13.2e}"
+            print(f"{px:>5} {n:>7} {path:<8} {ms:>9.2f} {peak:>9.1f} {diff}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""micro-benchmark of the per-step overhead of DDIMSampler.p_sample_ddim
+
+Times a sampling step once with a stub denoiser (sampler overhead only) and once with a UNet forward pass,
+for the precomputed coefficient and time tables and for the previous per-step torch.full path. Both variants
+share one prebuilt ClassifierFreeGuidance, so that only the per-step update differs.
+
+    python scripts/benchmarks/ddim_step_overhead.py --steps 50 --batch_size 1
+    python scripts/benchmarks/ddim_step_overhead.py --config configs/stable-diffusion/v1-inference.yaml
+"""
+
+import argparse
+import time
+
+import torch
+import numpy as np
+from omegaconf import OmegaConf
+
+from ldm.util import instantiate_from_config
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.sampling_util import ClassifierFreeGuidance
+from ldm.modules.diffusionmodules.util import make_beta_schedule, noise_like
+
+
+class StubModel(object):
+    """carries the diffusion schedule of LatentDiffusion and optionally a UNet to call in apply_model"""
+
+    def __init__(self, unet, device, linear_start=0.00085, linear_end=0.0120, timesteps=1000):
+        betas = make_beta_schedule("linear", timesteps, linear_start=linear_start, linear_end=linear_end)
+        alphas_cumprod = np.cumprod(1. - betas, axis=0)
+        to_torch = lambda x: torch.tensor(x, dtype=torch.float32, device=device)
+        self.betas = to_torch(betas)
+        self.alphas_cumprod = to_torch(alphas_cumprod)
+        self.alphas_cumprod_prev = to_torch(np.append(1., alphas_cumprod[:-1]))
+        self.num_timesteps = timesteps
+        self.parameterization = "eps"
+        self.device = torch.device(device)
+        self.unet = unet
+
+    def apply_model(self, x, t, c):
+        if self.unet is None:
+            return x
+        return self.unet(x, t, context=c)
+
+
+class LegacyDDIMSampler(DDIMSampler):
+    """the per-step update as it was before the coefficient table, for comparison"""
+
+    @torch.no_grad()
+    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
+                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance=None):
+        b, *_, device = *x.shape, x.device
+
+        if guidance is not None:
+            e_t = guidance(x, t)
+        elif unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            e_t = self.model.apply_model(x, t, c)
+        else:
+            x_in = torch.cat([x] * 2)
+            t_in = torch.cat([t] * 2)
+            c_in = torch.cat([unconditional_conditioning, c])
+            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+
+        a_t = torch.full((b, 1, 1, 1), self.ddim_alphas[index], device=device)
+        a_prev = torch.full((b, 1, 1, 1), self.ddim_alphas_prev[index], device=device)
+        sigma_t = torch.full((b, 1, 1, 1), self.ddim_sigmas[index], device=device)
+        sqrt_one_minus_at = torch.full((b, 1, 1, 1), self.ddim_sqrt_one_minus_alphas[index], device=device)
+
+        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
+        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        return x_prev, pred_x0
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def time_steps(sampler, opt, device):
+    sampler.make_schedule(ddim_num_steps=opt.steps, ddim_eta=opt.eta, verbose=False)
+    shape = (opt.batch_size, opt.C, opt.H // opt.f, opt.W // opt.f)
+    c = torch.randn(opt.batch_size, 77, opt.context_dim, device=device)
+    uc = torch.randn(opt.batch_size, 77, opt.context_dim, device=device)
+    time_range = np.flip(sampler.ddim_timesteps)
+    time_table = torch.tensor(np.ascontiguousarray(time_range), device=device, dtype=torch.long)
+    # built once per run, as ddim_sampling does
+    guidance = ClassifierFreeGuidance(sampler.model.apply_model, c, uc, opt.scale)
+    legacy = isinstance(sampler, LegacyDDIMSampler)
+
+    timings = []
+    for _ in range(opt.repeats + 1):
+        x = torch.randn(shape, device=device)
+        sync(device)
+        tic = time.perf_counter()
+        for i, step in enumerate(time_range):
+            index = opt.steps - i - 1
+            if legacy:
+                ts = torch.full((opt.batch_size,), step, device=device, dtype=torch.long)
+            else:
+                ts = time_table[i].expand(opt.batch_size)
+            x, _ = sampler.p_sample_ddim(x, c, ts, index=index, guidance=guidance)
+        sync(device)
+        timings.append((time.perf_counter() - tic) / opt.steps)
+    # the first run is warmup
+    return 1e3 * np.median(timings[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default=None,
+                        help="config whose model.params.unet_config is used for the model call (default: small UNet)")
+    parser.add_argument("--steps", type=int, default=50, help="number of ddim sampling steps")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--eta", type=float, default=0.0)
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--C", type=int, default=4)
+    parser.add_argument("--f", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+
+    if opt.config is not None:
+        unet_config = OmegaConf.load(opt.config).model.params.unet_config
+    else:
+        unet_config = OmegaConf.create({
+            "target": "ldm.modules.diffusionmodules.openaimodel.UNetModel",
+            "params": {"image_size": 32, "in_channels": opt.C, "out_channels": opt.C, "model_channels": 32,
+                       "attention_resolutions": [2], "num_res_blocks": 1, "channel_mult": [1, 2],
+                       "num_heads": 4, "use_spatial_transformer": True, "transformer_depth": 1,
+                       "context_dim": 768, "use_checkpoint": False, "legacy": False}})
+    opt.context_dim = unet_config.params.get("context_dim", 768)
+    unet = instantiate_from_config(unet_config).to(device).eval()
+
+    print(f"{opt.steps} steps, batch size {opt.batch_size}, {opt.H}x{opt.W}, scale {opt.scale}, device {device}")
+    print(f"{'sampler':<12} {'model call':<12} {'ms/step':>10}")
+    for name, sampler_cls in [("legacy", LegacyDDIMSampler), ("table", DDIMSampler)]:
+        for with_model in [False, True]:
+            sampler = sampler_cls(StubModel(unet if with_model else None, device))
+            ms = time_steps(sampler, opt, device)
+            print(f"{name:<12} {'yes' if with_model else 'no':<12} {ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
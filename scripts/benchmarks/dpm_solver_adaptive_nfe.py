@@ -0,0 +1,115 @@
+"""NFE vs. quality of the adaptive DPM-Solver
+
+Samples the same prompts and start codes with a 200 step DDIM reference, with the fixed step multistep
+DPM-Solver and with the adaptive DPM-Solver at several tolerances, and reports the number of function
+evaluations next to the difference of the decoded images from the reference (RMSE and PSNR in [0, 1] pixel space).
+
+    python scripts/benchmarks/dpm_solver_adaptive_nfe.py --ckpt models/ldm/stable-diffusion-v1/model.ckpt
+"""
+
+import argparse
+import time
+
+import torch
+import numpy as np
+from omegaconf import OmegaConf
+from torch import autocast
+from contextlib import nullcontext
+
+from ldm.util import load_model_from_config
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+
+
+DEFAULT_PROMPTS = ["a photograph of an astronaut riding a horse",
+                   "a painting of a virus monster playing guitar",
+                   "a watercolor painting of a lighthouse at dawn",
+                   "a close up photo of a red fox in the snow"]
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def run(model, sampler, opt, c, uc, x_T, **kwargs):
+    device = x_T.device
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    sync(device)
+    tic = time.perf_counter()
+    with precision_scope("cuda"):
+        samples, info = sampler.sample(conditioning=c, batch_size=x_T.shape[0], shape=list(x_T.shape[1:]),
+                                       verbose=False, unconditional_guidance_scale=opt.scale,
+                                       unconditional_conditioning=uc, x_T=x_T, **kwargs)
+        x = model.decode_first_stage(samples)
+    sync(device)
+    toc = time.perf_counter()
+    x = torch.clamp((x.float() + 1.0) / 2.0, min=0.0, max=1.0)
+    return x, info, toc - tic
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt")
+    parser.add_argument("--from-file", type=str, default=None, help="read the prompts from this file")
+    parser.add_argument("--ref_steps", type=int, default=200, help="steps of the ddim reference")
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 15, 20, 25, 50],
+                        help="step counts of the multistep dpm_solver")
+    parser.add_argument("--tolerances", type=str, nargs="+",
+                        default=["0.0078,0.05", "0.0078,0.1", "0.02,0.1", "0.05,0.2"],
+                        help="atol,rtol pairs of the adaptive dpm_solver")
+    parser.add_argument("--orders", type=int, nargs="+", default=[2, 3], help="orders of the adaptive dpm_solver")
+    parser.add_argument("--scale", type=float, default=7.5, help="unconditional guidance scale")
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--C", type=int, default=4)
+    parser.add_argument("--f", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+
+    prompts = DEFAULT_PROMPTS
+    if opt.from_file is not None:
+        with open(opt.from_file, "r") as f:
+            prompts = [p for p in f.read().splitlines() if p]
+
+    model = load_model_from_config(OmegaConf.load(opt.config), opt.ckpt, device=device)
+    ddim = DDIMSampler(model)
+    dpm = DPMSolverSampler(model)
+
+    with torch.no_grad():
+        c = model.get_learned_conditioning(prompts)
+        uc = model.get_learned_conditioning(len(prompts) * [""])
+    generator = torch.Generator().manual_seed(opt.seed)
+    x_T = torch.randn([len(prompts), opt.C, opt.H // opt.f, opt.W // opt.f], generator=generator).to(device)
+
+    ref, _, ref_time = run(model, ddim, opt, c, uc, x_T, S=opt.ref_steps, eta=0.)
+    print(f"{len(prompts)} prompts, {opt.H}x{opt.W}, scale {opt.scale}, reference: ddim {opt.ref_steps} steps "
+          f"({ref_time:.1f} s)")
+    print(f"{'solver':<36} {'NFE mean':>9} {'NFE min/max':>12} {'time s':>8} {'RMSE':>8} {'PSNR dB':>8}")
+
+    def report(name, x, nfe, seconds):
+        mse = ((x - ref) ** 2).flatten(1).mean(dim=1)
+        rmse = mse.sqrt().mean().item()
+        psnr = (-10. * torch.log10(mse.clamp(min=1e-10))).mean().item()
+        print(f"{name:<36} {np.mean(nfe):>9.1f} {f'{min(nfe)}/{max(nfe)}':>12} {seconds:>8.2f} {rmse:>8.4f} "
+              f"{psnr:>8.2f}")
+
+    for S in opt.steps:
+        x, info, seconds = run(model, dpm, opt, c, uc, x_T, S=S, method="multistep", order=2)
+        report(f"multistep order 2, {S} steps", x, info["nfe"], seconds)
+
+    for order in opt.orders:
+        for tol in opt.tolerances:
+            atol, rtol = map(float, tol.split(","))
+            x, info, seconds = run(model, dpm, opt, c, uc, x_T, S=0, method="adaptive", order=order, atol=atol,
+                                   rtol=rtol)
+            report(f"adaptive order {order}, atol {atol}, rtol {rtol}", x, info["nfe"], seconds)
+
+
+if __name__ == "__main__":
+    main()
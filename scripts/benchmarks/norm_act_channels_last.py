@@ -0,0 +1,116 @@
+"""channels_last and fused GroupNorm + SiLU on stable diffusion block shapes
+
+Runs the ResBlocks of the stable diffusion UNet levels and the ResnetBlocks of the autoencoder decoder at the shapes
+of a 512 px sample, as they are, with fused GroupNorm + SiLU, in channels_last and with both (see
+ldm.modules.diffusionmodules.util.optimize_for_inference), and reports the median time and the largest deviation
+from the unmodified block. A second table times the norm + activation alone and reports its effective bandwidth,
+counting one read of the input and one write of the output.
+
+    python scripts/benchmarks/norm_act_channels_last.py --threads 8
+    python scripts/benchmarks/norm_act_channels_last.py --blocks unet --batch_size 2
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+import numpy as np
+
+from ldm.modules.diffusionmodules.openaimodel import ResBlock
+from ldm.modules.diffusionmodules.model import ResnetBlock, nonlinearity
+from ldm.modules.diffusionmodules.util import GroupNormSiLU, GroupNorm32, optimize_for_inference
+
+
+MODES = {"default": dict(channels_last=False, fuse_norm_act=False),
+         "fused": dict(channels_last=False, fuse_norm_act=True),
+         "channels_last": dict(channels_last=True, fuse_norm_act=False),
+         "fused+cl": dict(channels_last=True, fuse_norm_act=True)}
+
+
+@torch.no_grad()
+def measure(fn, inputs, repeats):
+    timings = []
+    out = None
+    for _ in range(repeats + 1):
+        tic = time.perf_counter()
+        out = fn(*inputs)
+        timings.append(time.perf_counter() - tic)
+    # the first run is warmup
+    return out, 1e3 * np.median(timings[1:])
+
+
+def cases(opt):
+    """(name, block, x, emb) at the shapes of a H x W sample"""
+    h, w = opt.H // opt.f, opt.W // opt.f
+    if "unet" in opt.blocks:
+        # the first ResBlock of every UNet level, and the one at the lowest resolution
+        for level, (c_in, c_out) in enumerate([(320, 320), (320, 640), (640, 1280), (1280, 1280)]):
+            hl, wl = h >> level, w >> level
+            block = ResBlock(c_in, 1280, dropout=0., out_channels=c_out)
+            # the output convolution is zero initialized, which would hide any deviation of the out layers
+            torch.nn.init.normal_(block.out_layers[-1].weight, std=0.02)
+            yield f"ResBlock {c_in}->{c_out} {hl}x{wl}", block, \
+                torch.randn(opt.batch_size, c_in, hl, wl), torch.randn(opt.batch_size, 1280)
+    if "decoder" in opt.blocks:
+        # the ResnetBlocks of the decoder levels, from the latent resolution up
+        for level, (c_in, c_out) in enumerate([(512, 512), (512, 512), (512, 256), (256, 128)]):
+            hl, wl = h << level, w << level
+            block = ResnetBlock(in_channels=c_in, out_channels=c_out, temb_channels=0, dropout=0.)
+            yield f"ResnetBlock {c_in}->{c_out} {hl}x{wl}", block, torch.randn(1, c_in, hl, wl), None
+
+
+def run_block(block, x, emb):
+    return block(x, emb)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=str, nargs="+", choices=["unet", "decoder"], default=["unet", "decoder"])
+    parser.add_argument("--batch_size", type=int, default=2, help="batch size of the unet blocks, 2 for a single "
+                                                                  "guided sample")
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor of the autoencoder")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None, help="torch cpu threads")
+    opt = parser.parse_args()
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(0)
+
+    print(f"{opt.H}x{opt.W}, cpu, {torch.get_num_threads()} threads, torch {torch.__version__}")
+    print(f"{'block':<32} {'mode':<14} {'ms':>9} {'speedup':>8} {'max abs diff':>13}")
+    norm_shapes = list()
+    for name, block, x, emb in cases(opt):
+        block = block.eval()
+        ref, base = None, None
+        for mode, kwargs in MODES.items():
+            b = optimize_for_inference(copy.deepcopy(block), **kwargs)
+            inp = x.contiguous(memory_format=torch.channels_last) if kwargs["channels_last"] else x
+            out, ms = measure(run_block, (b, inp, emb), opt.repeats)
+            if ref is None:
+                ref, base = out, ms
+            diff = (out - ref).abs().max().item()
+            print(f"{name:<32} {mode:<14} {ms:>9.2f} {base / ms:>8.2f} {diff:>13.2e}")
+        norm_shapes.append((name, isinstance(block, ResBlock), x.shape))
+
+    print()
+    print(f"{'norm + act of':<32} {'mode':<14} {'ms':>9} {'GB/s':>8}")
+    for name, upcast, shape in norm_shapes:
+        x = torch.randn(shape)
+        norm = (GroupNorm32 if upcast else torch.nn.GroupNorm)(32, shape[1])
+        fused = GroupNormSiLU(norm)
+        # the silu of the unet is torch.nn.SiLU, the nonlinearity of the autoencoder is x * sigmoid(x)
+        act = torch.nn.functional.silu if upcast else nonlinearity
+        gigabytes = 2 * x.numel() * x.element_size() / 1e9
+        for mode, fn, inp in [("default", lambda x: act(norm(x)), x),
+                              ("fused", fused, x),
+                              ("channels_last", lambda x: act(norm(x)), x.contiguous(memory_format=torch.channels_last)),
+                              ("fused+cl", fused, x.contiguous(memory_format=torch.channels_last))]:
+            _, ms = measure(fn, (inp,), opt.repeats)
+            print(f"{name:<32} {mode:<14} {ms:>9.2f} {gigabytes / (ms / 1e3):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
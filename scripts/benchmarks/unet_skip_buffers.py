@@ -0,0 +1,202 @@
+"""UNetModel forward with th.cat skip connections against preallocated skip buffers
+
+Runs the unet of a config (stable diffusion v1 by default, with random weights) with the skip connections
+concatenated by th.cat, as forward does by default, and with UNetModel.enable_skip_buffers, and reports the median
+time, the largest deviation of the output and the peak activation memory of every resolution level of the unet.
+The peak is counted from the activations the forward pass holds at the block boundaries: the skip connections (or
+their buffers), the block output and, for th.cat, the concatenated copy. On cuda, the peak allocated memory
+measured during the blocks of each level, intermediate activations of the blocks included, is reported as well.
+
+    python scripts/benchmarks/unet_skip_buffers.py --batch_size 2 --H 512 --W 512
+    python scripts/benchmarks/unet_skip_buffers.py --precision full --repeats 10
+"""
+
+import argparse
+import time
+
+import torch
+import numpy as np
+from omegaconf import OmegaConf
+from torch import autocast
+from contextlib import nullcontext
+
+from ldm.util import instantiate_from_config
+from ldm.modules.attention import SpatialTransformer
+from ldm.modules.diffusionmodules.openaimodel import ResBlock
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def blocks(unet):
+    """(kind, index, block) of the input, middle and output blocks in the order forward runs them"""
+    for i, module in enumerate(unet.input_blocks):
+        yield "input", i, module
+    yield "middle", 0, unet.middle_block
+    for j, module in enumerate(unet.output_blocks):
+        yield "output", j, module
+
+
+@torch.no_grad()
+def block_records(unet, inputs, precision_scope):
+    """the input resolution and the input and output bytes of every block of the default forward"""
+    records = list()
+
+    def hook(kind, index):
+        def fn(module, args, output):
+            records.append(dict(kind=kind, index=index, res=tuple(args[0].shape[2:]),
+                                inp=args[0].numel() * args[0].element_size(),
+                                out=output.numel() * output.element_size(),
+                                # the last layer of the block writes its output into the buffer or is copied
+                                copies=not isinstance(module[-1], (ResBlock, SpatialTransformer))))
+        return fn
+
+    handles = [module.register_forward_hook(hook(kind, index)) for kind, index, module in blocks(unet)]
+    with precision_scope("cuda"):
+        unet(*inputs)
+    for handle in handles:
+        handle.remove()
+    return records
+
+
+def default_peaks(records):
+    """bytes held at each block: the skip connections in hs, the concatenated copy of h and skip, the output"""
+    hs, peaks = list(), list()
+    for r in records:
+        if r["kind"] == "output":
+            skip = hs.pop()
+            h = r["inp"] - skip
+            # th.cat allocates the concatenation while h and the skip are alive
+            peaks.append(max(sum(hs) + h + skip + r["inp"], sum(hs) + r["inp"] + r["out"]))
+        else:
+            peaks.append(sum(hs) + r["out"])
+            if r["kind"] == "input":
+                hs.append(r["out"])
+    return peaks
+
+
+def buffer_peaks(records):
+    """bytes held at each block with SkipBuffers: the allocated buffers and the outputs that are copied into them"""
+    n = sum(r["kind"] == "output" for r in records)
+    sizes = [r["inp"] for r in records if r["kind"] == "output"]
+    buffers, peaks = dict(), list()
+    for r in records:
+        if r["kind"] == "input":
+            buffers[n - 1 - r["index"]] = sizes[n - 1 - r["index"]]
+        last = r["kind"] == "output" and r["index"] == n - 1
+        peaks.append(sum(buffers.values()) + (r["out"] if r["copies"] or last else 0))
+        if r["kind"] == "output":
+            del buffers[r["index"]]
+    return peaks
+
+
+@torch.no_grad()
+def cuda_peaks(unet, inputs, precision_scope, device):
+    """
+    peak allocated bytes from the end of the previous block to the end of every block, th.cat included, above the
+    memory allocated before the forward pass (weights and inputs)
+    """
+    peaks = list()
+    start = torch.cuda.memory_allocated(device)
+
+    def hook(module, args, output):
+        peaks.append(torch.cuda.max_memory_allocated(device) - start)
+        torch.cuda.reset_peak_memory_stats(device)
+
+    handles = [module.register_forward_hook(hook) for _, _, module in blocks(unet)]
+    with precision_scope("cuda"):
+        sync(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        unet(*inputs)
+    for handle in handles:
+        handle.remove()
+    return peaks
+
+
+def per_level(records, peaks):
+    levels = dict()
+    for r, peak in zip(records, peaks):
+        levels[r["res"]] = max(levels.get(r["res"], 0), peak)
+    return levels
+
+
+@torch.no_grad()
+def measure(unet, inputs, precision_scope, repeats, device):
+    timings = []
+    out = None
+    with precision_scope("cuda"):
+        for _ in range(repeats + 1):
+            sync(device)
+            tic = time.perf_counter()
+            out = unet(*inputs)
+            sync(device)
+            timings.append(time.perf_counter() - tic)
+    # the first run is warmup
+    return out.float(), 1e3 * np.median(timings[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="config whose model.params.unet_config is benchmarked")
+    parser.add_argument("--batch_size", type=int, default=2, help="2 for a single guided sample")
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor of the autoencoder")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast",
+                        help="autocast applies on cuda only")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    opt = parser.parse_args()
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+
+    unet_config = OmegaConf.load(opt.config).model.params.unet_config
+    unet = instantiate_from_config(unet_config).to(device).eval()
+    # the zero initialized output convolutions would hide any deviation of the blocks
+    for p in unet.parameters():
+        if p.dim() > 1 and not p.any():
+            torch.nn.init.normal_(p, std=0.02)
+
+    c = unet_config.params.in_channels
+    x = torch.randn(opt.batch_size, c, opt.H // opt.f, opt.W // opt.f, device=device)
+    t = torch.randint(0, 1000, (opt.batch_size,), device=device)
+    context_dim = unet_config.params.get("context_dim", None)
+    context = torch.randn(opt.batch_size, 77, context_dim, device=device) if context_dim is not None else None
+    inputs = (x, t, context)
+    autocasting = opt.precision == "autocast" and device.type == "cuda"
+    precision_scope = autocast if autocasting else nullcontext
+
+    print(f"batch size {opt.batch_size}, {opt.H}x{opt.W}, {device}, {'autocast' if autocasting else 'full'}")
+    print(f"{'forward':<14} {'ms':>9} {'speedup':>8} {'max abs diff':>13}")
+    outputs, peaks, base = dict(), dict(), None
+    for name, enabled in [("th.cat", False), ("skip buffers", True)]:
+        unet.enable_skip_buffers(enabled)
+        out, ms = measure(unet, inputs, precision_scope, opt.repeats, device)
+        outputs[name] = out
+        base = base or ms
+        diff = (out - outputs["th.cat"]).abs().max().item()
+        print(f"{name:<14} {ms:>9.2f} {base / ms:>8.2f} {diff:>13.2e}")
+        if device.type == "cuda":
+            peaks[name] = cuda_peaks(unet, inputs, precision_scope, device)
+
+    unet.enable_skip_buffers(False)
+    records = block_records(unet, inputs, precision_scope)
+    held = {"th.cat": per_level(records, default_peaks(records)),
+            "skip buffers": per_level(records, buffer_peaks(records))}
+    measured = {name: per_level(records, p) for name, p in peaks.items()}
+
+    print()
+    columns = [("held", name, levels) for name, levels in held.items()] + \
+              [("cuda", name, levels) for name, levels in measured.items()]
+    print(f"{'level':<10} " + " ".join(f"{f'{kind} {name} MiB':>22}" for kind, name, _ in columns))
+    for res in held["th.cat"]:
+        print(f"{'x'.join(map(str, res)):<10} " +
+              " ".join(f"{levels[res] / 2**20:>22.1f}" for _, _, levels in columns))
+    print(f"{'all':<10} " + " ".join(f"{max(levels.values()) / 2**20:>22.1f}" for _, _, levels in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""invisible watermark throughput
+
+Times the per-image put_watermark txt2img used before BatchWatermarker (PIL -> numpy -> BGR -> dwtDct -> PIL)
+against BatchWatermarker on a stacked uint8 batch, in process and with a pool of worker processes, and reports ms
+per image at 512 and 768 px.
+
+    python scripts/benchmarks/watermark.py --batch_size 8 --workers 0 2 4 8
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+from imwatermark import WatermarkEncoder
+
+from ldm.util import BatchWatermarker
+
+
+WATERMARK = "StableDiffusionV1"
+
+
+def put_watermark(img, wm_encoder):
+    """as in scripts/txt2img.py before BatchWatermarker"""
+    img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+    img = wm_encoder.encode(img, 'dwtDct')
+    return Image.fromarray(img[:, :, ::-1])
+
+
+def per_image(images):
+    wm_encoder = WatermarkEncoder()
+    wm_encoder.set_watermark('bytes', WATERMARK.encode('utf-8'))
+
+    def run():
+        return [put_watermark(Image.fromarray(x), wm_encoder) for x in images]
+    return run
+
+
+def measure(fn, repeats):
+    timings = []
+    for _ in range(repeats + 1):
+        tic = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - tic)
+    # the first run is warmup
+    return np.median(timings[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 768], help="image sizes in pixels")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4], help="worker processes to compare")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(opt.seed)
+    watermarkers = {n: BatchWatermarker(WATERMARK, n) for n in opt.workers}
+
+    print(f"batch size {opt.batch_size}")
+    print(f"{'px':>5} {'path':<16} {'ms/image':>9} {'speedup':>8}")
+    for px in opt.sizes:
+        images = rng.randint(0, 256, size=(opt.batch_size, px, px, 3), dtype=np.uint8)
+        base = measure(per_image(images), opt.repeats) / opt.batch_size
+        print(f"{px:>5} {'per image':<16} {1e3 * base:>9.2f} {1.:>8.2f}")
+        for n, watermarker in watermarkers.items():
+            seconds = measure(lambda: watermarker(images), opt.repeats) / opt.batch_size
+            print(f"{px:>5} {f'batched, {n} proc':<16} {1e3 * seconds:>9.2f} {base / seconds:>8.2f}")
+
+    for watermarker in watermarkers.values():
+        watermarker.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""decode the latents of txt2img --latents_only
+
+Reads a LatentStore (see ldm/latent_store.py), decodes the latents in batches with the first stage model, runs the
+safety checker and the watermark on them and writes the images, optionally downscaled to thumbnails. The safety
+checker and the watermark see the full resolution images, the watermark cannot be put on images smaller than 256 px.
+Latents whose image already exists are skipped, so the script can be rerun while txt2img is still appending to the
+store.
+
+    python scripts/txt2img.py --from-file prompts.txt --latents_only --outdir outputs/run
+    python scripts/decode_latents.py --store outputs/run/latents --outdir outputs/run/samples --batch_size 16
+    python scripts/decode_latents.py --store outputs/run/latents --outdir outputs/run/thumbs --thumbnail 128
+"""
+
+import argparse, os
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from PIL import Image
+from tqdm import tqdm
+from torch import autocast
+from contextlib import nullcontext
+
+from ldm.util import load_model_from_config, AsyncImageWriter, BatchWatermarker
+from ldm.latent_store import LatentStore
+
+# the safety and watermarking helpers are shared with the txt2img script
+from txt2img import check_safety, safety_preprocess
+
+
+def thumbnail(size):
+    """downscale a PIL image such that its longer side has size pixels"""
+    def transform(img):
+        factor = size / max(img.size)
+        return img.resize((round(factor * img.width), round(factor * img.height)), Image.BICUBIC)
+    return transform
+
+
+def check_writer(writer, height, width):
+    """
+    Run the watermark and the thumbnail transform of writer on a blank image of the decoded size, so that settings
+    they cannot handle fail before the model is loaded instead of on the writer threads.
+    """
+    images = np.zeros((1, height, width, 3), dtype=np.uint8)
+    if writer.batch_transform is not None:
+        images = writer.batch_transform(images)
+    if writer.transform is not None:
+        writer.transform(Image.fromarray(images[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True, help="the latents directory written by txt2img")
+    parser.add_argument("--outdir", type=str, default=None, help="dir to write images to, default: next to --store")
+    parser.add_argument("--batch_size", type=int, default=8, help="latents per decoder call")
+    parser.add_argument("--thumbnail", type=int, default=0,
+                        help="downscale the images such that their longer side has this many pixels, 0 for full size")
+    parser.add_argument("--image_format", type=str, choices=["png", "webp", "jpg"], default="png")
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt",
+                        help="path to checkpoint of model")
+    parser.add_argument("--mmap", action='store_true',
+                        help="load the checkpoint through a memory-mappable copy, written once next to it or to "
+                             "--mmap_dir")
+    parser.add_argument("--mmap_dir", type=str, default=None,
+                        help="directory for the memory-mappable copy of the checkpoint")
+    parser.add_argument("--precision", type=str, help="evaluate at this precision", choices=["full", "autocast"],
+                        default="autocast")
+    parser.add_argument("--vae_tiling", action='store_true',
+                        help="decode in overlapping tiles, for latents too large to decode at once")
+    parser.add_argument("--writer_workers", type=int, default=2,
+                        help="number of threads that encode and write images while decoding continues")
+    parser.add_argument("--watermark_workers", type=int, default=4,
+                        help="number of processes that put the invisible watermark, 0 to watermark on the writer "
+                             "threads")
+    opt = parser.parse_args()
+    outpath = opt.outdir or os.path.join(os.path.dirname(os.path.normpath(opt.store)), "decoded")
+    os.makedirs(outpath, exist_ok=True)
+
+    store = LatentStore(opt.store)
+    done = set(os.listdir(outpath))
+    name = lambda e: f"{e['name'] if 'name' in e else format(e['id'], '08')}.{opt.image_format}"
+    todo = [e for e in store.entries if name(e) not in done]
+    print(f"{len(store)} latents in {opt.store}, {len(todo)} to decode")
+    if len(todo) == 0:
+        return
+
+    config = OmegaConf.load(f"{opt.config}")
+    wm = "StableDiffusionV1"
+    watermarker = BatchWatermarker(wm, opt.watermark_workers)
+    # the writer watermarks the full resolution images and downscales them afterwards
+    writer = AsyncImageWriter(opt.writer_workers, batch_transform=watermarker,
+                              transform=thumbnail(opt.thumbnail) if opt.thumbnail > 0 else None)
+    f = 2 ** (len(config.model.params.first_stage_config.params.ddconfig.ch_mult) - 1)
+    for shape in sorted(set(tuple(e["shape"]) for e in todo)):
+        check_writer(writer, f * shape[1], f * shape[2])
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = load_model_from_config(config, f"{opt.ckpt}", device=device, use_mmap=opt.mmap,
+                                   mmap_dir=opt.mmap_dir)
+    if opt.vae_tiling:
+        model.enable_first_stage_tiling()
+
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    with torch.no_grad(), precision_scope("cuda"):
+        for entries, latents in tqdm(store.batches(opt.batch_size, todo), total=-(-len(todo) // opt.batch_size),
+                                     desc="Decoding"):
+            z = torch.from_numpy(latents).to(device, torch.float32)
+            x = model.decode_first_stage(z)
+            x = torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)
+            clip_input = safety_preprocess(x)
+            x = x.cpu().permute(0, 2, 3, 1).numpy()
+
+            paths = [os.path.join(outpath, name(e)) for e in entries]
+            writer.submit(x, paths, postprocess=lambda x, clip_input=clip_input: check_safety(x, clip_input)[0])
+
+    writer.close()
+    watermarker.close()
+    store.close()
+    print(f"Your samples are ready and waiting for you here: \n{outpath} \n")
+
+
+if __name__ == "__main__":
+    main()
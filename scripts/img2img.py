@@ -15,7 +15,7 @@ from contextlib import nullcontext
 import time
 from pytorch_lightning import seed_everything
 
-from ldm.util import instantiate_from_config
+from ldm.util import load_model_from_config, AsyncImageWriter
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 
@@ -25,26 +25,6 @@ def chunk(it, size):
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-def load_model_from_config(config, ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
-        print(m)
-    if len(u) > 0 and verbose:
-        print("unexpected keys:")
-        print(u)
-
-    model.cuda()
-    model.eval()
-    return model
-
-
 def load_img(path):
     image = Image.open(path).convert("RGB")
     w, h = image.size
@@ -162,6 +142,14 @@ def main():
         default=0.75,
         help="strength for noising/unnoising. 1.0 corresponds to full destruction of information in init image",
     )
+    parser.add_argument(
+        "--guidance_policy",
+        type=str,
+        choices=["batched", "sequential"],
+        default="batched",
+        help="evaluate the unconditional and conditional predictions in one doubled batch or one after the other "
+             "(lower peak memory)",
+    )
     parser.add_argument(
         "--from-file",
         type=str,
@@ -179,6 +167,17 @@ def main():
         default="models/ldm/stable-diffusion-v1/model.ckpt",
         help="path to checkpoint of model",
     )
+    parser.add_argument(
+        "--mmap",
+        action='store_true',
+        help="load the checkpoint through a memory-mappable copy, written once next to it or to --mmap_dir",
+    )
+    parser.add_argument(
+        "--mmap_dir",
+        type=str,
+        default=None,
+        help="directory for the memory-mappable copy of the checkpoint",
+    )
     parser.add_argument(
         "--seed",
         type=int,
@@ -192,15 +191,50 @@ def main():
         choices=["full", "autocast"],
         default="autocast"
     )
+    parser.add_argument(
+        "--vae_tiling",
+        action='store_true',
+        help="encode and decode with the autoencoder in overlapping tiles, for high resolutions",
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=64,
+        help="tile size of --vae_tiling in latent pixels",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="minimum overlap of neighbouring tiles of --vae_tiling in latent pixels",
+    )
+    parser.add_argument(
+        "--vae_tiling_sequential",
+        action='store_true',
+        help="run the autoencoder on one tile at a time instead of all tiles as one batch, lowers peak memory",
+    )
+    parser.add_argument(
+        "--image_format",
+        type=str,
+        choices=["png", "webp"],
+        default="png",
+        help="file format of the samples and grids",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="number of threads that encode and write images while sampling continues",
+    )
 
     opt = parser.parse_args()
     seed_everything(opt.seed)
 
     config = OmegaConf.load(f"{opt.config}")
-    model = load_model_from_config(config, f"{opt.ckpt}")
-
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = model.to(device)
+    model = load_model_from_config(config, f"{opt.ckpt}", device=device, use_mmap=opt.mmap, mmap_dir=opt.mmap_dir)
+    if opt.vae_tiling:
+        model.enable_first_stage_tiling(opt.vae_tile_size, opt.vae_tile_overlap, sequential=opt.vae_tiling_sequential)
 
     if opt.plms:
         raise NotImplementedError("PLMS sampler not (yet) supported")
@@ -224,6 +258,7 @@ def main():
             data = f.read().splitlines()
             data = list(chunk(data, batch_size))
 
+    writer = AsyncImageWriter(opt.writer_workers)
     sample_path = os.path.join(outpath, "samples")
     os.makedirs(sample_path, exist_ok=True)
     base_count = len(os.listdir(sample_path))
@@ -259,17 +294,17 @@ def main():
                         z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]*batch_size).to(device))
                         # decode it
                         samples = sampler.decode(z_enc, c, t_enc, unconditional_guidance_scale=opt.scale,
-                                                 unconditional_conditioning=uc,)
+                                                 unconditional_conditioning=uc,
+                                                 guidance_policy=opt.guidance_policy)
 
                         x_samples = model.decode_first_stage(samples)
                         x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
 
                         if not opt.skip_save:
-                            for x_sample in x_samples:
-                                x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                                Image.fromarray(x_sample.astype(np.uint8)).save(
-                                    os.path.join(sample_path, f"{base_count:05}.png"))
-                                base_count += 1
+                            paths = [os.path.join(sample_path, f"{base_count + i:05}.{opt.image_format}")
+                                     for i in range(len(x_samples))]
+                            writer.submit(rearrange(x_samples.cpu().numpy(), 'b c h w -> b h w c'), paths)
+                            base_count += len(paths)
                         all_samples.append(x_samples)
 
                 if not opt.skip_grid:
@@ -280,11 +315,17 @@ def main():
 
                     # to image
                     grid = 255. * rearrange(grid, 'c h w -> h w c').cpu().numpy()
-                    Image.fromarray(grid.astype(np.uint8)).save(os.path.join(outpath, f'grid-{grid_count:04}.png'))
+                    writer.submit(grid.astype(np.uint8)[None],
+                                  [os.path.join(outpath, f'grid-{grid_count:04}.{opt.image_format}')])
                     grid_count += 1
 
+                writer.close()
                 toc = time.time()
 
+    if hasattr(model, "cond_cache"):
+        info = model.cond_cache.info()
+        print(f"Conditioning cache: {info.hits} hits, {info.misses} misses, {info.entries} entries "
+              f"({info.nbytes / 2**20:.1f} MiB)")
     print(f"Your samples are ready and waiting for you here: \n{outpath} \n"
           f" \nEnjoy.")
 
@@ -4,7 +4,6 @@ import torch
 import torch.nn as nn
 import numpy as np
 from omegaconf import OmegaConf
-from PIL import Image
 from tqdm import tqdm, trange
 from itertools import islice
 from einops import rearrange, repeat
@@ -13,7 +12,7 @@ import scann
 import time
 from multiprocessing import cpu_count
 
-from ldm.util import instantiate_from_config, parallel_data_prefetch
+from ldm.util import load_model_from_config, parallel_data_prefetch, AsyncImageWriter
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.modules.encoders.modules import FrozenClipImageEmbedder, FrozenCLIPTextEmbedder
@@ -38,26 +37,6 @@ def chunk(it, size):
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-def load_model_from_config(config, ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
-        print(m)
-    if len(u) > 0 and verbose:
-        print("unexpected keys:")
-        print(u)
-
-    model.cuda()
-    model.eval()
-    return model
-
-
 class Searcher(object):
     def __init__(self, database, retriever_version='ViT-L/14'):
         assert database in DATABASES
@@ -277,6 +256,17 @@ if __name__ == "__main__":
         default="models/rdm/rdm768x768/model.ckpt",
         help="path to checkpoint of model",
     )
+    parser.add_argument(
+        "--mmap",
+        action='store_true',
+        help="load the checkpoint through a memory-mappable copy, written once next to it or to --mmap_dir",
+    )
+    parser.add_argument(
+        "--mmap_dir",
+        type=str,
+        default=None,
+        help="directory for the memory-mappable copy of the checkpoint",
+    )
 
     parser.add_argument(
         "--clip_type",
@@ -303,14 +293,25 @@ if __name__ == "__main__":
         type=int,
         help="The number of included neighbors, only applied when --use_neighbors=True",
     )
+    parser.add_argument(
+        "--image_format",
+        type=str,
+        choices=["png", "webp"],
+        default="png",
+        help="file format of the samples and grids",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="number of threads that encode and write images while sampling continues",
+    )
 
     opt = parser.parse_args()
 
     config = OmegaConf.load(f"{opt.config}")
-    model = load_model_from_config(config, f"{opt.ckpt}")
-
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = model.to(device)
+    model = load_model_from_config(config, f"{opt.ckpt}", device=device, use_mmap=opt.mmap, mmap_dir=opt.mmap_dir)
 
     clip_text_encoder = FrozenCLIPTextEmbedder(opt.clip_type).to(device)
 
@@ -335,6 +336,7 @@ if __name__ == "__main__":
             data = f.read().splitlines()
             data = list(chunk(data, batch_size))
 
+    writer = AsyncImageWriter(opt.writer_workers)
     sample_path = os.path.join(outpath, "samples")
     os.makedirs(sample_path, exist_ok=True)
     base_count = len(os.listdir(sample_path))
@@ -377,11 +379,10 @@ if __name__ == "__main__":
                     x_samples_ddim = model.decode_first_stage(samples_ddim)
                     x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
 
-                    for x_sample in x_samples_ddim:
-                        x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                        Image.fromarray(x_sample.astype(np.uint8)).save(
-                            os.path.join(sample_path, f"{base_count:05}.png"))
-                        base_count += 1
+                    paths = [os.path.join(sample_path, f"{base_count + i:05}.{opt.image_format}")
+                             for i in range(len(x_samples_ddim))]
+                    writer.submit(rearrange(x_samples_ddim.cpu().numpy(), 'b c h w -> b h w c'), paths)
+                    base_count += len(paths)
                     all_samples.append(x_samples_ddim)
 
                 if not opt.skip_grid:
@@ -392,7 +393,9 @@ if __name__ == "__main__":
 
                     # to image
                     grid = 255. * rearrange(grid, 'c h w -> h w c').cpu().numpy()
-                    Image.fromarray(grid.astype(np.uint8)).save(os.path.join(outpath, f'grid-{grid_count:04}.png'))
+                    writer.submit(grid.astype(np.uint8)[None],
+                                  [os.path.join(outpath, f'grid-{grid_count:04}.{opt.image_format}')])
                     grid_count += 1
 
+    writer.close()
     print(f"Your samples are ready and waiting for you here: \n{outpath} \nEnjoy.")
@@ -8,7 +8,7 @@ from omegaconf import OmegaConf
 from PIL import Image
 
 from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.util import instantiate_from_config
+from ldm.util import instantiate_from_config, load_model_from_config, AsyncImageWriter
 
 rescale = lambda x: (x + 1.) / 2.
 
@@ -117,17 +117,19 @@ def run(model, logdir, batch_size=50, vanilla=False, custom_steps=None, eta=None
     # path = logdir
     if model.cond_stage_model is None:
         all_images = []
+        writer = AsyncImageWriter()
 
         print(f"Running unconditional sampling for {n_samples} samples")
         for _ in trange(n_samples // batch_size, desc="Sampling Batches (unconditional)"):
             logs = make_convolutional_sample(model, batch_size=batch_size,
                                              vanilla=vanilla, custom_steps=custom_steps,
                                              eta=eta)
-            n_saved = save_logs(logs, logdir, n_saved=n_saved, key="sample")
+            n_saved = save_logs(logs, logdir, n_saved=n_saved, key="sample", writer=writer)
             all_images.extend([custom_to_np(logs["sample"])])
             if n_saved >= n_samples:
                 print(f'Finish after generating {n_saved} samples')
                 break
+        writer.close()
         all_img = np.concatenate(all_images, axis=0)
         all_img = all_img[:n_samples]
         shape_str = "x".join([str(x) for x in all_img.shape])
@@ -140,11 +142,16 @@ def run(model, logdir, batch_size=50, vanilla=False, custom_steps=None, eta=None
     print(f"sampling of {n_saved} images finished in {(time.time() - tstart) / 60.:.2f} minutes.")
 
 
-def save_logs(logs, path, n_saved=0, key="sample", np_path=None):
+def save_logs(logs, path, n_saved=0, key="sample", np_path=None, writer=None):
+    """with an AsyncImageWriter, the images are written in the background"""
     for k in logs:
         if k == key:
             batch = logs[key]
-            if np_path is None:
+            if np_path is None and writer is not None:
+                images = custom_to_np(batch).numpy()
+                writer.submit(images, [os.path.join(path, f"{key}_{n_saved + i:06}.png") for i in range(len(images))])
+                n_saved += len(images)
+            elif np_path is None:
                 for x in batch:
                     img = custom_to_pil(x)
                     imgpath = os.path.join(path, f"{key}_{n_saved:06}.png")
@@ -217,24 +224,15 @@ def get_parser():
     return parser
 
 
-def load_model_from_config(config, sd):
-    model = instantiate_from_config(config)
-    model.load_state_dict(sd,strict=False)
-    model.cuda()
-    model.eval()
-    return model
-
-
 def load_model(config, ckpt, gpu, eval_mode):
     if ckpt:
-        print(f"Loading model from {ckpt}")
-        pl_sd = torch.load(ckpt, map_location="cpu")
-        global_step = pl_sd["global_step"]
+        model, metadata = load_model_from_config(config, ckpt, device=torch.device("cuda"), return_metadata=True)
+        global_step = metadata["global_step"]
     else:
-        pl_sd = {"state_dict": None}
+        model = instantiate_from_config(config.model)
+        model.cuda()
+        model.eval()
         global_step = None
-    model = load_model_from_config(config.model,
-                                   pl_sd["state_dict"])
 
     return model, global_step
 
@@ -1,20 +1,24 @@
 import argparse, os, sys, glob
-import cv2
+import json
+import threading
 import torch
+import torch.nn.functional as F
 import numpy as np
 from omegaconf import OmegaConf
 from PIL import Image
 from tqdm import tqdm, trange
-from imwatermark import WatermarkEncoder
 from itertools import islice
 from einops import rearrange
 from torchvision.utils import make_grid
 import time
+from concurrent.futures import Future
 from pytorch_lightning import seed_everything
 from torch import autocast
 from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 
-from ldm.util import instantiate_from_config
+from ldm.util import load_model_from_config, AsyncImageWriter, BatchWatermarker
+from ldm.latent_store import LatentStore
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.models.diffusion.dpm_solver import DPMSolverSampler
@@ -34,60 +38,109 @@ def chunk(it, size):
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-def numpy_to_pil(images):
+def read_prompts(path, batch_size, num_shards=1, shard_id=0, skip=()):
     """
-    Convert a numpy image or a batch of images to a PIL image.
+    Stream the prompts of a file, one per line, in batches of (line indices, prompts). Only the lines with
+    index % num_shards == shard_id are read, and lines in skip are left out.
     """
-    if images.ndim == 3:
-        images = images[None, ...]
-    images = (images * 255).round().astype("uint8")
-    pil_images = [Image.fromarray(image) for image in images]
-
-    return pil_images
-
-
-def load_model_from_config(config, ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
-        print(m)
-    if len(u) > 0 and verbose:
-        print("unexpected keys:")
-        print(u)
-
-    model.cuda()
-    model.eval()
-    return model
-
-
-def put_watermark(img, wm_encoder=None):
-    if wm_encoder is not None:
-        img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-        img = wm_encoder.encode(img, 'dwtDct')
-        img = Image.fromarray(img[:, :, ::-1])
-    return img
+    with open(path, "r") as f:
+        lines = ((i, line.rstrip("\r\n")) for i, line in enumerate(f)
+                 if i % num_shards == shard_id and i not in skip)
+        for batch in chunk(lines, batch_size):
+            yield tuple(zip(*batch))
+
+
+class ProgressManifest(object):
+    """
+    Append-only record of the prompt lines whose samples are written, one json line per batch. Reopening it for the
+    same output directory and shard resumes an interrupted run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        newline = False
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                content = f.read()
+            for line in content.splitlines():
+                try:
+                    self.done.update(json.loads(line)["lines"])
+                except (ValueError, KeyError):
+                    # the last entry of a run that was killed while writing it
+                    pass
+            newline = len(content) > 0 and not content.endswith("\n")
+        self.file = open(path, "a")
+        if newline:
+            self.file.write("\n")
+
+    def record_when_done(self, futures, lines, files):
+        """record lines once all futures, e.g. of AsyncImageWriter.submit, finished without error"""
+        remaining = [len(futures)]
+
+        def done(_):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] == 0 and all(f.exception() is None for f in futures):
+                    self.file.write(json.dumps({"lines": list(lines), "files": files}) + "\n")
+                    self.file.flush()
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def close(self):
+        self.file.close()
+
+
+@lru_cache(maxsize=8)
+def replacement_image(h, w, dtype):
+    y = Image.open("assets/rick.jpeg").convert("RGB").resize((w, h))
+    y = (np.array(y)/255.0).astype(dtype)
+    y.setflags(write=False)
+    return y
 
 
 def load_replacement(x):
     try:
-        hwc = x.shape
-        y = Image.open("assets/rick.jpeg").convert("RGB").resize((hwc[1], hwc[0]))
-        y = (np.array(y)/255.0).astype(x.dtype)
+        y = replacement_image(x.shape[0], x.shape[1], x.dtype.str)
         assert y.shape == x.shape
         return y
     except Exception:
         return x
 
 
-def check_safety(x_image):
-    safety_checker_input = safety_feature_extractor(numpy_to_pil(x_image), return_tensors="pt")
-    x_checked_image, has_nsfw_concept = safety_checker(images=x_image, clip_input=safety_checker_input.pixel_values)
+def safety_preprocess(x):
+    """
+    Batched equivalent of safety_feature_extractor for (b, c, h, w) images in [0, 1], on the device they are on:
+    resize the shortest side, center crop and normalize in one go instead of once per PIL image.
+    """
+    size = safety_feature_extractor.size
+    if isinstance(size, dict):
+        size = size.get("shortest_edge", size.get("height"))
+    crop = safety_feature_extractor.crop_size
+    crop = (crop["height"], crop["width"]) if isinstance(crop, dict) else (crop, crop)
+
+    h, w = x.shape[-2:]
+    scale = size / min(h, w)
+    x = F.interpolate(x.float(), size=(max(round(h * scale), crop[0]), max(round(w * scale), crop[1])),
+                      mode="bicubic", align_corners=False, antialias=True)
+    top, left = (x.shape[-2] - crop[0]) // 2, (x.shape[-1] - crop[1]) // 2
+    x = x[..., top:top + crop[0], left:left + crop[1]]
+
+    mean = torch.tensor(safety_feature_extractor.image_mean, device=x.device).view(1, -1, 1, 1)
+    std = torch.tensor(safety_feature_extractor.image_std, device=x.device).view(1, -1, 1, 1)
+    return (x - mean) / std
+
+
+def check_safety(x_image, clip_input=None):
+    """
+    :param x_image: (b, h, w, c) numpy images in [0, 1].
+    :param clip_input: the safety_preprocess'ed images, computed from x_image if not given.
+    """
+    if clip_input is None:
+        clip_input = safety_preprocess(torch.from_numpy(x_image).permute(0, 3, 1, 2))
+    clip_input = clip_input.to(safety_checker.device, safety_checker.dtype)
+    x_checked_image, has_nsfw_concept = safety_checker(images=x_image, clip_input=clip_input)
     assert x_checked_image.shape[0] == len(has_nsfw_concept)
     for i in range(len(has_nsfw_concept)):
         if has_nsfw_concept[i]:
@@ -138,6 +191,44 @@ def main():
         action='store_true',
         help="use dpm_solver sampling",
     )
+    parser.add_argument(
+        "--dpm_solver_method",
+        type=str,
+        choices=["multistep", "adaptive"],
+        default="multistep",
+        help="dpm_solver method. adaptive ignores --ddim_steps and picks the step sizes within --dpm_atol/--dpm_rtol",
+    )
+    parser.add_argument(
+        "--dpm_order",
+        type=int,
+        default=2,
+        help="order of the dpm_solver (2 or 3 for the adaptive method)",
+    )
+    parser.add_argument(
+        "--dpm_atol",
+        type=float,
+        default=0.0078,
+        help="absolute tolerance of the adaptive dpm_solver",
+    )
+    parser.add_argument(
+        "--dpm_rtol",
+        type=float,
+        default=0.05,
+        help="relative tolerance of the adaptive dpm_solver",
+    )
+    parser.add_argument(
+        "--early_exit",
+        type=float,
+        default=None,
+        help="stop sampling a sample once the relative change of its x0 prediction stays below this threshold "
+             "(e.g. 1e-3) and drop it from the batch",
+    )
+    parser.add_argument(
+        "--early_exit_patience",
+        type=int,
+        default=2,
+        help="number of consecutive steps below the --early_exit threshold before a sample stops",
+    )
     parser.add_argument(
         "--laion400m",
         action='store_true',
@@ -148,6 +239,12 @@ def main():
         action='store_true',
         help="if enabled, uses the same starting code across samples ",
     )
+    parser.add_argument(
+        "--per_sample_seeds",
+        action='store_true',
+        help="seed every sample on its own with seed + its index, such that a sample does not depend on the batch "
+             "size. always on for --from-file, where the index is the line of the prompt",
+    )
     parser.add_argument(
         "--ddim_eta",
         type=float,
@@ -196,17 +293,43 @@ def main():
         default=0,
         help="rows in the grid (default: n_samples)",
     )
+    parser.add_argument(
+        "--grid_max",
+        type=int,
+        default=64,
+        help="with --from-file, the grid only shows the first this many samples",
+    )
     parser.add_argument(
         "--scale",
         type=float,
         default=7.5,
         help="unconditional guidance scale: eps = eps(x, empty) + scale * (eps(x, cond) - eps(x, empty))",
     )
+    parser.add_argument(
+        "--guidance_policy",
+        type=str,
+        choices=["batched", "sequential"],
+        default="batched",
+        help="evaluate the unconditional and conditional predictions in one doubled batch or one after the other "
+             "(lower peak memory)",
+    )
     parser.add_argument(
         "--from-file",
         type=str,
         help="if specified, load prompts from this file",
     )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="split the prompts of --from-file over this many processes, by line index",
+    )
+    parser.add_argument(
+        "--shard-id",
+        type=int,
+        default=0,
+        help="the shard of --from-file this process renders, in [0, --num-shards)",
+    )
     parser.add_argument(
         "--config",
         type=str,
@@ -219,6 +342,17 @@ def main():
         default="models/ldm/stable-diffusion-v1/model.ckpt",
         help="path to checkpoint of model",
     )
+    parser.add_argument(
+        "--mmap",
+        action='store_true',
+        help="load the checkpoint through a memory-mappable copy, written once next to it or to --mmap_dir",
+    )
+    parser.add_argument(
+        "--mmap_dir",
+        type=str,
+        default=None,
+        help="directory for the memory-mappable copy of the checkpoint",
+    )
     parser.add_argument(
         "--seed",
         type=int,
@@ -232,7 +366,86 @@ def main():
         choices=["full", "autocast"],
         default="autocast"
     )
+    parser.add_argument(
+        "--vae_tiling",
+        action='store_true',
+        help="encode and decode with the autoencoder in overlapping tiles, for high resolutions",
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=64,
+        help="tile size of --vae_tiling in latent pixels",
+    )
+    parser.add_argument(
+        "--vae_tile_overlap",
+        type=int,
+        default=16,
+        help="minimum overlap of neighbouring tiles of --vae_tiling in latent pixels",
+    )
+    parser.add_argument(
+        "--vae_tiling_sequential",
+        action='store_true',
+        help="run the autoencoder on one tile at a time instead of all tiles as one batch, lowers peak memory",
+    )
+    parser.add_argument(
+        "--compile_denoiser",
+        type=str,
+        choices=["trace", "compile"],
+        default=None,
+        help="run the unet compiled for the batch shape of this run, with torch.jit.trace or torch.compile",
+    )
+    parser.add_argument(
+        "--compile_cache",
+        type=str,
+        default="cache/denoiser",
+        help="dir to keep the compiled denoisers in across runs",
+    )
+    parser.add_argument(
+        "--channels_last",
+        action='store_true',
+        help="run the unet and the autoencoder decoder in channels_last memory format",
+    )
+    parser.add_argument(
+        "--fuse_norm_act",
+        action='store_true',
+        help="fuse the group norms of the unet and the autoencoder decoder with the following SiLUs",
+    )
+    parser.add_argument(
+        "--skip_buffers",
+        action='store_true',
+        help="write the skip connections of the unet into preallocated concatenation buffers instead of "
+             "concatenating them with torch.cat",
+    )
+    parser.add_argument(
+        "--image_format",
+        type=str,
+        choices=["png", "webp"],
+        default="png",
+        help="file format of the samples and grids",
+    )
+    parser.add_argument(
+        "--writer_workers",
+        type=int,
+        default=2,
+        help="number of threads that encode and write images while sampling continues",
+    )
+    parser.add_argument(
+        "--latents_only",
+        action='store_true',
+        help="do not decode, store the sampled latents in outdir/latents instead. decode them later with "
+             "scripts/decode_latents.py",
+    )
+    parser.add_argument(
+        "--watermark_workers",
+        type=int,
+        default=4,
+        help="number of processes that put the invisible watermark, 0 to watermark on the writer threads",
+    )
     opt = parser.parse_args()
+    if opt.early_exit is not None and opt.dpm_solver and opt.dpm_solver_method != "multistep":
+        parser.error("--early_exit is only supported by the multistep dpm_solver, not by --dpm_solver_method "
+                     f"{opt.dpm_solver_method}")
 
     if opt.laion400m:
         print("Falling back to LAION 400M model...")
@@ -243,13 +456,27 @@ def main():
     seed_everything(opt.seed)
 
     config = OmegaConf.load(f"{opt.config}")
-    model = load_model_from_config(config, f"{opt.ckpt}")
-
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-    model = model.to(device)
-
+    model = load_model_from_config(config, f"{opt.ckpt}", device=device, use_mmap=opt.mmap, mmap_dir=opt.mmap_dir)
+    if opt.vae_tiling:
+        model.enable_first_stage_tiling(opt.vae_tile_size, opt.vae_tile_overlap, sequential=opt.vae_tiling_sequential)
+    if opt.channels_last or opt.fuse_norm_act:
+        for net in [model.model.diffusion_model, model.first_stage_model.decoder]:
+            net.optimize_for_inference(channels_last=opt.channels_last, fuse_norm_act=opt.fuse_norm_act)
+    if opt.skip_buffers:
+        model.model.diffusion_model.enable_skip_buffers()
+    if opt.compile_denoiser is not None:
+        # classifier-free guidance evaluates both conditionings in one doubled batch
+        batch = opt.n_samples * (2 if opt.scale != 1.0 and opt.guidance_policy == "batched" else 1)
+        context_length = getattr(model.cond_stage_model, "max_length", 77)
+        model.compile_denoiser([(batch, opt.H // opt.f, opt.W // opt.f, context_length)], cache_dir=opt.compile_cache,
+                               backend=opt.compile_denoiser)
+
+    sampler_kwargs = dict(early_exit_threshold=opt.early_exit, early_exit_patience=opt.early_exit_patience)
     if opt.dpm_solver:
         sampler = DPMSolverSampler(model)
+        sampler_kwargs.update(method=opt.dpm_solver_method, order=opt.dpm_order, atol=opt.dpm_atol,
+                              rtol=opt.dpm_rtol)
     elif opt.plms:
         sampler = PLMSSampler(model)
     else:
@@ -260,90 +487,153 @@ def main():
 
     print("Creating invisible watermark encoder (see https://github.com/ShieldMnt/invisible-watermark)...")
     wm = "StableDiffusionV1"
-    wm_encoder = WatermarkEncoder()
-    wm_encoder.set_watermark('bytes', wm.encode('utf-8'))
+    watermarker = BatchWatermarker(wm, opt.watermark_workers)
+    writer = AsyncImageWriter(opt.writer_workers, batch_transform=watermarker)
 
     batch_size = opt.n_samples
     n_rows = opt.n_rows if opt.n_rows > 0 else batch_size
+    manifest = None
     if not opt.from_file:
         prompt = opt.prompt
         assert prompt is not None
-        data = [batch_size * [prompt]]
+        data = [(None, batch_size * [prompt])]
 
     else:
-        print(f"reading prompts from {opt.from_file}")
-        with open(opt.from_file, "r") as f:
-            data = f.read().splitlines()
-            data = list(chunk(data, batch_size))
+        assert 0 <= opt.shard_id < opt.num_shards, "--shard-id has to be in [0, --num-shards)"
+        manifest = ProgressManifest(os.path.join(outpath, f"manifest-{opt.shard_id:03}-of-{opt.num_shards:03}.jsonl"))
+        print(f"reading prompts from {opt.from_file}, shard {opt.shard_id} of {opt.num_shards}, "
+              f"{len(manifest.done)} prompts already done")
+        data = read_prompts(opt.from_file, batch_size, opt.num_shards, opt.shard_id, skip=manifest.done)
 
     sample_path = os.path.join(outpath, "samples")
     os.makedirs(sample_path, exist_ok=True)
-    base_count = len(os.listdir(sample_path))
-    grid_count = len(os.listdir(outpath)) - 1
-
+    base_count = len(os.listdir(sample_path)) if not opt.from_file else 0
+    store = None
+    if opt.latents_only:
+        store = LatentStore(os.path.join(outpath, "latents"))
+        base_count = store.next_id
+        opt.skip_grid = True
+    grid_max = opt.grid_max if opt.from_file else None
+
+    shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
     start_code = None
     if opt.fixed_code:
-        start_code = torch.randn([opt.n_samples, opt.C, opt.H // opt.f, opt.W // opt.f], device=device)
+        start_code = torch.randn([opt.n_samples] + shape, device=device)
 
     precision_scope = autocast if opt.precision=="autocast" else nullcontext
     with torch.no_grad():
         with precision_scope("cuda"):
             with model.ema_scope():
                 tic = time.time()
-                all_samples = list()
-                for n in trange(opt.n_iter, desc="Sampling"):
-                    for prompts in tqdm(data, desc="data"):
-                        uc = None
-                        if opt.scale != 1.0:
-                            uc = model.get_learned_conditioning(batch_size * [""])
-                        if isinstance(prompts, tuple):
-                            prompts = list(prompts)
-                        c = model.get_learned_conditioning(prompts)
-                        shape = [opt.C, opt.H // opt.f, opt.W // opt.f]
-                        samples_ddim, _ = sampler.sample(S=opt.ddim_steps,
-                                                         conditioning=c,
-                                                         batch_size=opt.n_samples,
-                                                         shape=shape,
-                                                         verbose=False,
-                                                         unconditional_guidance_scale=opt.scale,
-                                                         unconditional_conditioning=uc,
-                                                         eta=opt.ddim_eta,
-                                                         x_T=start_code)
+                all_samples, grid_lines = list(), None
+                sample_count = 0
+                for lines, prompts in tqdm(data, desc="data"):
+                    prompts = list(prompts)
+                    uc = None
+                    if opt.scale != 1.0:
+                        uc = model.get_learned_conditioning(len(prompts) * [""])
+                    c = model.get_learned_conditioning(prompts)
+                    futures, files = list(), list()
+                    for n in trange(opt.n_iter, desc="Sampling"):
+                        generator = None
+                        if lines is not None:
+                            # a prompt from a file only depends on the seed and its line, not on the shard or batch
+                            # it ends up in
+                            generator = [opt.seed + line * opt.n_iter + n for line in lines]
+                        elif opt.per_sample_seeds:
+                            generator = [opt.seed + sample_count + i for i in range(len(prompts))]
+                            sample_count += len(prompts)
+                        samples_ddim, info = sampler.sample(S=opt.ddim_steps,
+                                                            conditioning=c,
+                                                            batch_size=len(prompts),
+                                                            shape=shape,
+                                                            verbose=False,
+                                                            unconditional_guidance_scale=opt.scale,
+                                                            unconditional_conditioning=uc,
+                                                            eta=opt.ddim_eta,
+                                                            x_T=start_code,
+                                                            generator=generator,
+                                                            guidance_policy=opt.guidance_policy,
+                                                            **sampler_kwargs)
+                        if opt.dpm_solver:
+                            print(f"NFE per sample: {info['nfe']}")
+                        if opt.early_exit is not None:
+                            print(f"Stopped after steps: {info['stop_steps']}")
+
+                        if lines is None:
+                            names = [f"{base_count + i:05}" for i in range(len(prompts))]
+                        else:
+                            # named by line, so that shards never collide and nothing has to be counted
+                            names = [f"{line:08}-{n}" for line in lines]
+
+                        if store is not None:
+                            flushed = Future()
+                            store.append(samples_ddim, [
+                                {"name": name, "prompt": prompt, "seed": seed, "steps": opt.ddim_steps,
+                                 "scale": opt.scale, "H": opt.H, "W": opt.W}
+                                for name, prompt, seed in zip(names, prompts, generator or [None] * len(prompts))],
+                                on_flush=lambda flushed=flushed: flushed.set_result(None))
+                            base_count += len(names)
+                            futures.append(flushed)
+                            files.extend(names)
+                            continue
 
                         x_samples_ddim = model.decode_first_stage(samples_ddim)
                         x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+                        clip_input = safety_preprocess(x_samples_ddim)
                         x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
 
-                        x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
-
-                        x_checked_image_torch = torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
-
+                        # safety check, watermark and write on the writer threads while the next batch samples
+                        paths = [None] * len(x_samples_ddim)
                         if not opt.skip_save:
-                            for x_sample in x_checked_image_torch:
-                                x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                                img = Image.fromarray(x_sample.astype(np.uint8))
-                                img = put_watermark(img, wm_encoder)
-                                img.save(os.path.join(sample_path, f"{base_count:05}.png"))
-                                base_count += 1
+                            paths = [os.path.join(sample_path, f"{name}.{opt.image_format}") for name in names]
+                            base_count += len(paths)
+                        x_checked_image = writer.submit(
+                            x_samples_ddim, paths,
+                            postprocess=lambda x, clip_input=clip_input: check_safety(x, clip_input)[0])
+                        futures.append(x_checked_image)
+                        files.extend(paths)
 
                         if not opt.skip_grid:
-                            all_samples.append(x_checked_image_torch)
-
-                if not opt.skip_grid:
+                            # only the first grid_max samples of a prompt file are kept for the grid
+                            k = len(names)
+                            if grid_max is not None:
+                                k = min(k, grid_max - sum(n for _, n in all_samples))
+                            if k > 0:
+                                all_samples.append((x_checked_image, k))
+                                if grid_lines is None:
+                                    grid_lines = lines
+
+                    if manifest is not None:
+                        manifest.record_when_done(futures, lines, files)
+
+                if not opt.skip_grid and len(all_samples) > 0:
                     # additionally, save as grid
-                    grid = torch.stack(all_samples, 0)
-                    grid = rearrange(grid, 'n b c h w -> (n b) c h w')
+                    grid = torch.cat([torch.from_numpy(x.result()[:k]).permute(0, 3, 1, 2) for x, k in all_samples], 0)
                     grid = make_grid(grid, nrow=n_rows)
 
                     # to image
                     grid = 255. * rearrange(grid, 'c h w -> h w c').cpu().numpy()
-                    img = Image.fromarray(grid.astype(np.uint8))
-                    img = put_watermark(img, wm_encoder)
-                    img.save(os.path.join(outpath, f'grid-{grid_count:04}.png'))
-                    grid_count += 1
-
+                    if grid_lines is None:
+                        grid_name = f"grid-{len(os.listdir(outpath)) - 1:04}"
+                    else:
+                        # named by the first line it shows, unique across shards and resumed runs
+                        grid_name = f"grid-{grid_lines[0]:08}"
+                    writer.submit(grid.astype(np.uint8)[None],
+                                  [os.path.join(outpath, f"{grid_name}.{opt.image_format}")])
+
+                if store is not None:
+                    store.close()
+                writer.close()
+                watermarker.close()
+                if manifest is not None:
+                    manifest.close()
                 toc = time.time()
 
+    if hasattr(model, "cond_cache"):
+        info = model.cond_cache.info()
+        print(f"Conditioning cache: {info.hits} hits, {info.misses} misses, {info.entries} entries "
+              f"({info.nbytes / 2**20:.1f} MiB)")
     print(f"Your samples are ready and waiting for you here: \n{outpath} \n"
           f" \nEnjoy.")
 
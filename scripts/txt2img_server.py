@@ -0,0 +1,493 @@
+"""long-lived txt2img service
+
+Loads the model once and serves requests over HTTP (--host/--port) or a Unix socket (--socket). Requests that
+agree on resolution, step count, guidance scale and eta are grouped into one sampler call. A batch is dispatched
+as soon as it holds --max_batch samples or its oldest request has waited --max_wait milliseconds. With
+--continuous, requests are batched per sampler step instead and join or leave the running batch at any step.
+
+    POST /txt2img  {"prompt": "a painting of a virus monster playing guitar", "n_samples": 1,
+                    "H": 512, "W": 512, "steps": 50, "scale": 7.5, "eta": 0.0, "seed": 42, "format": "png"}
+        -> {"images": [<base64 encoded png>, ...], "nsfw": [false, ...], "seed": 42, "batch_size": 4,
+            "cached": false}
+    GET /health
+        -> {"pending": 0, "batches": 12, "samples": 40, "cache": {"hits": 3, "misses": 9, "entries": 9}}
+
+With --result_cache, results are cached under a hash of the request and a fingerprint of the weights, and repeated
+requests, in any output format, skip sampling.
+
+    python scripts/txt2img_server.py --port 8080 --max_batch 8 --max_wait 50
+    curl -X POST localhost:8080/txt2img -d '{"prompt": "a photograph of an astronaut riding a horse"}'
+"""
+
+import argparse, os
+import base64
+import io
+import json
+import random
+import socketserver
+import threading
+import time
+import torch
+import numpy as np
+from omegaconf import OmegaConf
+from PIL import Image
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from torch import autocast
+from contextlib import nullcontext
+
+from ldm.util import load_model_from_config, BatchWatermarker
+from ldm.result_cache import ResultCache, state_dict_fingerprint
+from ldm.models.diffusion.ddim import DDIMSampler
+
+# the safety and watermarking helpers are shared with the txt2img script
+from txt2img import check_safety, safety_preprocess
+
+
+IMAGE_FORMATS = ["png", "webp", "jpeg"]
+
+
+class Txt2ImgRequest(object):
+    def __init__(self, prompt, n_samples, H, W, steps, scale, eta, seed, format="png"):
+        self.prompt = prompt
+        self.n_samples = n_samples
+        self.H = H
+        self.W = W
+        self.steps = steps
+        self.scale = scale
+        self.eta = eta
+        self.seed = seed
+        self.format = format
+        self.arrival = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    @property
+    def key(self):
+        """requests with the same key can share one sampler call"""
+        return self.H, self.W, self.steps, self.scale, self.eta
+
+    @property
+    def params(self):
+        """everything that determines the images of the request, the output format does not"""
+        return {"prompt": self.prompt, "n_samples": self.n_samples, "H": self.H, "W": self.W, "steps": self.steps,
+                "scale": self.scale, "eta": self.eta, "seed": self.seed}
+
+    @classmethod
+    def from_json(cls, payload, opt):
+        prompt = payload["prompt"]
+        if not isinstance(prompt, str):
+            raise ValueError("prompt has to be a string")
+        req = cls(prompt=prompt,
+                  n_samples=int(payload.get("n_samples", 1)),
+                  H=int(payload.get("H", opt.H)),
+                  W=int(payload.get("W", opt.W)),
+                  steps=int(payload.get("steps", opt.ddim_steps)),
+                  scale=float(payload.get("scale", opt.scale)),
+                  eta=float(payload.get("eta", opt.ddim_eta)),
+                  seed=int(payload["seed"]) if payload.get("seed") is not None else random.randint(0, 2**31 - 1),
+                  format=str(payload.get("format", "png")).lower())
+        if not 1 <= req.n_samples <= opt.max_batch:
+            raise ValueError(f"n_samples has to be between 1 and {opt.max_batch}")
+        if req.H % opt.f != 0 or req.W % opt.f != 0:
+            raise ValueError(f"H and W have to be multiples of {opt.f}")
+        if req.steps < 1:
+            raise ValueError("steps has to be positive")
+        if req.format not in IMAGE_FORMATS:
+            raise ValueError(f"format has to be one of {IMAGE_FORMATS}")
+        return req
+
+
+class Batcher(object):
+    """
+    Groups pending requests into batches. The oldest pending request determines the key of the next batch; the
+    batch is closed once it is full (max_batch samples, or the next compatible request does not fit) or when the
+    oldest request has waited max_wait seconds.
+    """
+    def __init__(self, run_batch, max_batch=8, max_wait=0.05):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = list()
+        self.cond = threading.Condition()
+        self.batches = 0
+        self.samples = 0
+
+    def submit(self, req):
+        with self.cond:
+            self.pending.append(req)
+            self.cond.notify()
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def collect(self, key):
+        batch, n, full = list(), 0, False
+        for req in self.pending:
+            if req.key != key:
+                continue
+            if n + req.n_samples > self.max_batch:
+                full = True
+                break
+            batch.append(req)
+            n += req.n_samples
+        return batch, n, full or n >= self.max_batch
+
+    def next_batch(self):
+        with self.cond:
+            while True:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                head = self.pending[0]
+                batch, n, full = self.collect(head.key)
+                remaining = head.arrival + self.max_wait - time.monotonic()
+                if full or remaining <= 0:
+                    for req in batch:
+                        self.pending.remove(req)
+                    return batch, n
+                self.cond.wait(remaining)
+
+    def loop(self):
+        while True:
+            batch, n = self.next_batch()
+            try:
+                results = self.run_batch(batch)
+                for req, result in zip(batch, results):
+                    req.result = result
+            except Exception as e:
+                print(f"batch of {n} samples failed: {e}")
+                for req in batch:
+                    req.error = e
+            finally:
+                self.batches += 1
+                self.samples += n
+                for req in batch:
+                    req.done.set()
+
+    def stats(self):
+        with self.cond:
+            pending = len(self.pending)
+        return {"pending": pending, "batches": self.batches, "samples": self.samples}
+
+
+def encode_image(img, format="png"):
+    buf = io.BytesIO()
+    img.save(buf, format=format)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+class ContinuousBatcher(Batcher):
+    """
+    Step-level batching: the samples of every request are sampled as separate DDIM states and every sampler step
+    runs one forward pass over the states of all running requests, which may be at different steps of schedules
+    with different lengths, guidance scales and etas. A new request joins as soon as there is room for its
+    samples, instead of waiting for the running batch to finish. Only states of the same resolution can share a
+    forward pass; the resolutions of the running requests take turns.
+    """
+    def __init__(self, init_request, step, finish_request, max_batch=8):
+        super().__init__(None, max_batch=max_batch, max_wait=0.)
+        self.init_request = init_request
+        self.step = step
+        self.finish_request = finish_request
+
+    def fail(self, reqs, e):
+        print(f"{len(reqs)} requests failed: {e}")
+        for req in reqs:
+            req.error = e
+            req.done.set()
+
+    def admit(self, active):
+        with self.cond:
+            while len(self.pending) == 0 and len(active) == 0:
+                self.cond.wait()
+            n = sum(req.n_samples for req in active)
+            admitted = list()
+            while len(self.pending) > 0 and n + self.pending[0].n_samples <= self.max_batch:
+                req = self.pending.pop(0)
+                admitted.append(req)
+                n += req.n_samples
+        for req in admitted:
+            try:
+                req.states = self.init_request(req)
+                active.append(req)
+            except Exception as e:
+                self.fail([req], e)
+
+    def loop(self):
+        active = list()
+        while True:
+            self.admit(active)
+            if len(active) == 0:
+                continue
+            shapes = list()
+            for req in active:
+                if req.states[0].x.shape not in shapes:
+                    shapes.append(req.states[0].x.shape)
+            shape = shapes[self.batches % len(shapes)]
+            group = [req for req in active if req.states[0].x.shape == shape]
+            states = [s for req in group for s in req.states]
+            try:
+                self.step(states)
+            except Exception as e:
+                self.fail(group, e)
+                active = [req for req in active if req not in group]
+                continue
+            finally:
+                self.batches += 1
+
+            for req in group:
+                if all(s.done for s in req.states):
+                    active.remove(req)
+                    try:
+                        req.result = self.finish_request(req, len(states))
+                    except Exception as e:
+                        print(f"request failed: {e}")
+                        req.error = e
+                    self.samples += req.n_samples
+                    req.done.set()
+
+
+def sample_seeds(req):
+    # every sample is drawn from its own generator, so that it only depends on the seed of its request and its index
+    # in the request, not on the batch it ends up in
+    return [req.seed + i for i in range(req.n_samples)]
+
+
+def make_postprocess(model, opt, watermarker):
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+
+    @torch.no_grad()
+    def postprocess(samples_ddim, batch, batch_size):
+        with precision_scope("cuda"):
+            x_samples_ddim = model.decode_first_stage(samples_ddim)
+            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+            clip_input = safety_preprocess(x_samples_ddim)
+            x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
+
+        x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim, clip_input)
+        images = watermarker((255. * x_checked_image).astype(np.uint8))
+        latents = samples_ddim.float().cpu().numpy()
+
+        # the images are encoded on the handler threads, in the format of the request
+        results, offset = list(), 0
+        for req in batch:
+            results.append({"images": images[offset:offset + req.n_samples],
+                            "latents": latents[offset:offset + req.n_samples],
+                            "nsfw": [bool(x) for x in has_nsfw_concept[offset:offset + req.n_samples]],
+                            "seed": req.seed,
+                            "batch_size": batch_size})
+            offset += req.n_samples
+        return results
+
+    return postprocess
+
+
+def make_run_batch(model, sampler, opt, watermarker):
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    postprocess = make_postprocess(model, opt, watermarker)
+
+    @torch.no_grad()
+    def run_batch(batch):
+        H, W, steps, scale, eta = batch[0].key
+        prompts = [req.prompt for req in batch for _ in range(req.n_samples)]
+        shape = [opt.C, H // opt.f, W // opt.f]
+        seeds = [seed for req in batch for seed in sample_seeds(req)]
+
+        with precision_scope("cuda"):
+            uc = None
+            if scale != 1.0:
+                uc = model.get_learned_conditioning(len(prompts) * [""])
+            c = model.get_learned_conditioning(prompts)
+            samples_ddim, _ = sampler.sample(S=steps,
+                                             conditioning=c,
+                                             batch_size=len(prompts),
+                                             shape=shape,
+                                             verbose=False,
+                                             unconditional_guidance_scale=scale,
+                                             unconditional_conditioning=uc,
+                                             eta=eta,
+                                             generator=seeds)
+        return postprocess(samples_ddim, batch, len(prompts))
+
+    return run_batch
+
+
+def make_continuous_fns(model, sampler, opt, watermarker):
+    precision_scope = autocast if opt.precision == "autocast" else nullcontext
+    postprocess = make_postprocess(model, opt, watermarker)
+
+    @torch.no_grad()
+    def init_request(req):
+        shape = [opt.C, req.H // opt.f, req.W // opt.f]
+        with precision_scope("cuda"):
+            uc = None
+            if req.scale != 1.0:
+                uc = model.get_learned_conditioning([""])
+            c = model.get_learned_conditioning([req.prompt])
+        return [sampler.init_state(req.steps, c, shape=shape, eta=req.eta, unconditional_guidance_scale=req.scale,
+                                   unconditional_conditioning=uc, generator=seed)
+                for seed in sample_seeds(req)]
+
+    @torch.no_grad()
+    def step(states):
+        with precision_scope("cuda"):
+            sampler.step(states)
+
+    def finish_request(req, batch_size):
+        return postprocess(torch.cat([s.x for s in req.states]), [req], batch_size)[0]
+
+    return init_request, step, finish_request
+
+
+class Txt2ImgHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        stats = self.server.batcher.stats()
+        if self.server.result_cache is not None:
+            stats["cache"] = self.server.result_cache.stats()
+        self.send_json(200, stats)
+
+    def do_POST(self):
+        if self.path != "/txt2img":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            req = Txt2ImgRequest.from_json(json.loads(self.rfile.read(length)), self.server.opt)
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json(400, {"error": f"bad request: {e}"})
+            return
+        cache, key, cached = self.server.result_cache, None, None
+        try:
+            if cache is not None:
+                key = cache.key(**req.params, precision=self.server.opt.precision)
+                cached = cache.get(key)
+            if cached is not None:
+                result = {"images": cached["images"], "nsfw": cached["info"]["nsfw"], "seed": req.seed,
+                          "batch_size": 0}
+            else:
+                result = self.server.batcher.submit(req)
+                if cache is not None:
+                    cache.put(key, result["images"], latents=result["latents"], info={"nsfw": result["nsfw"]})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        result.pop("latents", None)
+        result["images"] = [encode_image(Image.fromarray(x), req.format) for x in result["images"]]
+        result["cached"] = cached is not None
+        self.send_json(200, result)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="listen on this unix socket instead of --host/--port")
+    parser.add_argument("--max_batch", type=int, default=8, help="maximum number of samples per sampler call")
+    parser.add_argument("--max_wait", type=float, default=50,
+                        help="maximum time in milliseconds a request waits for other requests to batch with")
+    parser.add_argument("--continuous", action='store_true',
+                        help="batch per sampler step: requests join and leave the running batch at any step, and "
+                             "requests with different step counts, scales and etas share forward passes")
+    parser.add_argument("--ddim_steps", type=int, default=50, help="default number of ddim sampling steps")
+    parser.add_argument("--ddim_eta", type=float, default=0.0, help="default ddim eta")
+    parser.add_argument("--H", type=int, default=512, help="default image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="default image width, in pixel space")
+    parser.add_argument("--C", type=int, default=4, help="latent channels")
+    parser.add_argument("--f", type=int, default=8, help="downsampling factor")
+    parser.add_argument("--scale", type=float, default=7.5, help="default unconditional guidance scale")
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml",
+                        help="path to config which constructs model")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt",
+                        help="path to checkpoint of model")
+    parser.add_argument("--mmap", action='store_true',
+                        help="load the checkpoint through a memory-mappable copy, written once next to it or to "
+                             "--mmap_dir")
+    parser.add_argument("--mmap_dir", type=str, default=None,
+                        help="directory for the memory-mappable copy of the checkpoint")
+    parser.add_argument("--precision", type=str, help="evaluate at this precision", choices=["full", "autocast"],
+                        default="autocast")
+    parser.add_argument("--watermark_workers", type=int, default=4,
+                        help="number of processes that put the invisible watermark, 0 to watermark in the worker")
+    parser.add_argument("--result_cache", type=str, default=None,
+                        help="cache results in this directory, or in this sqlite database if it ends in .sqlite")
+    parser.add_argument("--result_cache_gb", type=float, default=10,
+                        help="size of the result cache in GiB, least recently used results are evicted")
+    parser.add_argument("--cache_latents", action='store_true', help="also cache the final latents of a result")
+    opt = parser.parse_args()
+    opt.max_wait = opt.max_wait / 1000.
+
+    config = OmegaConf.load(f"{opt.config}")
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = load_model_from_config(config, f"{opt.ckpt}", device=device, use_mmap=opt.mmap,
+                                   mmap_dir=opt.mmap_dir)
+    sampler = DDIMSampler(model)
+
+    wm = "StableDiffusionV1"
+    watermarker = BatchWatermarker(wm, opt.watermark_workers)
+
+    result_cache = None
+    if opt.result_cache is not None:
+        result_cache = ResultCache(opt.result_cache, state_dict_fingerprint(model),
+                                   max_bytes=int(opt.result_cache_gb * 2**30), store_latents=opt.cache_latents)
+        print(f"Caching results in {opt.result_cache} ({len(result_cache.backend)} entries)")
+
+    if opt.continuous:
+        batcher = ContinuousBatcher(*make_continuous_fns(model, sampler, opt, watermarker), max_batch=opt.max_batch)
+    else:
+        batcher = Batcher(make_run_batch(model, sampler, opt, watermarker), max_batch=opt.max_batch,
+                          max_wait=opt.max_wait)
+
+    def worker():
+        # a single worker owns the model and the sampler
+        # the continuous batcher keeps the key / value cache and the timestep tables across its steps
+        with model.ema_scope(), sampler.stepping() if opt.continuous else nullcontext():
+            batcher.loop()
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    if opt.socket is not None:
+        if os.path.exists(opt.socket):
+            os.remove(opt.socket)
+        server = ThreadingUnixHTTPServer(opt.socket, Txt2ImgHandler)
+        where = opt.socket
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), Txt2ImgHandler)
+        where = f"http://{opt.host}:{opt.port}"
+    server.batcher = batcher
+    server.result_cache = result_cache
+    server.opt = opt
+    print(f"Serving txt2img on {where} ({'continuous batching' if opt.continuous else 'request batching'}, "
+          f"max batch {opt.max_batch}, max wait {1000 * opt.max_wait:.0f} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if opt.socket is not None and os.path.exists(opt.socket):
+            os.remove(opt.socket)
+
+
+if __name__ == "__main__":
+    main()